@@ -22,6 +22,7 @@ CROP_DATA = INPUT_DATA_PATH / "vw_crop_crosswalks_vw_perspective.csv"
 FIELD_DATA = INPUT_DATA_PATH / "vw_fields_southern_subset.csv"
 WELL_DATA = INPUT_DATA_PATH / "vw_wells_with_apns_and_service_areas.csv"
 ET_DATA = INPUT_DATA_PATH / "vw_et_and_precip_2018_annual.csv"
+MONTHLY_ET_DATA = {}  # {month: file} of monthly ET and precip, in the same format as ET_DATA - loaded as AgFieldTimestep.MONTHS
 CROP_IRRIGATION_TYPE_DATA = INPUT_DATA_PATH / "vw_prob_table_crop_irrig.csv"
 PRODUCTION_DATA_FILES = (
                             INPUT_DATA_PATH / "vw_well_billing_semi.csv",
@@ -30,6 +31,7 @@ PRODUCTION_DATA_FILES = (
                          )
 PIPE_FILE = INPUT_DATA_PATH / "vw_well_field_near_table.csv"
 #PIPE_FILE = INPUT_DATA_PATH / "vw_pipes_global_1500m.csv"
+#PIPE_FILE = None  # generate the pipes from the well and field coordinates - see allocate/pipes.py
 
 
 # Quick-start development settings - unsuitable for production
@@ -98,6 +100,15 @@ DATABASES = {
     }
 }
 
+# applied to every new SQLite connection - see allocate/sqlite.py. Set to None to keep SQLite's defaults
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",  # readers and the writer don't block each other, so model runs and loads can overlap
+    "synchronous": "NORMAL",  # safe with WAL - a power failure can lose the last commits, but can't corrupt the database
+    "mmap_size": 268435456,  # 256 MB
+    "cache_size": -65536,  # negative values are KiB, so 64 MB
+    "temp_store": "MEMORY",
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
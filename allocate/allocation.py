@@ -1,16 +1,24 @@
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from itertools import combinations
 import math
 from matplotlib.pyplot import boxplot
 from matplotlib import pyplot as plt
 import statistics
-import random
-import csv
 
 import numpy
 
 from cvxpy import Problem, Variable, Parameter, Maximize, sum as cvxsum
-from . import models
+from . import instrumentation, report, sampling
+from .instrumentation import activate as activate_instrumentation
+from .inputs import ModelInputs, NO_CROP
+from .lp import AllocationLP, FEASIBLE_STATUSES, Solution, model_settings
+from .results import ResultStore
+from .sampling import EfficiencySampler
+from .solvers import SolverSettings
+from .solve_cache import CACHED_STATUS, SolutionMemo, cached_solve
+from .streaming import EffectivenessStatistics, TopResults
+from .writer import write_results
 
 import logging
 
@@ -29,8 +37,6 @@ FIELD_DEMAND_MARGIN = 0.75
 WELL_ALLOCATION_MARGIN = 0
 SINGLE_CROP_WELL_ALLOCATION_MARGIN = 0
 
-FULL_RESET = False  # change if we want to overwrite calculated values for names/variables in the DB. Runs much slower
-
 MAX_WELLS_PER_FIELD = 5
 
 def get_parts(cost_timestep=1,
@@ -40,7 +46,8 @@ def get_parts(cost_timestep=1,
               add_debug=False,
               well_allocation_margin=WELL_ALLOCATION_MARGIN,
               single_crop_well_allocation_margin=SINGLE_CROP_WELL_ALLOCATION_MARGIN,
-              field_demand_margin=FIELD_DEMAND_MARGIN
+              field_demand_margin=FIELD_DEMAND_MARGIN,
+              inputs=None
               ):
     # so, we want to satisfy the demand of every ag field
     benefits = []
@@ -51,72 +58,69 @@ def get_parts(cost_timestep=1,
     vars_by_well = defaultdict(list)
     vars_by_name = {}
     demands_by_field = {}
-
-    if service_area is not None:
-        ag_fields = models.AgField.objects.filter(ucm_service_area_id=service_area)
-    else:
-        ag_fields = models.AgField.objects.all()
-
-    for field in ag_fields:
-        # get all the pipes for the field, except get the shortest ones first, and then limit it so we actually only get up to MAX_WELLS_PER_FIELD pipes to reduce model complexity
-        for pipe in field.pipes.all().order_by('distance')[:MAX_WELLS_PER_FIELD]:  # we'll only use the pipes connected to the fields here
-            well = pipe.well  # which means we only get the wells connected to those pipes, not others
-
-            do_save = False
-            if pipe.variable_name is None or FULL_RESET:
-                do_save = True
-
-            pipe.variable_name = f"well_{well.well_id}_field_{field.liq_id}"
-            variable = Variable(name=pipe.variable_name, nonneg=True)
-            # see if we can store the connections to the Django objects on the optimization variables
-            variable.alloc_pipe = pipe
+    field_demands = {}  # the demand before irrigation efficiency, as a number - demands_by_field has the expressions
+
+    if inputs is None:
+        inputs = load_inputs(service_area=service_area, year=year, cost_timestep=cost_timestep)
+
+    # pipes in the snapshot are already sorted by field and then distance, and limited to MAX_WELLS_PER_FIELD for each field to reduce model complexity
+    pipes_by_field = defaultdict(list)
+    for pipe_index in range(inputs.num_pipes):
+        pipes_by_field[inputs.pipe_field_index[pipe_index]].append(pipe_index)
+
+    pipe_variables = [None] * inputs.num_pipes  # in the snapshot's pipe order, same as AllocationLP's allocation vector
+    debug_variables = []
+    for field_index, field in enumerate(inputs.field_ids):
+        for pipe_index in pipes_by_field[field_index]:  # we'll only use the pipes connected to the fields here
+            well = inputs.well_ids[inputs.pipe_well_index[pipe_index]]  # which means we only get the wells connected to those pipes, not others
+
+            variable_name = inputs.pipe_variable_name(pipe_index)
+            variable = Variable(name=variable_name, nonneg=True)
+            # store the connections back to the database records on the optimization variables
+            variable.alloc_pipe_id = int(inputs.pipe_pks[pipe_index])
             variable.alloc_field = field
             variable.alloc_well = well
-            vars_by_name[pipe.variable_name] = variable
-
-            if do_save:
-                pipe.save()  # temporarily not saving for testing
+            vars_by_name[variable_name] = variable
+            pipe_variables[pipe_index] = variable
 
             benefits.append(variable * MAX_BENEFIT_DISTANCE_METERS)  # benefit is the amount of water times the max distance we can send
-            cost = variable * pipe.distance  # the cost is the amount of water sent over each pipe times the distance of the pipe
+            cost = variable * inputs.pipe_distance[pipe_index]  # the cost is the amount of water sent over each pipe times the distance of the pipe
             costs.append(cost)  # this way, once we subtract costs from benefits, costs only exceed benefits if the water travels more than the max distance.
 
             # index the vars so we can set constraints after this is all over
-            vars_by_well[well.well_id].append(variable)
-            vars_by_field[field.liq_id].append(variable)
+            vars_by_well[well].append(variable)
+            vars_by_field[field].append(variable)
 
         if add_debug:
-            debug_var_name = f"field_{field.liq_id}_debug"
+            debug_var_name = f"field_{field}_debug"
             debug_var = Variable(name=debug_var_name, nonneg=True)
 
             costs.append(debug_var * MAX_BENEFIT_DISTANCE_METERS * 1000)  # make this water cost an extra high amount to make sure it doesn't use it unless it's trying to make the model feasible
 
             # add it to the field's mass balance only so the field can pull water in from here, and that water has no limit,
             # but it's super high cost
-            vars_by_field[field.liq_id].append(debug_var)
+            vars_by_field[field].append(debug_var)
             vars_by_name[debug_var_name] = debug_var
+            debug_variables.append(debug_var)
 
+    field_positions = {field: index for index, field in enumerate(inputs.field_ids)}
     irrigation_efficiency_params = {}
     for field in vars_by_field:  # for each field, make sure the allocations to it are less than the demand
-        #log.info(f"Field: {field}, timestep: {cost_timestep}")
-        try:
-            field_demand = models.AgField.objects.get(liq_id=field).timesteps.get(timestep=cost_timestep).demand
-        except models.AgFieldTimestep.DoesNotExist:
-            field_demand = 0  # if we don't know the demand for the field, assume it wasn't planted and allocate 0 applied water
+        # if we don't know the demand for the field, the snapshot has it as 0 - assume it wasn't planted and allocate 0 applied water
+        field_demand = inputs.field_demand[field_positions[field]]
 
         log.info(f"Field Demand: {field_demand}")
         irrigation_efficiency_params[field] = Parameter(name=f"{field}_irrigation_efficiency", value=0.75)
         demand = float(field_demand) / irrigation_efficiency_params[field]
         demands_by_field[field] = demand
+        field_demands[field] = float(field_demand)
         constraints.append(cvxsum(vars_by_field[field]) <= demand)  # make sure it doesn't go very high - should maybe do this with the benefit function and not a constraint
         constraints.append(cvxsum(vars_by_field[field]) >= field_demand_margin * demand)  # make sure that we get close to the amount of water required. Leaving a bit of slosh to allow for data misalignments
 
+    well_positions = {well: index for index, well in enumerate(inputs.well_ids)}
     for well in vars_by_well:  # for each well, make sure the allocations it sends out are less than its capacity
-        well_obj = models.Well.objects.get(well_id=well)
-        annual_production = well_obj.annual_production(year)
+        annual_production = inputs.well_production[well_positions[well]]  # 0 if we don't have production for the year
         log.info(f"Well production: {annual_production}")
-        if annual_production is None:
-            annual_production = 0
 
         constraints.append(cvxsum(vars_by_well[well]) <= float(annual_production))  # can't overallocate the well
         constraints.append(cvxsum(vars_by_well[well]) >= well_allocation_margin * float(annual_production))  # but we also know the well produced a certain amount of water - make sure it's applied
@@ -126,9 +130,9 @@ def get_parts(cost_timestep=1,
         #    for pipe_allocation in vars_by_field[field]:
         #        constraints.append(pipe_allocation >= 0)  # don't allow any pipe to have negative values, or else the model does strange things (and we don't suck water out of fields, anyway)
 
-        # now make sure that water from the well that we know went to a specific crop gets allocated to that crop
-        if use_crop_constraints:
-            set_crop_constraints(constraints, vars_by_name, well, well_obj, single_crop_well_allocation_margin)
+    # now make sure that water from the well that we know went to a specific crop gets allocated to that crop
+    if use_crop_constraints:
+        set_crop_constraints(constraints, vars_by_name, inputs, single_crop_well_allocation_margin)
 
     return {"benefits": benefits,
             "costs": costs,
@@ -136,71 +140,120 @@ def get_parts(cost_timestep=1,
             "vars_by_well": vars_by_well,
             "vars_by_field": vars_by_field,
             "demands_by_field": demands_by_field,
-            "irrigation_efficiency_params": irrigation_efficiency_params
+            "field_demands": field_demands,
+            "irrigation_efficiency_params": irrigation_efficiency_params,
+            "pipe_variables": pipe_variables,
+            "inputs": inputs,
+            "debug_variables": debug_variables if add_debug else None,
+            "fingerprint": inputs.fingerprint(model_settings(MAX_BENEFIT_DISTANCE_METERS, use_crop_constraints, add_debug,
+                                                             well_allocation_margin, single_crop_well_allocation_margin, field_demand_margin)),
             }
 
 
-def get_sa_total(service_area_id, year=2018, cost_timestep=1):
-    sa_demands = 0
-    sa_supplies = 0
+def load_inputs(service_area=None, year=2018, cost_timestep=1, timesteps=None):
+    """
+        Loads the ModelInputs snapshot the model is built from, limiting pipes to MAX_WELLS_PER_FIELD for each field
+    :param timesteps: build_lp makes one model covering all of these timesteps (e.g. models.AgFieldTimestep.MONTHS)
+                      instead of just cost_timestep - see ModelInputs.load
+    """
+    with instrumentation.span(instrumentation.FETCH):
+        return ModelInputs.load(service_area=service_area, year=year, timestep=cost_timestep, max_wells_per_field=MAX_WELLS_PER_FIELD, timesteps=timesteps)
 
-    for field in models.AgField.objects.filter(ucm_service_area_id=service_area_id):
-        try:
-            sa_demands += field.timesteps.get(timestep=cost_timestep).demand
-        except models.AgFieldTimestep.DoesNotExist:
-            continue
 
-    for well in models.Well.objects.filter(ucm_service_area_id=service_area_id):
-        well_prod = well.annual_production(year=year)
-        if well_prod is not None:
-            sa_supplies += well_prod
+def get_sa_total(service_area_id, year=2018, cost_timestep=1, inputs=None):
+    if inputs is None:
+        inputs = load_inputs(service_area=service_area_id, year=year, cost_timestep=cost_timestep)
 
-    return {"demands": sa_demands, "supplies": float(sa_supplies)}
+    totals = inputs.service_area_totals(service_area_id)
+    return {"demands": totals["demands"], "supplies": totals["supplies"]}
 
 
-def report_sa_totals():
+def report_sa_totals(year=2018, cost_timestep=1):
+    # all of the service areas come from a couple of grouped queries - see report.service_area_totals
     all_supplies = 0
     all_demands = 0
-    for service_area in sorted(list(models.AgField.objects.values_list("ucm_service_area_id").distinct())):
-        totals = get_sa_total(service_area[0])
-        if totals["demands"] == 0:
-            totals["demands"] = 0.0001
-        ratio = totals["supplies"] / totals["demands"]
-        if ratio > 1.35:  # ranges skewed from irrigation efficiency
-            status = "Oversupply - Can't allocate"
-        elif ratio < 1:
-            status = "Undersupply - can't meet demand"
-        else:
-            status = "OK"
+    for totals in report.service_area_totals(year=year, timestep=cost_timestep):
         all_supplies += totals["supplies"]
         all_demands += totals["demands"]
-        print(f"{service_area[0]} - Supplies: {totals['supplies']}, Demands: {totals['demands']}, Ratio: {ratio}, Status: {status}")
+        print(f"{totals['service_area']} - Supplies: {totals['supplies']}, Demands: {totals['demands']}, Ratio: {totals['ratio']}, Status: {totals['status']}")
 
     print(f"Total Supply: {all_supplies}, Total Demand: {all_demands}")
 
 
-def set_crop_constraints(constraints, vars_by_name, well, well_obj, single_crop_well_allocation_margin):
-    for production in models.WellProduction.objects.filter(well=well_obj):
-        crop = production.crop
-        if crop is None:
+def set_crop_constraints(constraints, vars_by_name, inputs, single_crop_well_allocation_margin):
+    pipe_names = [inputs.pipe_variable_name(pipe_index) for pipe_index in range(inputs.num_pipes)]
+    for well_index, crop, quantity in zip(inputs.crop_production_well_index, inputs.crop_production_crop_ids, inputs.crop_production_quantity):
+        # get the variables for the pipes from the well to fields with the crop
+        pipes_for_well_and_crop = numpy.flatnonzero((inputs.pipe_well_index == well_index) & (inputs.field_crop_ids[inputs.pipe_field_index] == crop))
+        crop_variables = [vars_by_name[pipe_names[pipe_index]] for pipe_index in pipes_for_well_and_crop]
+        if len(crop_variables) == 0:  # the well doesn't connect to any fields with the crop in the model
             continue
-
-        pipes_for_well_and_crop = models.Pipe.objects.filter(well=well_obj, agfield__crop=crop)
-        # get the variables for the pipes
-        crop_variables = [vars_by_name[f"well_{well}_field_{pipe.agfield}"] for pipe in pipes_for_well_and_crop]
         # set constraints so that the
-        constraints.append(cvxsum(crop_variables) <= float(production.quantity))
-        constraints.append(cvxsum(crop_variables) >= single_crop_well_allocation_margin * float(production.quantity))
+        constraints.append(cvxsum(crop_variables) <= float(quantity))
+        constraints.append(cvxsum(crop_variables) >= single_crop_well_allocation_margin * float(quantity))
 
 
-def build_problem(service_area=None, use_crop_constraints=True, add_debug=False):
-    problem_info = get_parts(service_area=service_area, use_crop_constraints=use_crop_constraints, add_debug=add_debug)
-    problem = Problem(Maximize(cvxsum(problem_info["benefits"]) - cvxsum(problem_info["costs"])), problem_info["constraints"])
+def build_problem(service_area=None, use_crop_constraints=True, add_debug=False, inputs=None):
+    with instrumentation.span(instrumentation.BUILD):
+        problem_info = get_parts(service_area=service_area, use_crop_constraints=use_crop_constraints, add_debug=add_debug, inputs=inputs)
+        problem = Problem(Maximize(cvxsum(problem_info["benefits"]) - cvxsum(problem_info["costs"])), problem_info["constraints"])
     return problem, problem_info
 
 
-def solve_and_report(problem, problem_info):
-    problem.solve(verbose=True)
+def build_lp(service_area=None, use_crop_constraints=True, add_debug=False, inputs=None,
+             well_allocation_margin=WELL_ALLOCATION_MARGIN,
+             single_crop_well_allocation_margin=SINGLE_CROP_WELL_ALLOCATION_MARGIN,
+             field_demand_margin=FIELD_DEMAND_MARGIN):
+    """
+        Builds the same problem as build_problem, but in matrix form - a single vector of pipe allocations with
+        sparse incidence matrices for the field, well and crop constraints. See lp.AllocationLP
+    :return: AllocationLP - use .problem for the cvxpy Problem and .pipe_ids to map allocations back to pipes
+    """
+    if inputs is None:
+        inputs = load_inputs(service_area=service_area)
+
+    with instrumentation.span(instrumentation.BUILD):
+        return AllocationLP(inputs,
+                            max_benefit_distance=MAX_BENEFIT_DISTANCE_METERS,
+                            use_crop_constraints=use_crop_constraints,
+                            add_debug=add_debug,
+                            well_allocation_margin=well_allocation_margin,
+                            single_crop_well_allocation_margin=single_crop_well_allocation_margin,
+                            field_demand_margin=field_demand_margin)
+
+
+def solve_and_report(problem, problem_info, solve_cache=None, save_results=False, solver_settings=None):
+    """
+        Solves the problem from build_problem and logs the allocations for each field
+    :param solve_cache: optional solve_cache.SolveCache - if it already has this problem at the current
+                        efficiencies, the variables are filled in from the cache instead of solving
+    :param save_results: write the pipe and well allocations to the database (see writer.write_results)
+    :param solver_settings: solvers.SolverSettings for the solve - defaults to picking the solver automatically,
+                            with the solver's output shown
+    """
+    if solver_settings is None:
+        solver_settings = SolverSettings(verbose=True)
+    efficiencies = [param.value for param in problem_info["irrigation_efficiency_params"].values()]
+    solution = None
+    if solve_cache is not None:
+        key = solve_cache.key(problem_info["fingerprint"], efficiencies)
+        solution = solve_cache.get(key)
+
+    if solution is not None:
+        log.info("Using cached solve")
+        if solution.allocations is not None:
+            for variable, value in zip(problem_info["pipe_variables"], solution.allocations):
+                variable.value = value
+            for variable, value in zip(problem_info["debug_variables"] or [], solution.debug_allocations):
+                variable.value = value
+    else:
+        with instrumentation.span(instrumentation.SOLVE) as record:
+            solver_settings.solve(problem, num_variables=len(problem_info["pipe_variables"]) + len(problem_info["debug_variables"] or []))
+            instrumentation.record_solve(problem, record)
+        with instrumentation.span(instrumentation.EXTRACT):
+            solution = problem_solution(problem, problem_info)
+        if solve_cache is not None and solution.status == CACHED_STATUS:
+            solve_cache.put(key, solution)
 
     total_allocations = 0
     for variable in problem.variables():
@@ -213,15 +266,32 @@ def solve_and_report(problem, problem_info):
         allocations = problem_info["vars_by_field"][field]
         allocation_arrays = [str(round(float(val.value), 3)) for val in allocations]
         allocation_values = ", ".join(allocation_arrays)
-        demand = problem_info['demands_by_field'][field]
-        print(demand)
-        original_demand = float(str(demand).split(" / ")[0])
+        original_demand = problem_info["field_demands"][field]
         if original_demand == 0:
             continue
         log.info(f"Field {field} - evaporative demand: {original_demand:.3f}, allocations: {allocation_values}")
 
     log.info(f"Total Allocations: {total_allocations:.3f}")
 
+    if save_results:
+        write_results(problem_info["inputs"], solution)
+
+
+def problem_solution(problem, problem_info):
+    """
+        Captures a solve of the build_problem problem as a Solution, with the allocations in pipe order so that it's
+        interchangeable with AllocationLP solutions
+    """
+    allocations = problem_info["pipe_variables"]
+    debug_allocations = problem_info["debug_variables"]
+    if problem.status not in FEASIBLE_STATUSES:
+        allocations = debug_allocations = None
+    return Solution(status=problem.status,
+                    objective_value=problem.value,
+                    efficiencies=[param.value for param in problem_info["irrigation_efficiency_params"].values()],
+                    allocations=None if allocations is None else [variable.value for variable in allocations],
+                    debug_allocations=None if debug_allocations is None else [variable.value for variable in debug_allocations])
+
 
 class MonteCarloController(object):
     """
@@ -248,59 +318,190 @@ class MonteCarloController(object):
         field's irrigation type according to the error values.
     """
     service_area = None
-    fields = list()
-    field_efficiencies = dict()
     problem = None
-    problem_info = None
+    lp = None
     use_crop_constraints = True
     monte_carlo_iterations = 1000
     brute_force_combinations_threshold = 100
+    sampling_mode = sampling.UNIFORM  # or sampling.PRIOR to draw irrigation types with the crop's prior probabilities
+    sampling_chunk_size = 1000  # how many iterations of efficiencies to draw at once
+    streaming_statistics = False  # keep running effectiveness statistics and only the top_k results, rather than every iteration, so memory stays flat on long runs
+    top_k = 10
+    statistics_reservoir_size = 256  # values kept for each field x irrigation option for approximate quantiles when streaming
+    solution_memo_size = 1000  # solves to keep in memory so repeated samples skip the solver - least recently used go first
     # fallow_crop_id = None
-    null_crop_priors = list()
-    results = list()
-    best_result_objective_value = 0
-    best_result = None
     well_allocation_margin = WELL_ALLOCATION_MARGIN
     single_crop_well_allocation_margin = SINGLE_CROP_WELL_ALLOCATION_MARGIN
     field_demand_margin = FIELD_DEMAND_MARGIN
 
-    def __init__(self, service_area_id, use_crop_constraints, debug=False, random_seed='20220330'):
+    def __init__(self, service_area_id, use_crop_constraints, debug=False, random_seed='20220330', inputs=None, sampling_mode=None, solve_cache=None, streaming_statistics=None,
+                 instrumentation=None, timesteps=None, solver_settings=None):
+        """
+        :param solve_cache: optional solve_cache.SolveCache to check before solving - lets reruns with unchanged
+                            inputs skip the solver entirely
+        :param streaming_statistics: overrides the class's streaming_statistics setting when not None
+        :param instrumentation: optional instrumentation.Instrumentation to time loading, building and each
+                                iteration's solve with - run prints its summary at the end
+        :param timesteps: when loading the inputs, model all of these timesteps at once (e.g. every month with
+                          models.AgFieldTimestep.MONTHS) - each iteration's efficiencies then have to work in every
+                          timestep, still with a single solve
+        :param solver_settings: solvers.SolverSettings for every solve - defaults to picking the solver by the
+                                size of the problem
+        """
         self.service_area = service_area_id
         self.use_crop_constraints = use_crop_constraints
         self.debug = debug
         #self.fallow_crop_id = models.Crop.objects.get()
 
-        random.seed(random_seed, version=2)
-
-        irrigation_types = models.IrrigationType.objects.all()  # if we don't recognize it, use all of the irrigation type options
-        number_of_types = len(irrigation_types)
-        for irrig in irrigation_types:
-            prior = models.CropIrrigationTypePrior(
-                crop=None,
-                irrigation_type=irrig,
-                probability=1/number_of_types
-            )
-            self.null_crop_priors.append(prior)
+        if sampling_mode is not None:
+            self.sampling_mode = sampling_mode
+        if streaming_statistics is not None:
+            self.streaming_statistics = streaming_statistics
+        self.random_seed = random_seed
+        self.generator = numpy.random.default_rng(numpy.random.SeedSequence(int(random_seed)))
+        self.sampler = None
+        self.solutions_by_efficiencies = SolutionMemo(self.solution_memo_size)  # memo of solves in this run, so repeated samples don't need to be solved again
+        self.solver_calls = 0
+        self.brute_forced = False
+        self.solve_cache = solve_cache
+        self.results = None  # ResultStore for the latest run - None when streaming
+        self.effectiveness = None  # EffectivenessStatistics for the latest run when streaming
+        self.top_results = None  # TopResults for the latest run when streaming
+        self.instrumentation = instrumentation
+        self.solver_settings = SolverSettings() if solver_settings is None else solver_settings
+
+        with activate_instrumentation(self.instrumentation):
+            # everything after this point reads from the snapshot rather than the database
+            if inputs is None:
+                inputs = load_inputs(service_area=self.service_area, timesteps=timesteps)
+            self.inputs = inputs
+
+            irrigation_types = self.inputs.irrigation_types  # if we don't recognize it, use all of the irrigation type options
+            number_of_types = len(irrigation_types)
+            self.null_crop_priors = [(irrig["id"], 1/number_of_types) for irrig in irrigation_types]
+
+            self.build()
 
-        self.build()
+    @property
+    def lp_settings(self):
+        return {"use_crop_constraints": self.use_crop_constraints,
+                "add_debug": self.debug,
+                "well_allocation_margin": self.well_allocation_margin,
+                "single_crop_well_allocation_margin": self.single_crop_well_allocation_margin,
+                "field_demand_margin": self.field_demand_margin}
 
     def build(self):
-        self.problem, self.problem_info = build_problem(self.service_area, use_crop_constraints=self.use_crop_constraints, add_debug=self.debug)
+        self.lp = build_lp(inputs=self.inputs, **self.lp_settings)
+        self.problem = self.lp.problem
+
+    def run(self, iterations=None, workers=None):
+        """
+            If the number of combinations of irrigation options across the model's fields is at or below
+            brute_force_combinations_threshold, solves every combination once instead of sampling.
+        :param iterations: number of Monte Carlo iterations - defaults to monte_carlo_iterations
+        :param workers: when more than 1, splits the iterations across this many worker processes. Each worker
+                        builds its own problem from the input snapshot and samples from its own child of the
+                        random seed's SeedSequence, so results are reproducible for a given seed and worker count.
+                        Solves in the workers aren't instrumented - only the time to merge their results is
+        """
+        with activate_instrumentation(self.instrumentation):
+            self._run(iterations, workers)
+
+        print("Complete")
+        if self.instrumentation is not None:
+            print(self.instrumentation.summary_table())
 
-    def run(self, iterations=None):
+    def _run(self, iterations, workers):
         if iterations is None:
             iterations = self.monte_carlo_iterations
 
         self.efficiency_information = self.get_combinations()
-        for iteration in range(iterations):
-            if iteration % 250 == 0:
-                print(iteration)
-            self.run_iteration(efficiency_information=self.efficiency_information)
+        self.sampler = None  # the options may have changed, but keep drawing from the same random stream
+        self.solutions_by_efficiencies = SolutionMemo(self.solution_memo_size)
+        num_combinations = self.get_sampler(self.efficiency_information).num_combinations
+        self.brute_forced = num_combinations <= self.brute_force_combinations_threshold
+        if self.streaming_statistics:
+            self.results = None
+            self.effectiveness = EffectivenessStatistics(self.lp.field_ids, self.sampler.options, self.sampler.option_counts,
+                                                         reservoir_size=self.statistics_reservoir_size,
+                                                         generator=numpy.random.default_rng([int(self.random_seed), 1]))  # separate from the sampling stream
+            self.top_results = TopResults(self.top_k)
+        else:
+            self.results = ResultStore(self.lp, capacity=num_combinations if self.brute_forced else iterations)
+        if len(self.lp.field_ids) == 0:
+            # none of the service area's fields have pipes, so there's nothing to allocate - record no iterations
+            log.info(f"No fields with pipes in service area {self.service_area}, so there's nothing to run")
+            return
+        if self.brute_forced:
+            log.info(f"Brute forcing all {num_combinations} irrigation combinations")
+            indexes, efficiencies = self.sampler.all_combinations()
+            for iteration_efficiencies in efficiencies:
+                self.run_iteration(efficiency_information=self.efficiency_information, efficiencies=iteration_efficiencies)
+        elif workers is not None and workers > 1:
+            self.run_parallel(iterations, workers)
+        else:
+            # draw the efficiencies for a block of iterations at a time rather than field by field in each iteration
+            iteration = 0
+            for indexes, efficiencies in self.get_sampler(self.efficiency_information).chunks(iterations):
+                for iteration_efficiencies in efficiencies:
+                    if iteration % 250 == 0:
+                        print(iteration)
+                    self.run_iteration(efficiency_information=self.efficiency_information, efficiencies=iteration_efficiencies)
+                    iteration += 1
+
+    def get_sampler(self, efficiency_information):
+        if self.sampler is None:
+            self.sampler = EfficiencySampler.for_fields(efficiency_information, self.lp.field_ids, **self.sampler_settings, generator=self.generator)
+        return self.sampler
 
-        print("Complete")
+    @property
+    def sampler_settings(self):
+        return {"mode": self.sampling_mode, "chunk_size": self.sampling_chunk_size}
+
+    def run_parallel(self, iterations, workers):
+        seed_sequences = numpy.random.SeedSequence(int(self.random_seed)).spawn(workers)
+        worker_iterations = [len(chunk) for chunk in numpy.array_split(numpy.arange(iterations), workers)]
+        sampler_arguments = {
+            "efficiencies": [self.efficiency_information[field]["efficiencies"] for field in self.lp.field_ids],
+            "probabilities": [self.efficiency_information[field]["probabilities"] for field in self.lp.field_ids],
+            **self.sampler_settings,
+        }
+
+        # when streaming, each worker keeps its own statistics and top results and sends back just those
+        statistics_arguments = {"reservoir_size": self.statistics_reservoir_size, "top_k": self.top_k} if self.streaming_statistics else None
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=setup_worker_process) as executor:
+            futures = [executor.submit(_monte_carlo_worker, self.inputs, self.lp_settings, sampler_arguments, num_iterations, seed_sequence, self.solve_cache, self.solver_settings,
+                                       self.solution_memo_size, statistics_arguments)
+                        for num_iterations, seed_sequence in zip(worker_iterations, seed_sequences) if num_iterations > 0]
+
+            # merge in worker order rather than as they finish so the results are always in the same order
+            for future in futures:
+                solutions, solver_calls = future.result()
+                self.solver_calls += solver_calls
+                if self.streaming_statistics:
+                    effectiveness, top_results = solutions
+                    with instrumentation.span(instrumentation.RECORD):
+                        self.effectiveness.merge(effectiveness)
+                        self.top_results.merge(top_results)
+                    continue
+                for solution in solutions:
+                    self.record_result(solution, self.efficiency_information)
 
     def view_results(self, field_id):
         irrigation_options = self.efficiency_information[field_id]["irrigation"]
+        if self.streaming_statistics:
+            # we don't have the values for a regular boxplot, so draw it from the running statistics
+            box_stats = []
+            for irrig_type, summary in zip(irrigation_options, self.effectiveness.summary(field_id)):
+                print(f"{irrig_type['name']}: {summary['mean']}")
+                if summary["count"] > 0:
+                    box_stats.append({"label": irrig_type["name"], "med": summary["quantiles"][0.5], "q1": summary["quantiles"][0.25],
+                                      "q3": summary["quantiles"][0.75], "whislo": summary["min"], "whishi": summary["max"]})
+            plt.gca().bxp(box_stats, showfliers=False)
+            plt.show()
+            return
+
         effectivenesses = [item["effectiveness"] for item in irrigation_options]
 
         for irrig_type in irrigation_options:
@@ -311,20 +512,18 @@ class MonteCarloController(object):
         plt.show()
 
     def get_combinations(self):
-        fields = models.AgField.objects.filter(ucm_service_area_id=self.service_area)
-        irrigation_nums = []
         field_irrigation_options = {}
+        irrigation_types = {irrig["id"]: irrig for irrig in self.inputs.irrigation_types}
 
         # we don't technically need to collapse this into a custom object here, but I think it might help to
         # avoid random hits to the DB later on.
-        for field in fields:
+        for field, crop_id in zip(self.inputs.field_ids, self.inputs.field_crop_ids):
             use_defaults = False  # use a flag, because we need to use the null crop priors if the crop is unknown or if we don't have priors for the crop
-            if field.crop is not None:  # if we recognize the field's crop, use the known irrigation options
-                priors = field.crop.irrigation_priors.all()
+            if crop_id != NO_CROP:  # if we recognize the field's crop, use the known irrigation options
+                priors = self.inputs.irrigation_priors.get(crop_id, [])
                 if len(priors) > 0:
-                    crop_name = field.crop.vw_crop_name
-                    crop_id = field.crop_id
-                    irrigation_nums.append(len(priors))
+                    crop_name = self.inputs.crop_names[crop_id]
+                    crop_id = int(crop_id)
                 else:
                     use_defaults = True
             else:
@@ -334,144 +533,229 @@ class MonteCarloController(object):
                 priors = self.null_crop_priors
                 crop_name = "Unknown"
                 crop_id = -1
-                irrigation_nums.append(len(self.null_crop_priors))
 
-            field_irrigation_options[field.liq_id] = {
-                'liq_id': field.liq_id,
+            field_irrigation_options[field] = {
+                'liq_id': field,
                 'crop_name': crop_name,
                 'crop_id': crop_id,
                 'irrigation': [{
-                    'irrigation_id': prior.irrigation_type.id,
+                    'irrigation_id': irrigation_id,
                     #'prior_id': prior.id,
-                    'name': prior.irrigation_type.name,
-                    'efficiency': prior.irrigation_type.efficiency,
-                    'probability': prior.probability,
+                    'name': irrigation_types[irrigation_id]["name"],
+                    'efficiency': irrigation_types[irrigation_id]["efficiency"],
+                    'probability': probability,
                     "effectiveness": []  # how good did the full model fit after running it - this will be appended to after each model run, and we'll use it for one big bayesian update
-                } for prior in priors],
+                } for irrigation_id, probability in priors],
             }
 
-            # we'll want to use numpy.random.choice, and for that we need lists of the efficiencies to choose and their individual probabilities - cache these so
+            # we'll want to use the EfficiencySampler, and for that we need lists of the efficiencies to choose and their individual probabilities - cache these so
             # that we don't run the list comprehension every time. Though we'll need to update the list of probabilities when we do Bayesian updates
-            field_irrigation_options[field.liq_id]["efficiencies"] = [float(item["efficiency"]) for item in field_irrigation_options[field.liq_id]["irrigation"]]
-            field_irrigation_options[field.liq_id]["probabilities"] = [float(item["probability"]) for item in field_irrigation_options[field.liq_id]["irrigation"]]
+            field_irrigation_options[field]["efficiencies"] = [float(item["efficiency"]) for item in field_irrigation_options[field]["irrigation"]]
+            field_irrigation_options[field]["probabilities"] = [float(item["probability"]) for item in field_irrigation_options[field]["irrigation"]]
 
         return field_irrigation_options
-        #num_combinations = math.prod(irrigation_nums)
-        #if num_combinations > self.brute_force_combinations_threshold:
-        #    return None
-        #else:
-        #    return
-
-    def run_iteration(self, efficiency_information):
-        # for each iteration, set new irrigation efficiencies for each field by choosing from the available options
-        # based on their probability
-        for field in self.problem_info["irrigation_efficiency_params"]:
-            field_param = self.problem_info["irrigation_efficiency_params"][field]
-            field_options = efficiency_information[field]
-
-            # I don't actually think we should get the value based on the prior probability since it might bias the sample
-            # - we likely would want a true random sample of the efficiency options and to then go from there. But does
-            # that then make our prior probability almost moot?
-            field_param.value = numpy.random.choice(field_options["efficiencies"], replace=True)
-
-        self.problem.solve()
+
+    def run_iteration(self, efficiency_information, efficiencies=None):
+        # for each iteration, set new irrigation efficiencies for each field by choosing from the available options.
+        # run() draws these in blocks and passes them in - otherwise draw a single iteration here
+
+        # I don't actually think we should get the value based on the prior probability since it might bias the sample
+        # - we likely would want a true random sample of the efficiency options and to then go from there. But does
+        # that then make our prior probability almost moot? sampling_mode chooses between the two.
+        if efficiencies is None:
+            efficiencies = self.get_sampler(efficiency_information).draw(1)[0]
+
+        # if we've already solved this combination during the run, reuse its result rather than solving it again
+        key = SolutionMemo.key(efficiencies)
+        solution = self.solutions_by_efficiencies.get(key)
+        if solution is None:
+            self.lp.set_efficiencies(efficiencies)
+            # only the parameter values changed, so this reuses the compiled problem and warm starts - or skips the solve if it's cached on disk
+            solution, solved = cached_solve(self.lp, self.solve_cache, self.solver_settings)
+            self.solver_calls += int(solved)
+            self.solutions_by_efficiencies.put(key, solution)
         #self.update_results(efficiency_information)
 
+        self.record_result(solution, efficiency_information)
+
+    @property
+    def best_result(self):
+        """
+            ServiceAreaResult for the feasible iteration with the highest objective value, or None
+        """
+        if self.streaming_statistics:
+            if self.top_results is None or len(self.top_results) == 0:
+                return None
+            return self.top_results.as_store(self.lp).result(0)
+
+        if self.results is None or self.results.best_index is None:
+            return None
+        return self.results.result(self.results.best_index)
+
+    @property
+    def best_solution(self):
+        """
+            Solution for the best iteration, or None
+        """
+        if self.streaming_statistics:
+            return None if self.top_results is None or len(self.top_results) == 0 else self.top_results.solutions()[0]
+        if self.results is None or self.results.best_index is None:
+            return None
+        return self.results.solution(self.results.best_index)
+
+    def irrigation_probabilities(self):
+        """
+            Updates each field's prior probabilities for its irrigation types with how often each type led to a
+            feasible model. With uniform sampling (or brute forcing) that's prior x the share of the iterations with
+            the type that were feasible. With prior sampling, the types were already drawn in proportion to the
+            prior, so it's just the type's share of the feasible iterations. Fields keep their priors if nothing
+            was feasible.
+        :return: {liq_id: [(irrigation_type_id, probability), ...]} for the model's fields
+        """
+        options = self.sampler.options
+        if self.streaming_statistics:
+            drawn = self.effectiveness.drawn
+            feasible = self.effectiveness.feasible
+        else:
+            size = len(self.results)
+            indexes = self.sampler.option_indexes(self.results.efficiencies[:size])
+            feasible_rows = self.results.feasible[:size]
+            rows = numpy.broadcast_to(numpy.arange(options.shape[0]), indexes.shape)
+            drawn = numpy.zeros(options.shape, dtype=numpy.int64)
+            feasible = numpy.zeros(options.shape, dtype=numpy.int64)
+            numpy.add.at(drawn, (rows, indexes), 1)
+            numpy.add.at(feasible, (rows[feasible_rows], indexes[feasible_rows]), 1)
+
+        probabilities = {}
+        for row, field in enumerate(self.lp.field_ids):
+            irrigation_options = self.efficiency_information[field]["irrigation"]
+            priors = numpy.array(self.efficiency_information[field]["probabilities"], dtype=numpy.float64)
+            priors = priors / priors.sum()
+            field_drawn = drawn[row, :len(priors)]
+            field_feasible = feasible[row, :len(priors)].astype(numpy.float64)
+            if self.sampling_mode == sampling.PRIOR and not self.brute_forced:
+                posterior = field_feasible
+            else:
+                posterior = priors * numpy.divide(field_feasible, field_drawn, out=numpy.zeros(len(priors)), where=field_drawn > 0)
+            posterior = posterior / posterior.sum() if posterior.sum() > 0 else priors
+            probabilities[field] = [(item["irrigation_id"], float(probability)) for item, probability in zip(irrigation_options, posterior)]
+        return probabilities
+
+    def save_results(self, batch_size=None):
+        """
+            Writes the best iteration's pipe and well allocations and each field's irrigation type probabilities to
+            the database in bulk
+        """
+        kwargs = {} if batch_size is None else {"batch_size": batch_size}
+        return write_results(self.inputs, self.best_solution, self.irrigation_probabilities(), **kwargs)
+
+    @property
+    def feasible_iterations(self):
+        if self.streaming_statistics:
+            return 0 if self.effectiveness is None else self.effectiveness.feasible_iterations
+        return 0 if self.results is None else self.results.num_feasible
+
+    def mean_effectiveness(self, field):
+        """
+            Mean effectiveness of each of the field's irrigation options by name - None for options no feasible
+            iteration used
+        """
+        irrigation_options = self.efficiency_information[field]["irrigation"]
+        if self.streaming_statistics:
+            return {item["name"]: summary["mean"] for item, summary in zip(irrigation_options, self.effectiveness.summary(field))}
+        return {item["name"]: float(numpy.mean(item["effectiveness"])) if len(item["effectiveness"]) > 0 else None
+                for item in irrigation_options}
+
+    @property
+    def best_result_objective_value(self):
+        best = self.best_result
+        return 0 if best is None else best.objective_value
+
+    def record_result(self, solution, efficiency_information):
         log.info("Solved, processing results")
-        results = ServiceAreaResult(self.problem, self.problem_info, efficiency_information)
-        if results.objective_value is not False:
-            if results.objective_value > self.best_result_objective_value:
-                self.best_result_objective_value = results.objective_value
-                self.best_result = results
-            self.results.append(results)
+        with instrumentation.span(instrumentation.RECORD):
+            self._record_result(solution, efficiency_information)
 
-    def update_results(self, efficiency_information):
+    def _record_result(self, solution, efficiency_information):
+        if self.streaming_statistics:
+            self.effectiveness.add(solution)
+            self.top_results.add(solution)
+            return
+
+        self.results.add(solution)
+        if not solution.feasible:
+            return
 
-        for field in self.problem_info["irrigation_efficiency_params"]:
-            field_param = self.problem_info["irrigation_efficiency_params"][field]
+        for field, efficiency in zip(self.lp.field_ids, solution.efficiencies):
             field_info = efficiency_information[field]
-            irrigation_type = next((item for item in field_info["irrigation"] if math.isclose(item["efficiency"], field_param.value)), None)
+            irrigation_type = next((item for item in field_info["irrigation"] if math.isclose(item["efficiency"], efficiency)), None)
 
             # what we'll actually want to do here is to see *how* effective it was, not just a binary yes/no based
             # on whether it was feasible or not
-            if self.problem.status in ["infeasible", "unbounded"]:
-                irrigation_type["effectiveness"].append(0)
-            else:
-                irrigation_type["effectiveness"].append(self.problem.value)
-
+            irrigation_type["effectiveness"].append(solution.objective_value)
 
-class ServiceAreaResult(object):
-    # stores the individual field level results for all fields in the SA for a single run
-    results = dict()  # just a dict of results by each field
-    objective_value = None  # objective value for the whole SA
-
-    def __init__(self, problem, problem_info, efficiency_information):
-        if problem.status in ["infeasible", "unbounded"]:
-            self.objective_value = False
-            return
-        else:
-            self.objective_value = problem.value
+    def update_results(self, efficiency_information):
 
-        for field in problem_info["irrigation_efficiency_params"]:
-            field_param = problem_info["irrigation_efficiency_params"][field]
+        for field, efficiency in zip(self.lp.field_ids, self.lp.efficiencies):
             field_info = efficiency_information[field]
-            irrigation_type = next((item for item in field_info["irrigation"] if math.isclose(item["efficiency"], field_param.value)), None)
+            irrigation_type = next((item for item in field_info["irrigation"] if math.isclose(item["efficiency"], efficiency)), None)
 
             # what we'll actually want to do here is to see *how* effective it was, not just a binary yes/no based
             # on whether it was feasible or not
-            if problem.status in ["infeasible", "unbounded"]:
+            if self.problem.status not in FEASIBLE_STATUSES:
                 irrigation_type["effectiveness"].append(0)
             else:
-                irrigation_type["effectiveness"].append(problem.value)
-
-        self.field_level_results(problem_info, efficiency_information)
-
-    def dump_csvs(self, field_results_path):
-        with open(field_results_path, 'wb') as fh:
-            writer = csv.DictWriter(fh, fieldnames=self.results[0].result_dict.keys())
-            writer.writeheader()
-            for field in self.results:
-                writer.writerow(field.result_dict)
-
-    def field_level_results(self, problem_info, efficiency_information):
-        for field in problem_info["vars_by_field"]:
-            # ignore1, well, ignore2, field = variable.name().split("_")
-            allocations = problem_info["vars_by_field"][field]
-            allocation_arrays = [str(round(float(val.value), 3)) for val in allocations if val.value is not None]
-            allocation_values = ", ".join(allocation_arrays)
-            demand = problem_info['demands_by_field'][field]
-            print(demand)
-            original_demand = float(str(demand).split(" / ")[0])
-            if original_demand == 0:
-                continue
-            log.info(f"Field {field} - evaporative demand: {original_demand:.3f}, allocations: {allocation_values}")
-
-            self.results[field] = FieldResult(field, self, allocations, demand, problem_info["irrigation_efficiency_params"][field].value)
-
-
-class FieldResult(object):
-    field = None
-    # field - reference to Django object? or just the ID?
-    irrigation_efficiency_value = None
-    irrigation_type = None
-    allocations = list()
-    net_water_demand = None  # net water demand - water demand remaining after allocation
-    service_area_result = None
-
-    def __init__(self, field, service_area_result, allocations, demand, irrigation_efficiency):
-        self.field = field
-        self.service_area_result = service_area_result
-        self.allocations = [float(item.value) for item in allocations if item.value is not None]
-        self.net_water_demand = demand - sum(self.allocations)
-        self.irrigation_efficiency_value = irrigation_efficiency
+                irrigation_type["effectiveness"].append(self.problem.value)
 
-    @property
-    def total_allocations(self):
-        return sum(self.allocations)
 
-    @property
-    def result_dict(self):
-        return {'field': self.field, 'allocation': self.total_allocations, 'efficiency': self.irrigation_efficiency_value, 'available_water': self.total_allocations * self.irrigation_efficiency_value, 'excess_demand': self.net_water_demand}
+def setup_worker_process():
+    # worker processes only use the input snapshot, but unpickling it imports the models, so make sure Django's
+    # app registry is ready in case the process was spawned rather than forked
+    import django
+    django.setup()
+
+
+def _monte_carlo_worker(inputs, lp_settings, sampler_arguments, iterations, seed_sequence, solve_cache=None, solver_settings=None, memo_size=1000,
+                        statistics_arguments=None):
+    """
+        Runs a share of the Monte Carlo iterations in a worker process. Builds the problem once from the snapshot
+        and returns a Solution for each iteration - or, for a streaming run, its own summary of them
+    :param sampler_arguments: arguments for the EfficiencySampler, with the options for the model's fields in field order
+    :param solve_cache: optional SolveCache - the worker opens its own connection to it
+    :param solver_settings: optional solvers.SolverSettings for the solves
+    :param memo_size: number of solves to keep in memory for repeated samples (see SolutionMemo)
+    :param statistics_arguments: for streaming runs, {"reservoir_size": ..., "top_k": ...} - the worker folds each
+                                 solution into an EffectivenessStatistics and TopResults instead of keeping it
+    :return: (list of Solutions, or (EffectivenessStatistics, TopResults) when streaming, number of times the solver ran)
+    """
+    lp = build_lp(inputs=inputs, **lp_settings)
+    sampler = EfficiencySampler(generator=numpy.random.default_rng(seed_sequence), **sampler_arguments)
+    if statistics_arguments is None:
+        solutions = []
+        record = solutions.append
+    else:
+        effectiveness = EffectivenessStatistics(lp.field_ids, sampler.options, sampler.option_counts, reservoir_size=statistics_arguments["reservoir_size"],
+                                                generator=numpy.random.default_rng(seed_sequence.spawn(1)[0]))  # separate from the sampling stream
+        top_results = TopResults(statistics_arguments["top_k"])
+        solutions = (effectiveness, top_results)
+
+        def record(solution):
+            effectiveness.add(solution)
+            top_results.add(solution)
+
+    solver_calls = 0
+    solutions_by_efficiencies = SolutionMemo(memo_size)  # repeated samples reuse the earlier solve, same as the serial run
+    for indexes, efficiencies in sampler.chunks(iterations):
+        for iteration_efficiencies in efficiencies:
+            key = SolutionMemo.key(iteration_efficiencies)
+            solution = solutions_by_efficiencies.get(key)
+            if solution is None:
+                lp.set_efficiencies(iteration_efficiencies)
+                solution, solved = cached_solve(lp, solve_cache, solver_settings)
+                solver_calls += int(solved)
+                solutions_by_efficiencies.put(key, solution)
+            record(solution)
+    return solutions, solver_calls
 
 
 """
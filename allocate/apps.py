@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class AllocateConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'allocate'
+
+    def ready(self):
+        from . import production  # connects the signals that drop the cached production cube when production changes
+        from . import sqlite  # sets the SQLite pragmas on new connections
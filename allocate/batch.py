@@ -0,0 +1,151 @@
+"""
+    Runs the Monte Carlo for every service area in the valley, spreading the service areas across a pool of worker
+    processes. Service areas are independent models, so each one runs start to finish in a single worker.
+"""
+
+import csv
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.db.models import Count
+
+from . import allocation, models
+from .solve_cache import SolveCache
+from .writer import write_results
+
+log = logging.getLogger(__name__)
+
+
+def service_areas_by_size(service_areas=None):
+    """
+        Service area ids with their pipe counts, largest first - scheduling the big areas first keeps one big area
+        from holding up the end of the run after the other workers have finished
+    :param service_areas: optional list of service areas to limit it to
+    :return: list of (service_area_id, pipe_count)
+    """
+    pipe_counts = dict(models.Pipe.objects.values("agfield__ucm_service_area_id").annotate(pipes=Count("id")).values_list("agfield__ucm_service_area_id", "pipes"))
+    all_service_areas = models.AgField.objects.values_list("ucm_service_area_id", flat=True).distinct()
+    if service_areas is not None:
+        all_service_areas = [service_area for service_area in all_service_areas if service_area in service_areas]
+
+    sizes = [(service_area, pipe_counts.get(service_area, 0)) for service_area in all_service_areas]
+    return sorted(sizes, key=lambda size: (-size[1], size[0]))
+
+
+def run_service_area(inputs, use_crop_constraints=True, iterations=None, random_seed='20220330', solve_cache=None, include_best_solution=False, solver_settings=None):
+    """
+        Runs the Monte Carlo for one service area from its snapshot and summarizes the results. Doesn't touch the
+        database, so it can run in a worker process
+    :param solve_cache: optional SolveCache to check before each solve
+    :param include_best_solution: add the best iteration's Solution as "best_solution" so the caller can write it
+                                  to the database - it needs to be removed before writing the dict out as JSON
+    :param solver_settings: optional solvers.SolverSettings for the solves
+    :return: dict that can be written out as JSON
+    """
+    start = time.perf_counter()
+    # we only write out summaries, so there's no need to keep every iteration around
+    controller = allocation.MonteCarloController(inputs.service_area, use_crop_constraints, random_seed=random_seed, inputs=inputs, solve_cache=solve_cache, streaming_statistics=True,
+                                                 solver_settings=solver_settings)
+    build_seconds = time.perf_counter() - start
+    controller.run(iterations=iterations)
+    run_seconds = time.perf_counter() - start - build_seconds
+
+    probabilities = controller.irrigation_probabilities()
+    fields = {}
+    best_solution = controller.best_solution  # its efficiencies cover every field, including ones without any demand to record results for
+    for row, field in enumerate(controller.lp.field_ids):
+        field_info = controller.efficiency_information[field]
+        fields[field] = {
+            "crop_name": field_info["crop_name"],
+            "best_efficiency": None if best_solution is None else float(best_solution.efficiencies[row]),
+            "mean_effectiveness": controller.mean_effectiveness(field),
+            "irrigation_probabilities": {irrigation_id: probability for irrigation_id, probability in probabilities[field]},
+        }
+
+    result = {
+        "service_area": inputs.service_area,
+        "fields": int(inputs.num_fields),
+        "pipes": int(inputs.num_pipes),
+        "iterations": iterations,
+        "feasible_iterations": controller.feasible_iterations,
+        "brute_forced": controller.brute_forced,
+        "solver_calls": controller.solver_calls,
+        "best_objective_value": None if controller.best_result is None else float(controller.best_result_objective_value),
+        "build_seconds": build_seconds,
+        "run_seconds": run_seconds,
+        "field_results": fields,
+    }
+    if include_best_solution:
+        result["best_solution"] = controller.best_solution
+    return result
+
+
+def run_all_service_areas(output_folder, workers=None, iterations=None, use_crop_constraints=True, service_areas=None, random_seed='20220330', solve_cache_path=None, save_results=False,
+                          solver_settings=None):
+    """
+        Runs every service area and writes each one's results as soon as it finishes - a line in results.jsonl
+        with the full results and a row in timings.csv
+    :param output_folder: folder to write results.jsonl and timings.csv to
+    :param workers: number of worker processes - defaults to the number of cores
+    :param iterations: Monte Carlo iterations for each service area - defaults to MonteCarloController.monte_carlo_iterations
+    :param service_areas: optional list of service area ids to run instead of all of them
+    :param solve_cache_path: optional SQLite file for a SolveCache shared by the workers - service areas whose
+                             inputs haven't changed since an earlier run are read from it instead of solved
+    :param save_results: write each service area's best allocations and irrigation probabilities to the database
+                         as it finishes - the workers don't write, so there's only ever one writer
+    :param solver_settings: optional solvers.SolverSettings for the solves - by default each service area's
+                            solver is picked by its size
+    :return: number of service areas run - areas without any pipes are skipped, and areas that fail are logged
+             and left out of the results rather than stopping the run
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    if iterations is None:
+        iterations = allocation.MonteCarloController.monte_carlo_iterations
+    os.makedirs(output_folder, exist_ok=True)
+    solve_cache = None if solve_cache_path is None else SolveCache(solve_cache_path)
+
+    start = time.perf_counter()
+    schedule = service_areas_by_size(service_areas)
+    empty = [service_area for service_area, pipe_count in schedule if pipe_count == 0]
+    if len(empty) > 0:
+        log.info(f"Skipping {len(empty)} service areas without any pipes: {', '.join(map(str, empty))}")
+    schedule = [(service_area, pipe_count) for service_area, pipe_count in schedule if pipe_count > 0]
+    valley_inputs = allocation.load_inputs()  # one snapshot for the whole valley, then cut it up by service area
+    log.info(f"Loaded inputs for {len(schedule)} service areas in {time.perf_counter() - start:.1f} seconds")
+
+    with open(os.path.join(output_folder, "results.jsonl"), 'w') as results_file, \
+            open(os.path.join(output_folder, "timings.csv"), 'w', newline='') as timings_file:
+        timings = csv.DictWriter(timings_file, fieldnames=["service_area", "fields", "pipes", "iterations", "feasible_iterations", "brute_forced", "solver_calls", "build_seconds", "run_seconds"], extrasaction="ignore")
+        timings.writeheader()
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=allocation.setup_worker_process) as executor:
+            futures = {}
+            for service_area, pipe_count in schedule:
+                inputs = valley_inputs.for_service_area(service_area)
+                futures[executor.submit(run_service_area, inputs, use_crop_constraints, iterations, random_seed, solve_cache, save_results, solver_settings)] = inputs
+
+            completed = 0
+            failed = 0
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception:
+                    failed += 1
+                    log.exception(f"Service area {futures[future].service_area} failed")
+                    continue
+                completed += 1
+                if save_results:
+                    write_results(futures[future], result.pop("best_solution"),
+                                  {field: list(field_result["irrigation_probabilities"].items()) for field, field_result in result["field_results"].items()})
+                results_file.write(json.dumps(result) + "\n")
+                results_file.flush()
+                timings.writerow(result)
+                timings_file.flush()
+                log.info(f"{completed + failed}/{len(futures)} {result['service_area']}: {result['pipes']} pipes in {result['run_seconds']:.1f} seconds")
+
+    log.info(f"Ran {completed} service areas in {time.perf_counter() - start:.1f} seconds" + (f" - {failed} failed" if failed > 0 else ""))
+    return completed
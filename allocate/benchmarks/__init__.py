@@ -0,0 +1,4 @@
+"""
+    Benchmarks for the allocation model - each module has a run(**options) function that returns a dict of results
+    and can be run with `python manage.py benchmark <name>`
+"""
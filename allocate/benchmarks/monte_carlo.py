@@ -0,0 +1,68 @@
+"""
+    Per-iteration Monte Carlo time for the original per-pipe problem, where the irrigation efficiency is a Parameter
+    in the denominator of the demand (not DPP, so every solve canonicalizes the whole problem again), against the
+    matrix form with an inverse efficiency Parameter that's compiled once and warm started.
+"""
+
+import logging
+import time
+
+import numpy
+
+from allocate import allocation
+from allocate.synthetic import synthetic_inputs
+
+
+def run(fields=200, iterations=50, seed=20220330, **kwargs):
+    inputs = synthetic_inputs(num_fields=fields, seed=seed)
+    rng = numpy.random.default_rng(seed)
+
+    allocation_log = logging.getLogger(allocation.__name__)
+    log_level = allocation_log.level
+    allocation_log.setLevel(logging.WARNING)  # the per field logging in get_parts would otherwise swamp the timings
+    try:
+        problem, problem_info = allocation.build_problem(inputs=inputs)
+        lp = allocation.build_lp(inputs=inputs)
+    finally:
+        allocation_log.setLevel(log_level)
+
+    options = [[0.7, 0.86, 0.81] for _ in lp.field_ids]
+    samples = [[rng.choice(field_options) for field_options in options] for _ in range(iterations + 1)]
+
+    def per_parameter_iteration(efficiencies):
+        for field, efficiency in zip(lp.field_ids, efficiencies):
+            problem_info["irrigation_efficiency_params"][field].value = efficiency
+        problem.solve()
+        return problem.value
+
+    def matrix_iteration(efficiencies):
+        lp.set_efficiencies(efficiencies)
+        lp.solve()
+        return lp.problem.value
+
+    results = {"fields": fields, "pipes": int(inputs.num_pipes), "iterations": iterations}
+    for name, iteration, problem_to_check in (("before", per_parameter_iteration, problem), ("after", matrix_iteration, lp.problem)):
+        start = time.perf_counter()
+        iteration(samples[0])  # the first solve includes compiling the problem in both cases
+        first_solve = time.perf_counter() - start
+
+        objective_values = []
+        start = time.perf_counter()
+        for efficiencies in samples[1:]:
+            objective_values.append(iteration(efficiencies))
+        elapsed = time.perf_counter() - start
+
+        results[name] = {
+            "dpp": problem_to_check.is_dpp(),
+            "first_solve_seconds": first_solve,
+            "per_iteration_seconds": elapsed / iterations,
+            "objective_values": objective_values,
+        }
+
+    before_values = numpy.array(results["before"].pop("objective_values"), dtype=numpy.float64)
+    after_values = numpy.array(results["after"].pop("objective_values"), dtype=numpy.float64)
+    solved = numpy.isfinite(before_values) & numpy.isfinite(after_values)
+    results["solved_iterations"] = int(solved.sum())
+    results["max_objective_difference"] = float(numpy.abs(before_values - after_values)[solved].max()) if solved.any() else None
+    results["speedup"] = results["before"]["per_iteration_seconds"] / results["after"]["per_iteration_seconds"]
+    return results
@@ -0,0 +1,90 @@
+"""
+    Query counts and SQLite query plans for the queries every model run makes - loading a service area's inputs
+    and the service area report. Each hot query's EXPLAIN QUERY PLAN is checked for full table scans, so if an
+    index stops being used (or a query changes so it can't use one), it shows up here and in the tests rather than
+    as a slow run over the whole valley.
+"""
+
+import re
+import time
+
+from django.db import connection
+from django.db.models import Count, Q, Sum
+from django.test.utils import CaptureQueriesContext
+
+from allocate import models, report
+from allocate.inputs import ModelInputs
+
+
+def busiest_service_area():
+    """
+        The service area with the most pipes - the default for the benchmarks that run against the loaded data
+    """
+    return models.Pipe.objects.values("agfield__ucm_service_area_id").annotate(pipes=Count("id")).order_by("-pipes").values_list("agfield__ucm_service_area_id", flat=True).first()
+
+
+def hot_queries(service_area, year=2018, timestep=1):
+    """
+        The querysets ModelInputs.load and the production cube run for a service area
+    :return: {name: queryset}
+    """
+    fields = models.AgField.objects.filter(ucm_service_area_id=service_area)
+    wells = models.Well.objects.filter(Q(ucm_service_area_id=service_area) | Q(id__in=models.Pipe.objects.filter(agfield__in=fields).values("well_id")))
+    return {
+        "fields": fields.order_by("id").values_list("id", "liq_id", "crop_id", "ucm_service_area_id"),
+        "field_demand": models.AgFieldTimestep.objects.filter(agfield__in=fields, timestep=timestep).with_demand().values_list("agfield_id", "demand_acre_feet"),
+        "pipes": models.Pipe.objects.filter(agfield__in=fields).order_by("agfield_id", "distance", "id").values_list("id", "well_id", "agfield_id", "distance", "variable_name"),
+        "wells": wells.order_by("id").values_list("id", "well_id", "ucm_service_area_id"),
+        "production": models.WellProduction.objects.filter(well__in=wells, year__in=[year]).order_by().values_list("well_id", "year", "month", "semi_year").annotate(total=Sum("quantity"), count=Count("id")),
+        "crop_production": models.WellProduction.objects.filter(well__in=wells, crop__isnull=False).order_by("id").values_list("well_id", "crop_id", "quantity"),
+    }
+
+
+def full_scans(plan):
+    """
+        Tables that an EXPLAIN QUERY PLAN reads in full - "SCAN table" without an index. Index scans ("SCAN table
+        USING INDEX ...") are fine, they only read the index
+    """
+    scans = []
+    for line in plan.splitlines():
+        match = re.search(r"\bSCAN (\w+)(.*)$", line)
+        if match is not None and "USING" not in match.group(2) and match.group(1) not in ("CONSTANT", "SUBQUERY"):
+            scans.append(match.group(1))
+    return scans
+
+
+def query_plans(service_area, year=2018, timestep=1):
+    """
+    :return: {query name: {"plan": list of plan lines, "full_scans": tables read in full, "temp_b_tree": whether it
+             sorts or groups without an index}}
+    """
+    plans = {}
+    for name, queryset in hot_queries(service_area, year=year, timestep=timestep).items():
+        plan = queryset.explain()
+        plans[name] = {"plan": plan.splitlines(), "full_scans": full_scans(plan), "temp_b_tree": "TEMP B-TREE" in plan}
+    return plans
+
+
+def _count_queries(function):
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+    return {"queries": len(queries.captured_queries), "seconds": elapsed}
+
+
+def run(service_area=None, year=2018, timestep=1, **kwargs):
+    if connection.vendor != "sqlite":
+        raise ValueError("The query plan benchmark reads SQLite's EXPLAIN QUERY PLAN output")
+    if service_area is None:
+        service_area = busiest_service_area()
+
+    plans = query_plans(service_area, year=year, timestep=timestep)
+    return {
+        "service_area": service_area,
+        "load_inputs": _count_queries(lambda: ModelInputs.load(service_area=service_area, year=year, timestep=timestep)),
+        "load_all_inputs": _count_queries(lambda: ModelInputs.load(year=year, timestep=timestep)),
+        "service_area_report": _count_queries(lambda: report.service_area_totals(year=year, timestep=timestep)),
+        "plans": plans,
+        "full_scans": {name: plan["full_scans"] for name, plan in plans.items() if len(plan["full_scans"]) > 0},
+    }
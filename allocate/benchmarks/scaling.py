@@ -0,0 +1,89 @@
+"""
+    How the model scales with the number of fields. For each size, writes a synthetic service area with that many
+    fields to the database and times each step of a run against it - get_parts, build_problem, loading the inputs
+    snapshot, building the matrix LP, one solve, and a Monte Carlo run - recording wall time, peak memory and the
+    number of queries for each. Everything's written inside a transaction that's rolled back at the end, so the
+    database is left as it was.
+
+    Peak memory is from tracemalloc, so it's the peak of Python (and numpy) allocations during the step, not
+    including the solver's own allocations - max_rss_bytes is the process's peak resident size so far, which does
+    include them but never goes down between steps.
+"""
+
+import contextlib
+import logging
+import resource
+import sys
+import time
+import tracemalloc
+
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from allocate import allocation, synthetic
+
+SIZES = (100, 1000, 10000, 100000)
+
+
+def measure(function):
+    """
+    :return: (function's return value, {"seconds", "peak_memory_bytes", "queries"})
+    """
+    tracemalloc.start()
+    try:
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            result = function()
+            elapsed = time.perf_counter() - start
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, {"seconds": elapsed, "peak_memory_bytes": peak, "queries": len(queries.captured_queries)}
+
+
+def run_size(num_fields, iterations, pipes_per_field=5, seed=20220330):
+    service_area = "synthetic_0"
+    results = {"fields": num_fields}
+    with transaction.atomic():
+        counts, results["generate"] = measure(lambda: synthetic.create_synthetic_database(fields_per_area=num_fields, pipes_per_field=pipes_per_field, crops_without_priors=0, seed=seed))
+        results.update({"wells": counts["wells"], "pipes": counts["pipes"]})
+
+        measured, results["get_parts"] = measure(lambda: allocation.get_parts(service_area=service_area))
+        measured, results["build_problem"] = measure(lambda: allocation.build_problem(service_area=service_area))
+        del measured  # so the legacy problem isn't still in memory for the next steps
+
+        inputs, results["load_inputs"] = measure(lambda: allocation.load_inputs(service_area=service_area))
+        lp, results["build_lp"] = measure(lambda: allocation.build_lp(inputs=inputs))
+        lp.set_efficiencies([0.8] * len(lp.field_ids))
+        objective_value, results["solve"] = measure(lp.solve)
+        results["solve"]["status"] = lp.problem.status
+
+        controller = allocation.MonteCarloController(service_area, use_crop_constraints=True, inputs=inputs, random_seed=str(seed), streaming_statistics=True)
+        controller.brute_force_combinations_threshold = 0  # always sample, so it's the same number of iterations at every size
+        with contextlib.redirect_stdout(sys.stderr):  # the run prints its progress, which would mix in with the JSON output
+            measured, results["monte_carlo"] = measure(lambda: controller.run(iterations=iterations))
+        results["monte_carlo"].update({"iterations": iterations, "feasible_iterations": controller.feasible_iterations, "solver_calls": controller.solver_calls,
+                                       "per_iteration_seconds": results["monte_carlo"]["seconds"] / iterations})
+
+        transaction.set_rollback(True)
+
+    results["max_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # kilobytes on Linux
+    return results
+
+
+def run(sizes=None, iterations=50, pipes_per_field=5, seed=20220330, **kwargs):
+    """
+    :param sizes: numbers of fields to run - defaults to SIZES
+    :param iterations: Monte Carlo iterations at each size
+    """
+    if sizes is None:
+        sizes = SIZES
+
+    allocation_log = logging.getLogger(allocation.__name__)
+    log_level = allocation_log.level
+    allocation_log.setLevel(logging.WARNING)  # the per field logging in get_parts would otherwise swamp the timings
+    try:
+        return {"iterations": iterations, "pipes_per_field": pipes_per_field, "seed": seed,
+                "sizes": [run_size(num_fields, iterations, pipes_per_field=pipes_per_field, seed=seed) for num_fields in sizes]}
+    finally:
+        allocation_log.setLevel(log_level)
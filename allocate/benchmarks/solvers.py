@@ -0,0 +1,86 @@
+"""
+    Solves the same service areas with each installed LP solver, at the same sampled efficiencies, and reports how
+    long each solver takes and how closely its objective values agree with the reference solver's (the first
+    solver in the list, which is HiGHS when it's installed). Each solver gets its own copy of the problem, so the
+    first solve's time includes compiling it. Without service areas, runs a synthetic service area.
+"""
+
+import logging
+import time
+
+import numpy
+from cvxpy.error import SolverError
+
+from allocate import allocation, solvers
+from allocate.synthetic import synthetic_inputs
+
+
+def _time_solver(inputs, solver_settings, samples):
+    lp = allocation.build_lp(inputs=inputs)
+    objective_values = []
+    statuses = []
+    times = []
+    for efficiencies in samples:
+        lp.set_efficiencies(efficiencies)
+        start = time.perf_counter()
+        try:
+            lp.solve(solver_settings)
+            statuses.append(lp.problem.status)
+            objective_values.append(lp.problem.value)
+        except SolverError:
+            statuses.append("solver_error")
+            objective_values.append(None)
+        times.append(time.perf_counter() - start)
+
+    return {
+        "first_solve_seconds": times[0],
+        "per_iteration_seconds": float(numpy.mean(times[1:])) if len(times) > 1 else None,
+        "statuses": {status: statuses.count(status) for status in set(statuses)},
+    }, numpy.array([numpy.nan if value is None else value for value in objective_values], dtype=numpy.float64), statuses
+
+
+def run_inputs(inputs, solver_names, iterations=50, seed=20220330, tolerance=None, time_limit=None):
+    rng = numpy.random.default_rng(seed)
+    lp = allocation.build_lp(inputs=inputs)
+    samples = rng.choice([0.7, 0.86, 0.81], size=(iterations + 1, len(lp.field_ids)))
+
+    results = {"service_area": inputs.service_area, "fields": int(inputs.num_fields), "pipes": int(inputs.num_pipes), "solvers": {}}
+    reference_values = reference_statuses = None
+    for solver in solver_names:
+        solver_results, objective_values, statuses = _time_solver(inputs, solvers.SolverSettings(solver=solver, tolerance=tolerance, time_limit=time_limit), samples)
+        if reference_values is None:
+            reference_values, reference_statuses = objective_values, statuses
+        else:
+            # only compare the samples both solvers found an optimum for
+            compared = numpy.isfinite(objective_values) & numpy.isfinite(reference_values)
+            differences = numpy.abs(objective_values - reference_values)[compared] / numpy.maximum(numpy.abs(reference_values[compared]), 1)
+            solver_results["max_relative_objective_difference"] = float(differences.max()) if compared.any() else None
+            solver_results["status_disagreements"] = sum(status != reference_status for status, reference_status in zip(statuses, reference_statuses))
+        results["solvers"][solver] = solver_results
+
+    results["auto_solver"] = solvers.SolverSettings().choose(lp.num_variables)
+    return results
+
+
+def run(service_areas=None, fields=200, iterations=50, seed=20220330, solvers_to_run=None, tolerance=None, time_limit=None, **kwargs):
+    """
+    :param service_areas: service areas to load from the database - defaults to a synthetic service area with fields fields
+    :param iterations: number of efficiency samples to solve with each solver, after a first solve that includes compiling
+    :param solvers_to_run: solver names - defaults to every installed solver in solvers.LP_SOLVERS
+    """
+    if solvers_to_run is None:
+        solvers_to_run = solvers.available_solvers()
+
+    allocation_log = logging.getLogger(allocation.__name__)
+    log_level = allocation_log.level
+    allocation_log.setLevel(logging.WARNING)
+    try:
+        if service_areas is None:
+            all_inputs = [synthetic_inputs(num_fields=fields, seed=seed)]
+        else:
+            all_inputs = [allocation.load_inputs(service_area=service_area) for service_area in service_areas]
+
+        return {"iterations": iterations, "reference_solver": solvers_to_run[0] if len(solvers_to_run) > 0 else None,
+                "service_areas": [run_inputs(inputs, solvers_to_run, iterations=iterations, seed=seed, tolerance=tolerance, time_limit=time_limit) for inputs in all_inputs]}
+    finally:
+        allocation_log.setLevel(log_level)
@@ -0,0 +1,55 @@
+"""
+    get_parts time for a service area with the database read from the SQLite file (with the pragmas in
+    settings.SQLITE_PRAGMAS) and from an in-memory copy made by sqlite.in_memory_copy, plus the time to make the copy.
+    get_parts is mostly building the cvxpy expressions, so the time for just loading its inputs from the database
+    is reported separately. Needs the data loaded into the database in settings, and has to be run outside of a
+    transaction.
+"""
+
+import logging
+import statistics
+import time
+
+from django.db import connection
+
+from allocate import allocation, sqlite
+from allocate.benchmarks.query_plans import busiest_service_area
+
+
+def _time(function, repeats):
+    times = []
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {"median_seconds": statistics.median(times), "min_seconds": min(times)}
+
+
+def _time_modes(service_area, repeats):
+    return {"get_parts": _time(lambda: allocation.get_parts(service_area=service_area), repeats),
+            "load_inputs": _time(lambda: allocation.load_inputs(service_area=service_area), repeats)}
+
+
+def run(service_area=None, iterations=50, **kwargs):
+    """
+    :param iterations: number of times to time get_parts in each mode
+    """
+    if connection.vendor != "sqlite":
+        raise ValueError("The SQLite benchmark needs a SQLite database")
+    if service_area is None:
+        service_area = busiest_service_area()
+
+    allocation_log = logging.getLogger(allocation.__name__)
+    log_level = allocation_log.level
+    allocation_log.setLevel(logging.WARNING)  # the per field logging in get_parts would otherwise swamp the timings
+    try:
+        results = {"service_area": service_area, "repeats": iterations, "file": _time_modes(service_area, iterations)}
+        start = time.perf_counter()
+        with sqlite.in_memory_copy(write_models=()):  # get_parts doesn't write anything, so there's nothing to write back
+            results["copy_seconds"] = time.perf_counter() - start
+            results["in_memory"] = _time_modes(service_area, iterations)
+    finally:
+        allocation_log.setLevel(log_level)
+
+    results["speedup"] = {name: results["file"][name]["median_seconds"] / results["in_memory"][name]["median_seconds"] for name in results["file"]}
+    return results
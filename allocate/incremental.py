@@ -0,0 +1,194 @@
+"""
+    Incremental reloads of the input files. Each file's SHA-256 is recorded in InputFile when it's loaded, so
+    unchanged files are skipped entirely, and a changed file is compared row by row against what's already in the
+    database using each model's natural key (e.g. well, year, month and semi year for production) - only the rows
+    that are new, changed or gone get written. A stage is also rerun if a stage it depends on changed, since rows
+    that referenced something that didn't exist before might resolve now.
+
+    Deletes only consider the keys that were loaded from the same file last time (stored on the InputFile) - the
+    production data is split across several files in one table, so "not in this file" doesn't mean "delete". The
+    first incremental load of a database that was loaded some other way has no keys to compare against, so it
+    only inserts and updates.
+"""
+
+import hashlib
+import json
+import logging
+import zlib
+
+from django.db import transaction
+
+from . import load, models, production
+from .parallel_load import build_stages, check_stages, field_attnames, parse_csv
+
+log = logging.getLogger(__name__)
+
+NATURAL_KEYS = {
+    models.Crop: ("vw_crop_name",),
+    models.Well: ("well_id",),
+    models.AgField: ("liq_id",),
+    models.CropIrrigationTypePrior: ("crop", "irrigation_type"),
+    models.AgFieldTimestep: ("agfield", "timestep"),
+    models.Pipe: ("well", "agfield"),
+    models.WellProduction: ("well", "year", "month", "semi_year", "crop"),  # crop too - a well can have a record for each crop in a period
+}
+
+DELETE_BATCH_SIZE = 500
+
+
+def file_fingerprint(path, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _encode_keys(keys):
+    return zlib.compress(json.dumps([list(key) for key in keys]).encode("utf-8"))
+
+
+def _decode_keys(data):
+    if data is None:
+        return set()
+    return set(tuple(key) for key in json.loads(zlib.decompress(bytes(data)).decode("utf-8")))
+
+
+def read_rows(model, csv_file, field_map):
+    """
+        Parses the file and converts its values to the model fields' Python types so they compare equal to what's
+        in the database (e.g. "2018" and 2018, "2.5" and Decimal("2.5000"))
+    :return: (attribute names, {natural key: row values}, number of rows skipped) - rows missing a required value
+             are skipped, same as the bulk_create in a full load ignores them, and the first row wins if a key repeats
+    """
+    lookups = load.LookupCache()
+    lookups.preload(field_map)
+    attnames = field_attnames(model, field_map)
+
+    fields = [model._meta.get_field(name) for name in field_map]
+    key_positions = [list(field_map).index(name) for name in NATURAL_KEYS[model]]
+    parsed = {}
+    skipped = 0
+    for rows in parse_csv(csv_file, field_map, lookups):
+        for row in rows:
+            row = tuple(value if value is None or field.is_relation else field.to_python(value) for field, value in zip(fields, row))
+            if any(value is None and not field.null for field, value in zip(fields, row)):
+                skipped += 1
+                continue
+            parsed.setdefault(tuple(row[position] for position in key_positions), row)
+    return attnames, parsed, skipped
+
+
+class Delta(object):
+    """
+        What changed between a file and the database
+    """
+
+    def __init__(self, inserts, updates, deletes, skipped=0):
+        self.inserts = inserts  # list of row value tuples
+        self.updates = updates  # list of (id, row value tuple)
+        self.deletes = deletes  # list of ids
+        self.skipped = skipped
+
+    def counts(self):
+        return {"inserts": len(self.inserts), "updates": len(self.updates), "deletes": len(self.deletes), "skipped": self.skipped}
+
+
+def compute_delta(model, attnames, parsed, previous_keys=(), skipped=0):
+    """
+    :param parsed: {natural key: row values} from read_rows
+    :param previous_keys: natural keys loaded from the file last time - existing rows with one of these keys that
+                          aren't in the file anymore are deleted
+    """
+    key_positions = [attnames.index(model._meta.get_field(name).attname) for name in NATURAL_KEYS[model]]
+    existing = {}
+    for row in model.objects.order_by("id").values_list("id", *attnames):
+        existing.setdefault(tuple(row[1 + position] for position in key_positions), (row[0], row[1:]))
+
+    inserts = []
+    updates = []
+    for key, values in parsed.items():
+        if key not in existing:
+            inserts.append(values)
+        elif existing[key][1] != values:
+            updates.append((existing[key][0], values))
+
+    deletes = [existing[key][0] for key in previous_keys if key not in parsed and key in existing]
+    return Delta(inserts, updates, deletes, skipped)
+
+
+def apply_delta(model, update_fields, attnames, delta, batch_size=load.IMPORT_BATCH_SIZE):
+    """
+    :param update_fields: the fields to write for updated rows
+    :param attnames: attribute names for the values in the delta's rows
+    """
+    with transaction.atomic():
+        for start in range(0, len(delta.deletes), DELETE_BATCH_SIZE):
+            model.objects.filter(id__in=delta.deletes[start:start + DELETE_BATCH_SIZE]).delete()
+        if len(delta.updates) > 0:
+            model.objects.bulk_update([model(id=row_id, **dict(zip(attnames, values))) for row_id, values in delta.updates], update_fields, batch_size=batch_size)
+        for start in range(0, len(delta.inserts), batch_size):
+            model.objects.bulk_create([model(**dict(zip(attnames, values))) for values in delta.inserts[start:start + batch_size]], ignore_conflicts=True)
+
+
+def load_stage(stage, force=False, batch_size=load.IMPORT_BATCH_SIZE):
+    """
+        Loads the changes in a stage's file
+    :param force: compare the file with the database even if it hasn't changed since it was loaded
+    :return: dict of counts, or None if the file was skipped
+    """
+    path = str(stage.csv_file)
+    sha256 = file_fingerprint(path)
+    input_file = models.InputFile.objects.filter(path=path).first()
+    if input_file is not None and input_file.sha256 == sha256 and input_file.model == stage.model._meta.label and not force:
+        return None
+
+    previous_keys = _decode_keys(input_file.keys) if input_file is not None and input_file.model == stage.model._meta.label else set()
+    attnames, parsed, skipped = read_rows(stage.model, stage.csv_file, stage.field_map)
+    delta = compute_delta(stage.model, attnames, parsed, previous_keys, skipped)
+    with transaction.atomic():
+        update_fields = [name for name in stage.field_map if name not in NATURAL_KEYS[stage.model]]  # keys matched, so they're the same
+        apply_delta(stage.model, update_fields, attnames, delta, batch_size=batch_size)
+        models.InputFile.objects.update_or_create(path=path, defaults={"model": stage.model._meta.label, "sha256": sha256, "rows": len(parsed), "keys": _encode_keys(parsed.keys())})
+    return delta.counts()
+
+
+def load_incremental(stages=None, batch_size=load.IMPORT_BATCH_SIZE):
+    """
+        Loads only what changed in the input files, in dependency order
+    :param stages: list of parallel_load.Stages - defaults to build_stages() with the files from the settings
+    :return: {stage name: counts of inserts, updates, deletes and skipped rows, or None if it was unchanged} - for
+             a function stage that reran because a dependency changed, {"generated": what the function returned}
+    """
+    if stages is None:
+        stages = build_stages()
+    check_stages(stages)
+
+    results = {}
+    changed = set()
+    remaining = list(stages)
+    while len(remaining) > 0:
+        ready = [stage for stage in remaining if all(dependency in results for dependency in stage.depends_on)]
+        for stage in ready:
+            remaining.remove(stage)
+            if stage.run is not None:
+                # these are idempotent - the ones without dependencies are cheap enough to always run, and the rest
+                # (generating the pipes) only rerun when something they depend on changed
+                results[stage.name] = None
+                if len(stage.depends_on) == 0:
+                    stage.run()
+                elif any(dependency in changed for dependency in stage.depends_on):
+                    results[stage.name] = {"generated": stage.run()}
+                    changed.add(stage.name)
+                    log.info(f"{stage.name}: {results[stage.name]}")
+                continue
+            results[stage.name] = load_stage(stage, force=any(dependency in changed for dependency in stage.depends_on), batch_size=batch_size)
+            if results[stage.name] is not None:
+                changed.add(stage.name)
+                log.info(f"{stage.name}: {results[stage.name]}")
+            else:
+                log.info(f"{stage.name}: unchanged")
+
+    if any(stage.model is models.WellProduction for stage in stages if stage.name in changed):
+        production.invalidate()  # bulk writes don't send signals
+    return results
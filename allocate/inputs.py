@@ -0,0 +1,273 @@
+"""
+    Loads everything the allocation model needs for a service area (or for every service area) in a fixed
+    number of bulk queries and holds it in NumPy arrays. Building and solving the model, checking service
+    area totals, and setting up the Monte Carlo then only read from this snapshot instead of going back to
+    the ORM once per field, pipe and well.
+"""
+
+import hashlib
+
+import numpy
+
+from django.db.models import Q
+
+from . import models
+from .production import ProductionCube
+
+NO_CROP = -1  # crop id used in the arrays for fields that don't have a crop
+
+
+class ModelInputs(object):
+    """
+        A snapshot of the model inputs. Fields, wells and pipes are each stored as parallel arrays - pipes refer
+        to their well and field by *index* into the well and field arrays so that the model can be built with
+        array operations. Nothing in here holds on to Django objects, so the snapshot can be pickled and handed
+        to other processes.
+
+        Fields:
+            field_pks, field_ids (liq_id), field_crop_ids (NO_CROP when unknown), field_service_areas, field_demand
+        Wells:
+            well_pks, well_ids (well_id), well_service_areas, well_production (annual production for the year, 0 if unknown)
+        Pipes (only the max_wells_per_field shortest for each field, sorted by field and then distance):
+            pipe_pks, pipe_well_index, pipe_field_index, pipe_distance, pipe_named (whether variable_name is already set)
+        Crop tagged production (one entry per WellProduction record with a crop, for wells in the snapshot):
+            crop_production_well_index, crop_production_crop_ids, crop_production_quantity
+        Lookups:
+            crop_names ({crop_id: vw_crop_name}), irrigation_types (list of dicts with id, name, efficiency),
+            irrigation_priors ({crop_id: [(irrigation_type_id, probability), ...]})
+        Timesteps (only when loaded with more than one timestep, otherwise None - field_demand is then the total
+        over the timesteps and well_production is still the annual production):
+            timesteps, field_timestep_demand (fields x timesteps), well_timestep_production (wells x timesteps)
+    """
+
+    def __init__(self, **arrays):
+        self.service_area = None
+        self.year = None
+        self.timestep = None
+        self.timesteps = None
+        self.field_timestep_demand = None
+        self.well_timestep_production = None
+        self.__dict__.update(arrays)
+
+    @property
+    def num_fields(self):
+        return len(self.field_ids)
+
+    @property
+    def num_wells(self):
+        return len(self.well_ids)
+
+    @property
+    def num_pipes(self):
+        return len(self.pipe_pks)
+
+    @property
+    def num_timesteps(self):
+        return 1 if self.timesteps is None else len(self.timesteps)
+
+    def timestep_demand(self):
+        """
+            Demand for each field in each timestep - a single column of field_demand without timesteps
+        """
+        return self.field_demand[:, numpy.newaxis] if self.field_timestep_demand is None else self.field_timestep_demand
+
+    def timestep_production(self):
+        """
+            Production for each well in each timestep - a single column of well_production without timesteps
+        """
+        return self.well_production[:, numpy.newaxis] if self.well_timestep_production is None else self.well_timestep_production
+
+    @classmethod
+    def load(cls, service_area=None, year=2018, timestep=1, max_wells_per_field=None, timesteps=None):
+        """
+            Builds the snapshot from the database
+        :param service_area: the ucm_service_area_id to load - if None, loads every service area
+        :param year: the production year to use for well capacities
+        :param timestep: the AgFieldTimestep timestep to use for field demands
+        :param max_wells_per_field: how many of the closest pipes to keep for each field - None keeps them all
+        :param timesteps: load the demand for each of these timesteps instead of just timestep (e.g.
+                          AgFieldTimestep.MONTHS), along with each well's production in them - the month's production
+                          for monthly timesteps (see ProductionCube.monthly_production_with_fallback), otherwise the
+                          annual production
+        :return: ModelInputs
+        """
+        fields = models.AgField.objects.all()
+        wells = models.Well.objects.all()
+        if service_area is not None:
+            fields = fields.filter(ucm_service_area_id=service_area)
+
+        field_rows = list(fields.order_by("id").values_list("id", "liq_id", "crop_id", "ucm_service_area_id"))
+        field_pks = numpy.array([row[0] for row in field_rows], dtype=numpy.int64)
+        field_crop_ids = numpy.array([NO_CROP if row[2] is None else row[2] for row in field_rows], dtype=numpy.int64)
+
+        # demand for each field in the timestep - fields without a timestep record get 0 demand (assume unplanted)
+        if timesteps is None:
+            field_timestep_demand = None
+            field_demand = models.AgFieldTimestep.objects.filter(agfield__in=fields, timestep=timestep).demand_by_field(field_pks)
+        else:
+            field_timestep_demand = models.AgFieldTimestep.objects.filter(agfield__in=fields).demand_by_field_and_timestep(field_pks, timesteps)
+            field_demand = field_timestep_demand.sum(axis=1)
+
+        # get all the pipes for the fields, shortest first, and then keep only up to max_wells_per_field for each field
+        pipe_rows = list(models.Pipe.objects.filter(agfield__in=fields)
+                            .order_by("agfield_id", "distance", "id")
+                            .values_list("id", "well_id", "agfield_id", "distance", "variable_name"))
+        pipe_field_pks = numpy.array([row[2] for row in pipe_rows], dtype=numpy.int64)
+        if max_wells_per_field is not None:
+            keep = _rank_within_groups(pipe_field_pks) < max_wells_per_field
+            pipe_rows = [row for row, keep_row in zip(pipe_rows, keep) if keep_row]
+
+        # we need the wells in the service area (for supply totals) as well as any wells the fields' pipes connect to
+        if service_area is not None:
+            wells = wells.filter(Q(ucm_service_area_id=service_area) | Q(id__in=models.Pipe.objects.filter(agfield__in=fields).values("well_id")))
+        well_rows = list(wells.order_by("id").values_list("id", "well_id", "ucm_service_area_id"))
+        well_pks = numpy.array([row[0] for row in well_rows], dtype=numpy.int64)
+
+        # annual production with the annual -> semi-annual -> monthly fallback, from one grouped query - 0 if unknown
+        cube = ProductionCube.load(wells=wells, years=[year])
+        well_production = numpy.nan_to_num(cube.annual_production(well_pks, year), nan=0.0)
+        well_timestep_production = None if timesteps is None else _timestep_production(cube, well_pks, year, timesteps, well_production)
+
+        crop_production_rows = list(models.WellProduction.objects.filter(well__in=wells, crop__isnull=False).order_by("id").values_list("well_id", "crop_id", "quantity"))
+
+        crop_names = dict(models.Crop.objects.filter(id__in=fields.values("crop_id")).values_list("id", "vw_crop_name"))
+        irrigation_types = [{"id": type_id, "name": name, "efficiency": float(efficiency)}
+                                for type_id, name, efficiency in models.IrrigationType.objects.order_by("id").values_list("id", "name", "efficiency")]
+        irrigation_priors = {}
+        for crop_id, irrigation_type_id, probability in models.CropIrrigationTypePrior.objects.filter(crop_id__in=fields.values("crop_id")).order_by("id").values_list("crop_id", "irrigation_type_id", "probability"):
+            irrigation_priors.setdefault(crop_id, []).append((irrigation_type_id, float(probability)))
+
+        inputs = cls(
+            field_pks=field_pks,
+            field_ids=numpy.array([row[1] for row in field_rows], dtype=object),
+            field_crop_ids=field_crop_ids,
+            field_service_areas=numpy.array([row[3] for row in field_rows], dtype=object),
+            field_demand=field_demand,
+            well_pks=well_pks,
+            well_ids=numpy.array([row[1] for row in well_rows], dtype=object),
+            well_service_areas=numpy.array([row[2] for row in well_rows], dtype=object),
+            well_production=well_production,
+            pipe_pks=numpy.array([row[0] for row in pipe_rows], dtype=numpy.int64),
+            pipe_well_index=numpy.searchsorted(well_pks, numpy.array([row[1] for row in pipe_rows], dtype=numpy.int64)),
+            pipe_field_index=numpy.searchsorted(field_pks, numpy.array([row[2] for row in pipe_rows], dtype=numpy.int64)),
+            pipe_distance=numpy.array([float(row[3]) for row in pipe_rows], dtype=numpy.float64),
+            pipe_named=numpy.array([row[4] is not None for row in pipe_rows], dtype=bool),
+            crop_production_well_index=numpy.searchsorted(well_pks, numpy.array([row[0] for row in crop_production_rows], dtype=numpy.int64)),
+            crop_production_crop_ids=numpy.array([row[1] for row in crop_production_rows], dtype=numpy.int64),
+            crop_production_quantity=numpy.array([float(row[2]) for row in crop_production_rows], dtype=numpy.float64),
+            crop_names=crop_names,
+            irrigation_types=irrigation_types,
+            irrigation_priors=irrigation_priors,
+            timesteps=None if timesteps is None else numpy.array(timesteps, dtype=numpy.int64),
+            field_timestep_demand=field_timestep_demand,
+            well_timestep_production=well_timestep_production,
+        )
+        inputs.service_area = service_area
+        inputs.year = year
+        inputs.timestep = timestep
+        return inputs
+
+    def for_service_area(self, service_area):
+        """
+            Cuts the snapshot for a single service area out of a larger snapshot (e.g. one loaded for every service
+            area), so many service areas can be set up from one set of queries. Keeps the area's fields, their
+            pipes, and the wells that are either in the area or connected to its fields by those pipes.
+        """
+        field_mask = self.field_service_areas == service_area
+        pipe_mask = field_mask[self.pipe_field_index]
+        well_mask = self.well_service_areas == service_area
+        well_mask[self.pipe_well_index[pipe_mask]] = True
+        crop_production_mask = well_mask[self.crop_production_well_index]
+
+        # positions of the kept fields and wells in the new arrays
+        field_positions = numpy.cumsum(field_mask) - 1
+        well_positions = numpy.cumsum(well_mask) - 1
+
+        field_crop_ids = self.field_crop_ids[field_mask]
+        inputs = ModelInputs(
+            field_pks=self.field_pks[field_mask],
+            field_ids=self.field_ids[field_mask],
+            field_crop_ids=field_crop_ids,
+            field_service_areas=self.field_service_areas[field_mask],
+            field_demand=self.field_demand[field_mask],
+            well_pks=self.well_pks[well_mask],
+            well_ids=self.well_ids[well_mask],
+            well_service_areas=self.well_service_areas[well_mask],
+            well_production=self.well_production[well_mask],
+            pipe_pks=self.pipe_pks[pipe_mask],
+            pipe_well_index=well_positions[self.pipe_well_index[pipe_mask]],
+            pipe_field_index=field_positions[self.pipe_field_index[pipe_mask]],
+            pipe_distance=self.pipe_distance[pipe_mask],
+            pipe_named=self.pipe_named[pipe_mask],
+            crop_production_well_index=well_positions[self.crop_production_well_index[crop_production_mask]],
+            crop_production_crop_ids=self.crop_production_crop_ids[crop_production_mask],
+            crop_production_quantity=self.crop_production_quantity[crop_production_mask],
+            crop_names={crop: name for crop, name in self.crop_names.items() if crop in field_crop_ids},
+            irrigation_types=self.irrigation_types,
+            irrigation_priors={crop: priors for crop, priors in self.irrigation_priors.items() if crop in field_crop_ids},
+            timesteps=self.timesteps,
+            field_timestep_demand=None if self.field_timestep_demand is None else self.field_timestep_demand[field_mask],
+            well_timestep_production=None if self.well_timestep_production is None else self.well_timestep_production[well_mask],
+        )
+        inputs.service_area = service_area
+        inputs.year = self.year
+        inputs.timestep = self.timestep
+        return inputs
+
+    def fingerprint(self, settings):
+        """
+            Hash of everything that goes into the allocation model - pipes, distances, demands, production, crop
+            tagged production and the model settings (margins, etc). If any of the inputs change, so does the
+            fingerprint, so it can be used to key cached solves across runs and data reloads
+        :param settings: dict of the model settings
+        :return: hex digest
+        """
+        digest = hashlib.sha256()
+        for name in ("field_ids", "well_ids"):
+            digest.update("\x00".join(str(value) for value in getattr(self, name)).encode("utf-8"))
+            digest.update(b"\x01")
+        for name in ("field_crop_ids", "field_demand", "well_production", "pipe_pks", "pipe_well_index", "pipe_field_index",
+                     "pipe_distance", "crop_production_well_index", "crop_production_crop_ids", "crop_production_quantity"):
+            digest.update(name.encode("utf-8"))
+            digest.update(numpy.ascontiguousarray(getattr(self, name), dtype=numpy.float64).tobytes())
+        if self.timesteps is not None:  # so snapshots without timesteps keep the fingerprints they had before timesteps existed
+            for name in ("timesteps", "field_timestep_demand", "well_timestep_production"):
+                digest.update(name.encode("utf-8"))
+                digest.update(numpy.ascontiguousarray(getattr(self, name), dtype=numpy.float64).tobytes())
+        digest.update(repr(sorted(settings.items())).encode("utf-8"))
+        return digest.hexdigest()
+
+    def pipe_variable_name(self, pipe_index):
+        return f"well_{self.well_ids[self.pipe_well_index[pipe_index]]}_field_{self.field_ids[self.pipe_field_index[pipe_index]]}"
+
+    def service_area_totals(self, service_area):
+        """
+            Total demand of the fields and total production of the wells that are in the service area
+        """
+        return {"demands": float(self.field_demand[self.field_service_areas == service_area].sum()),
+                "supplies": float(self.well_production[self.well_service_areas == service_area].sum())}
+
+
+def _timestep_production(cube, well_pks, year, timesteps, annual_production):
+    """
+        Each well's production in each timestep - the month's production for monthly timesteps, and the annual
+        production for any other timestep
+    """
+    monthly = numpy.nan_to_num(cube.monthly_production_with_fallback(well_pks, year), nan=0.0)
+    columns = []
+    for timestep in timesteps:
+        month = models.AgFieldTimestep.timestep_month(timestep)
+        columns.append(annual_production if month is None else monthly[:, month - 1])
+    return numpy.column_stack(columns) if len(columns) > 0 else numpy.zeros((len(well_pks), 0))
+
+
+def _rank_within_groups(group_keys):
+    """
+        Given an array of keys that's already sorted so each group is contiguous, returns each item's position
+        within its group (0 for the first item in each group)
+    """
+    if len(group_keys) == 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+    positions = numpy.arange(len(group_keys))
+    group_starts = numpy.concatenate(([True], group_keys[1:] != group_keys[:-1]))
+    return positions - numpy.maximum.accumulate(numpy.where(group_starts, positions, 0))
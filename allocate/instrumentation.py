@@ -0,0 +1,156 @@
+"""
+    Timing for the phases of an allocation run - fetching the inputs, building the model, cvxpy's compile, the
+    solve, and extracting the results - with the SQL queries run and the solver's stats for each. Nothing is
+    recorded unless an Instrumentation is active, and when none is, span() hands back a shared no-op context
+    manager, so the calls can stay in the hot loop.
+
+    Usage:
+        metrics = Instrumentation("metrics.jsonl")
+        with metrics.active():
+            ...
+        print(metrics.summary_table())
+
+    Spans nest - a query or a compile inside a solve span counts toward both - so the summary's rows don't add up
+    to the total time. Each span is written to the JSON lines file as it finishes.
+"""
+
+import contextlib
+import json
+import time
+
+from django.db import connection
+
+FETCH = "fetch"
+BUILD = "build"
+COMPILE = "compile"
+SOLVE = "solve"
+EXTRACT = "extract"
+RECORD = "record"  # adding an iteration's solution to the Monte Carlo results
+
+_NULL_SPAN = contextlib.nullcontext()
+_active = None
+
+
+class Instrumentation(object):
+
+    def __init__(self, path=None):
+        """
+        :param path: optional JSON lines file to append each span's record to
+        """
+        self.path = path
+        self.records = []
+        self._open_spans = []  # records for the spans that are currently open, outermost first
+        self._file = None
+
+    @contextlib.contextmanager
+    def active(self):
+        """
+            Makes this the instrumentation that span() and record_solve() report to, and counts the queries run on
+            the default connection while it's active
+        """
+        global _active
+        if _active is self:  # already active further up, and already counting queries
+            yield self
+            return
+        previous = _active
+        _active = self
+        if self.path is not None and self._file is None:
+            self._file = open(self.path, 'a')
+        try:
+            with connection.execute_wrapper(self._count_query):
+                yield self
+        finally:
+            _active = previous
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _count_query(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            for record in self._open_spans:
+                record["queries"] += 1
+                record["query_seconds"] += elapsed
+
+    @contextlib.contextmanager
+    def span(self, name, **fields):
+        record = {"span": name, "seconds": 0.0, "queries": 0, "query_seconds": 0.0, **fields}
+        self._open_spans.append(record)
+        start = time.perf_counter()
+        try:
+            yield record  # the caller can add fields to the record while the span is open
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            self._open_spans.remove(record)
+            self.add(record)
+
+    def add(self, record):
+        self.records.append(record)
+        if self._file is not None:
+            self._file.write(json.dumps(record) + "\n")
+
+    def record_solve(self, problem, record):
+        """
+            Adds cvxpy's solver_stats for the problem's latest solve to the solve span's record, and records its
+            compile (canonicalization) time as a span of its own
+        """
+        stats = problem.solver_stats
+        record.update({"status": problem.status,
+                       "solver": None if stats is None else stats.solver_name,
+                       "setup_seconds": None if stats is None else stats.setup_time,
+                       "solve_seconds": None if stats is None else stats.solve_time,
+                       "iterations": None if stats is None else stats.num_iters})
+        compilation_time = getattr(problem, "compilation_time", None)
+        if compilation_time is not None:
+            self.add({"span": COMPILE, "seconds": compilation_time, "queries": 0, "query_seconds": 0.0})
+
+    def summary(self):
+        """
+            Totals for each kind of span, in the order they first ran
+        :return: list of dicts with span, count, seconds, mean_seconds, queries and query_seconds
+        """
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record["span"], {"span": record["span"], "count": 0, "seconds": 0.0, "queries": 0, "query_seconds": 0.0})
+            total["count"] += 1
+            total["seconds"] += record["seconds"]
+            total["queries"] += record["queries"]
+            total["query_seconds"] += record["query_seconds"]
+        for total in totals.values():
+            total["mean_seconds"] = total["seconds"] / total["count"]
+        return list(totals.values())
+
+    def summary_table(self):
+        lines = [f"{'span':<10} {'count':>8} {'seconds':>10} {'mean':>10} {'queries':>8} {'query s':>10}"]
+        for total in self.summary():
+            lines.append(f"{total['span']:<10} {total['count']:>8} {total['seconds']:>10.3f} {total['mean_seconds']:>10.5f} {total['queries']:>8} {total['query_seconds']:>10.3f}")
+        return "\n".join(lines)
+
+
+def span(name, **fields):
+    """
+        Times the block as a span of the active Instrumentation - does nothing if there isn't one. The context
+        manager's value is the span's record (a dict), or None when nothing is being recorded
+    """
+    if _active is None:
+        return _NULL_SPAN
+    return _active.span(name, **fields)
+
+
+def record_solve(problem, record):
+    """
+        See Instrumentation.record_solve - record is the value of the solve span, so this does nothing when it's None
+    """
+    if record is None or _active is None:
+        return
+    _active.record_solve(problem, record)
+
+
+def activate(instrumentation):
+    """
+        instrumentation.active(), or a no-op context manager when instrumentation is None
+    """
+    return _NULL_SPAN if instrumentation is None else instrumentation.active()
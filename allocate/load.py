@@ -1,14 +1,18 @@
 import logging
 
+import django.core.exceptions
 import django.db.utils
+from django.db import transaction
 
 from WellAllocation import settings
-from allocate import models
+from allocate import models, pipes, production
 
 import csv
 
 log = logging.getLogger(__name__)
 
+IMPORT_BATCH_SIZE = 5000  # rows to hold in memory and insert at once
+
 class Constant(object):
 	""" we'll use this in field maps - if it's a Constant type, then it won't look up the value"""
 	def __init__(self, value):
@@ -21,13 +25,63 @@ def sanitize_input(value):
 	return value
 
 
-def get_value(record, field):
+class LookupCache(object):
+	"""
+		Resolves the foreign key lookups in field maps ({"ModelName.attribute": "csv column"}) from dicts of
+		attribute -> id that are loaded once per model and attribute, rather than with a query per CSV row. Keeps
+		the same behavior as the query - when more than one record has the value, the one with the lowest id wins,
+		and values that don't match anything resolve to None.
+	"""
+	def __init__(self):
+		self.lookups = {}
+
+	def preload(self, field_map):
+		"""
+			Loads the lookups for every foreign key in the field map, so the cache can resolve rows without the
+			database - e.g. after it's been pickled and sent to another process
+		"""
+		for field in field_map.values():
+			if hasattr(field, "keys"):
+				model_key = list(field.keys())[0]
+				if model_key not in self.lookups:
+					self.load(model_key)
+
+	def load(self, model_key):
+		model_name, attribute = model_key.split(".")
+		model = getattr(models, model_name)
+		lookup = {}
+		for pk, value in model.objects.order_by("id").values_list("id", attribute):
+			lookup.setdefault(value, pk)  # first by id wins, like .order_by("id").first()
+		self.lookups[model_key] = (model, model._meta.get_field(attribute), lookup)
+
+	def get(self, model_key, value):
+		"""
+			Returns an unsaved instance with just the primary key set - enough to assign to a foreign key and save
+		"""
+		if model_key not in self.lookups:
+			self.load(model_key)
+		model, field, lookup = self.lookups[model_key]
+		if value is not None:
+			try:
+				value = field.to_python(value)  # so the CSV's strings match the database values for non-text attributes
+			except django.core.exceptions.ValidationError:
+				return None
+		pk = lookup.get(value)  # a None value matches records where the attribute is null, same as .get(attribute=None)
+		if pk is None:
+			return None
+		return model(pk=pk)
+
+
+def get_value(record, field, lookups=None):
 	if type(field) is Constant:
 		return field.value
 
 	if hasattr(field, "keys"):  # if it's a dict-like, then it's a foreign key,
 		# so let's get the foreign object
 		model_key = list(field.keys())[0]
+		if lookups is not None:
+			return lookups.get(model_key, sanitize_input(record[field[model_key]]))
+
 		model, attribute = model_key.split(".")  # it'll be ModelName.attribute as the key and then the value for the lookup
 		kwarg = dict()
 		kwarg[attribute] = sanitize_input(record[field[model_key]])
@@ -44,37 +98,124 @@ def get_value(record, field):
 		return None
 
 
-def generic_csv_import(model, csv_file, field_map, skip_failed_create=False, bulk=True):
+def read_values(csv_data, field_map, lookups=None):
+	"""
+		Reads a CSV one row at a time and yields the model values for each row
+	:param csv_data: open CSV file
+	:param field_map: model field -> CSV column (or Constant, or {"Model.attribute": column} for foreign keys). A None
+					column means the CSV column has the same name as the model field, and a None field_map uses every
+					CSV column as-is
+	"""
+	records = csv.DictReader(csv_data)
 	if field_map is None:
-		with open(csv_file, 'r') as csv_data:
-			records = csv.DictReader(csv_data)
-			for record in records:
-				field_map = {key: key for key in record.keys()}
-				break
-	else:
-		for field in field_map:  # if the field map provides a None value for the field, then
-			if field_map[field] is None:  # set the key as the value to look up in the csv - it means to use it for both
-				field_map[field] = field
+		field_map = {key: key for key in records.fieldnames}
+	else:  # if the field map provides a None value for the field, then set the key as the value to look up in the csv - it means to use it for both
+		field_map = {field: field if field_map[field] is None else field_map[field] for field in field_map}
 
-	items = []
-	with open(csv_file, 'r') as csv_data:
-		records = csv.DictReader(csv_data)
-		for record in records:
-			values = {model_key: get_value(record, field_map[model_key]) for model_key in field_map}
+	for record in records:
+		yield {model_key: get_value(record, field_map[model_key], lookups) for model_key in field_map}
 
+
+def generic_csv_import(model, csv_file, field_map, skip_failed_create=False, bulk=True, batch_size=IMPORT_BATCH_SIZE):
+	"""
+		Imports a CSV into model. The file is read once and streamed through in chunks of batch_size rows, so memory
+		doesn't grow with the size of the file, and the whole import is a single transaction - if it fails partway
+		through, nothing from the file is saved.
+	:param field_map: see read_values
+	:param skip_failed_create: when not using bulk, skip rows that fail with an IntegrityError instead of stopping.
+								Each row gets its own savepoint so a failed row doesn't break the transaction
+	:param bulk: bulk_create each chunk (ignoring conflicts) rather than get_or_create for each row
+	:return: number of rows read
+	"""
+	lookups = LookupCache()  # preloads the foreign key lookups instead of querying for them on every row
+	rows = 0
+	items = []
+	with open(csv_file, 'r', newline='') as csv_data, transaction.atomic():
+		for values in read_values(csv_data, field_map, lookups):
+			rows += 1
 			if bulk:
 				items.append(model(**values))
+				if len(items) >= batch_size:
+					model.objects.bulk_create(items, ignore_conflicts=True)
+					items = []
 			else:
 				try:
-					model.objects.get_or_create(**values)
+					with transaction.atomic():
+						model.objects.get_or_create(**values)
 				except django.db.utils.IntegrityError:
 					if skip_failed_create:
 						pass
 					else:
 						raise
 
-	if bulk:
-		model.objects.bulk_create(items, ignore_conflicts=True)
+		if bulk and len(items) > 0:
+			model.objects.bulk_create(items, ignore_conflicts=True)
+
+	return rows
+
+# field maps for each of the input files - model field -> CSV column. See read_values
+CROP_FIELDS = {
+	"vw_crop_name": "VW_crop",
+	"ucm_group": "UCM_group",
+	"liq_crop_name": "LIQ_CropType",
+	"liq_crop_id": "LIQ_CROPTYP2",
+	"liq_group_name": "LIQ_class_name",
+	"liq_group_code": "LIQ_CLASS2",
+	"_efficiency_options": "efficiencies",
+}
+
+WELL_FIELDS = {
+	"well_id": "Well_Nbr",
+	"ucm_service_area_id": "ucm_well_service_area_id",
+	"apn": "APN",
+	"x": "POINT_X",  # optional - only needed to generate pipes (see pipes.py) instead of loading PIPE_FILE
+	"y": "POINT_Y",
+}
+
+FIELD_FIELDS = {
+	"crop": {"Crop.liq_crop_id": "CROPTYP2"},
+	"ucm_service_area_id": "ucm_well_service_area_id",
+	"liq_id": "UniqueID",
+	"acres": "ACRES",
+	"x": "CENTROID_X",  # optional, like the well coordinates
+	"y": "CENTROID_Y",
+}
+
+CROP_IRRIGATION_TYPE_FIELDS = {
+	"crop": {"Crop.liq_crop_id": "crop_code"},
+	"irrigation_type": {"IrrigationType.type_code": "irrigation_type"},
+	"probability": "probability",
+}
+
+ET_FIELDS = {
+	"agfield": {"AgField.liq_id": "UniqueID"},
+	"timestep": Constant(models.AgFieldTimestep.ANNUAL),
+	"consumptive_use": "et",
+	"precip": "precip",
+}
+
+
+def monthly_et_fields(month):
+	"""
+		Field map for a file of ET for a single month - loaded as that month's timestep (see AgFieldTimestep)
+	"""
+	return dict(ET_FIELDS, timestep=Constant(models.AgFieldTimestep.month_timestep(month)))
+
+PIPE_FIELDS = {
+	"well": {"Well.well_id": "Well_Nbr"},
+	"agfield": {"AgField.liq_id": "UniqueID"},
+	"distance": "NEAR_DIST",
+}
+
+PRODUCTION_FIELDS = {
+	"well": {"Well.well_id": "well_id"},
+	"crop": {"Crop.vw_crop_name": "factor"},
+	"quantity": "af",
+	"year": "calendar_year",
+	"month": "month",
+	"semi_year": "calendar_semi_year",
+}
+
 
 def load(crop_file=settings.CROP_DATA,
 		 well_file=settings.WELL_DATA,
@@ -82,7 +223,8 @@ def load(crop_file=settings.CROP_DATA,
 		 field_file=settings.FIELD_DATA,
 		 agtimestep_file=settings.ET_DATA,
 		 pipe_file=settings.PIPE_FILE,
-		 crop_irrigation_file=settings.CROP_IRRIGATION_TYPE_DATA):
+		 crop_irrigation_file=settings.CROP_IRRIGATION_TYPE_DATA,
+		 monthly_et_files=settings.MONTHLY_ET_DATA):
 
 	log.info("Crops")
 	load_crops(crop_file)
@@ -95,85 +237,68 @@ def load(crop_file=settings.CROP_DATA,
 
 	log.info("ET Data")
 	load_et_data(agtimestep_file)
+	load_monthly_et_data(monthly_et_files)
 
 	log.info("Pipes")
-	generic_csv_import(models.Pipe, pipe_file, {
-		"well": {"Well.well_id": "Well_Nbr"},
-		"agfield": {"AgField.liq_id": "UniqueID"},
-		"distance": "NEAR_DIST",
-	})
+	if pipe_file is None:  # build them from the well and field coordinates instead of a near table
+		pipes.generate_pipes()
+	else:
+		generic_csv_import(models.Pipe, pipe_file, PIPE_FIELDS)
 
 	log.info("Production Data")
 	for production_file in production_files:
 		log.info(production_file)
-		generic_csv_import(models.WellProduction, production_file, {
-			"well": {"Well.well_id": "well_id"},
-			"crop": {"Crop.vw_crop_name": "factor"},
-			"quantity": "af",
-			"year": "calendar_year",
-			"month": "month",
-			"semi_year": "calendar_semi_year",
-		},
-		skip_failed_create=True
-		)
+		generic_csv_import(models.WellProduction, production_file, PRODUCTION_FIELDS, skip_failed_create=True)
+	production.invalidate()  # bulk creates don't send signals, so drop the cached production cube ourselves
 
 
 
 
 def load_crops(crop_file=settings.CROP_DATA):
-	generic_csv_import(models.Crop, crop_file, {"vw_crop_name": "VW_crop",
-												"ucm_group": "UCM_group",
-												"liq_crop_name": "LIQ_CropType",
-												"liq_crop_id": "LIQ_CROPTYP2",
-												"liq_group_name": "LIQ_class_name",
-												"liq_group_code": "LIQ_CLASS2",
-												"_efficiency_options": "efficiencies"})
+	generic_csv_import(models.Crop, crop_file, CROP_FIELDS)
 
 
 def load_fields(field_file=settings.FIELD_DATA):
-	generic_csv_import(models.AgField, field_file,{
-		"crop": {"Crop.liq_crop_id": "CROPTYP2"},
-		"ucm_service_area_id": "ucm_well_service_area_id",
-		"liq_id": "UniqueID",
-		"acres": "ACRES"
-	},
-	skip_failed_create=True)
+	generic_csv_import(models.AgField, field_file, FIELD_FIELDS, skip_failed_create=True)
+
+
+IRRIGATION_TYPES = [
+	#("Flood Basin", "FB", 0.83),
+	#("Flood Furrow", "FF", 0.73),
+	("Sprinkler - Solid Set", "SI", 0.7),
+	("Drip - Surface", "SD", 0.86),
+	#("Drip - Subsurface", "SSD", 0.86),
+	#("Other", "OT", None),
+	#("Center Pivot", "CP", 0.8),
+	("Sprinkler - Microsprinkler", "MS", 0.81),
+	("Fallow", "F", 0.01),  # discourage applying water to fallow fields
+]
 
 
 def load_irrigation_types():
-	#models.IrrigationType.objects.create(name="Flood Basin", code="FB", efficiency=0.83)
-	#models.IrrigationType.objects.create(name="Flood Furrow", code="FF", efficiency=0.73)
-	models.IrrigationType.objects.create(name="Sprinkler - Solid Set", type_code="SI", efficiency=0.7)
-	models.IrrigationType.objects.create(name="Drip - Surface", type_code="SD", efficiency=0.86)
-	#models.IrrigationType.objects.create(name="Drip - Subsurface", code="SSD", efficiency=0.86)
-	#models.IrrigationType.objects.create(name="Other", code="OT", efficiency=None)
-	#models.IrrigationType.objects.create(name="Center Pivot", code="CP", efficiency=0.8)
-	models.IrrigationType.objects.create(name="Sprinkler - Microsprinkler", type_code="MS", efficiency=0.81)
-	models.IrrigationType.objects.create(name="Fallow", type_code="F", efficiency=0.01)  # discourage applying water to fallow fields
+	# by type code, so running it again updates the types rather than adding another copy of each
+	for name, type_code, efficiency in IRRIGATION_TYPES:
+		models.IrrigationType.objects.update_or_create(type_code=type_code, defaults={"name": name, "efficiency": efficiency})
 
 
 def load_crop_irrigation_types(crop_irrigation_type_file=settings.CROP_IRRIGATION_TYPE_DATA):
-	generic_csv_import(models.CropIrrigationTypePrior, crop_irrigation_type_file, {
-		"crop": {"Crop.liq_crop_id": "crop_code"},
-		"irrigation_type": {"IrrigationType.type_code": "irrigation_type"},
-		"probability": "probability",
-	})
+	generic_csv_import(models.CropIrrigationTypePrior, crop_irrigation_type_file, CROP_IRRIGATION_TYPE_FIELDS)
 
 def load_wells(well_file=settings.WELL_DATA):
-	generic_csv_import(models.Well, well_file, {
-		"well_id": "Well_Nbr",
-		"ucm_service_area_id": "ucm_well_service_area_id",
-		"apn": "APN",
-	})
+	generic_csv_import(models.Well, well_file, WELL_FIELDS)
 
 
 def load_et_data(agtimestep_file=settings.ET_DATA):
-	generic_csv_import(models.AgFieldTimestep, agtimestep_file, {
-		"agfield": {"AgField.liq_id": "UniqueID"},
-		"timestep": Constant(1),
-		"consumptive_use": "et",
-		"precip": "precip"
-	})
+	generic_csv_import(models.AgFieldTimestep, agtimestep_file, ET_FIELDS)
+
+
+def load_monthly_et_data(monthly_et_files=settings.MONTHLY_ET_DATA):
+	"""
+	:param monthly_et_files: {month: file} - each file has the same columns as the annual ET file
+	"""
+	for month, et_file in sorted(monthly_et_files.items()):
+		log.info(et_file)
+		generic_csv_import(models.AgFieldTimestep, et_file, monthly_et_fields(month))
 
 
 def override_service_areas():
@@ -0,0 +1,326 @@
+"""
+    Matrix form of the allocation LP. Instead of one scalar cvxpy Variable per pipe with a cvxsum constraint per
+    field and per well (see allocation.get_parts), this uses a single vector of pipe allocations and sparse
+    incidence matrices that map pipes to fields, wells, and crop tagged well production. The model is built
+    straight from a ModelInputs snapshot, so it doesn't hold on to any Django objects.
+"""
+
+import numpy
+from scipy import sparse
+
+from cvxpy import Problem, Variable, Parameter, Maximize, multiply, sum as cvxsum
+
+from . import instrumentation
+
+DEBUG_WATER_COST_MULTIPLIER = 1000  # debug water costs this many times the max benefit, so it's only used to make the model feasible
+FEASIBLE_STATUSES = ("optimal", "optimal_inaccurate")  # cvxpy statuses that come with allocations
+
+
+def incidence_matrix(rows, columns, num_rows, num_columns):
+    """
+        Builds a sparse 0/1 matrix with a 1 at each (row, column) pair
+    """
+    return sparse.csr_matrix((numpy.ones(len(rows)), (rows, columns)), shape=(num_rows, num_columns))
+
+
+def model_settings(max_benefit_distance, use_crop_constraints, add_debug, well_allocation_margin, single_crop_well_allocation_margin, field_demand_margin):
+    """
+        The settings that, along with the inputs, determine the model - used to fingerprint it for the solve cache.
+        Both AllocationLP and allocation.get_parts build the same model, so they share this
+    """
+    return {"max_benefit_distance": float(max_benefit_distance),
+            "use_crop_constraints": bool(use_crop_constraints),
+            "add_debug": bool(add_debug),
+            "well_allocation_margin": float(well_allocation_margin),
+            "single_crop_well_allocation_margin": float(single_crop_well_allocation_margin),
+            "field_demand_margin": float(field_demand_margin)}
+
+
+class AllocationLP(object):
+    """
+        Pipe allocations are the vector variable x, where x[i] is the water sent through pipe inputs.pipe_pks[i].
+        Rows of the incidence matrices only include the fields and wells that have pipes in the model (plus all
+        fields when add_debug is on, since they then get a debug supply), which matches the constraints
+        get_parts creates.
+
+        The model fields' irrigation efficiencies enter as a single vector Parameter of *inverse* efficiencies, in
+        the same order as field_ids. Writing the demand as field_demand * inverse_efficiency (a constant times a
+        parameter) rather than field_demand / efficiency (a parameter in a denominator) keeps the problem DPP
+        compliant, so cvxpy only canonicalizes it on the first solve and each Monte Carlo iteration after that just
+        updates the parameter values.
+
+        When the inputs have more than one timestep (e.g. months), the allocation vector has every pipe for each
+        timestep in turn, and each timestep gets its own field and well constraints from that timestep's demand and
+        production. The efficiencies are shared by all of the timesteps, so each efficiency sample is still a
+        single solve. Crop tagged production isn't by timestep, so its constraints are on the total over the
+        timesteps. Solutions, allocations and field_demand are totals over the timesteps, so results read the
+        same either way - Solution.timestep_allocations has the allocations by timestep.
+    """
+
+    def __init__(self, inputs,
+                 max_benefit_distance,
+                 use_crop_constraints=True,
+                 add_debug=False,
+                 well_allocation_margin=0,
+                 single_crop_well_allocation_margin=0,
+                 field_demand_margin=0.75):
+        self.inputs = inputs
+        self.max_benefit_distance = max_benefit_distance
+        self.use_crop_constraints = use_crop_constraints
+        self.add_debug = add_debug
+        self.well_allocation_margin = well_allocation_margin
+        self.single_crop_well_allocation_margin = single_crop_well_allocation_margin
+        self.field_demand_margin = field_demand_margin
+        self._fingerprint = None
+
+        num_pipes = inputs.num_pipes
+
+        # which fields and wells end up with constraints - in snapshot order
+        if add_debug:
+            self.field_index = numpy.arange(inputs.num_fields)
+        else:
+            self.field_index = numpy.unique(inputs.pipe_field_index)
+        self.well_index = numpy.unique(inputs.pipe_well_index)
+        field_rows = numpy.searchsorted(self.field_index, inputs.pipe_field_index)
+        well_rows = numpy.searchsorted(self.well_index, inputs.pipe_well_index)
+
+        self.field_incidence = incidence_matrix(field_rows, numpy.arange(num_pipes), len(self.field_index), num_pipes)
+        self.well_incidence = incidence_matrix(well_rows, numpy.arange(num_pipes), len(self.well_index), num_pipes)
+        self.crop_incidence, self.crop_production_index = self._crop_incidence()
+
+        self.field_demand = inputs.field_demand[self.field_index]
+        self.well_production = inputs.well_production[self.well_index]
+        self.crop_production = inputs.crop_production_quantity[self.crop_production_index]
+        self.num_timesteps = inputs.num_timesteps
+
+        self.build()
+
+    @property
+    def pipe_ids(self):
+        """
+            Index map from a position in the allocation vector to the Pipe's primary key
+        """
+        return self.inputs.pipe_pks
+
+    @property
+    def field_ids(self):
+        return self.inputs.field_ids[self.field_index]
+
+    @property
+    def well_ids(self):
+        return self.inputs.well_ids[self.well_index]
+
+    @property
+    def settings(self):
+        return model_settings(self.max_benefit_distance, self.use_crop_constraints, self.add_debug,
+                              self.well_allocation_margin, self.single_crop_well_allocation_margin, self.field_demand_margin)
+
+    @property
+    def fingerprint(self):
+        """
+            Fingerprint of the inputs and settings for the solve cache - computed on first use
+        """
+        if self._fingerprint is None:
+            self._fingerprint = self.inputs.fingerprint(self.settings)
+        return self._fingerprint
+
+    def _crop_incidence(self):
+        """
+            One row for each crop tagged production record whose well connects to a field with that crop - each
+            row selects the pipes from the well to fields with the crop
+        """
+        inputs = self.inputs
+        pipe_crops = inputs.field_crop_ids[inputs.pipe_field_index]
+        rows = []
+        columns = []
+        production_index = []
+        for record_index, (well_index, crop) in enumerate(zip(inputs.crop_production_well_index, inputs.crop_production_crop_ids)):
+            pipes = numpy.flatnonzero((inputs.pipe_well_index == well_index) & (pipe_crops == crop))
+            if len(pipes) == 0:  # the well doesn't connect to any fields with the crop in the model
+                continue
+            rows.append(numpy.full(len(pipes), len(production_index)))
+            columns.append(pipes)
+            production_index.append(record_index)
+
+        if len(production_index) == 0:
+            return incidence_matrix([], [], 0, inputs.num_pipes), numpy.zeros(0, dtype=numpy.int64)
+        return (incidence_matrix(numpy.concatenate(rows), numpy.concatenate(columns), len(production_index), inputs.num_pipes),
+                numpy.array(production_index, dtype=numpy.int64))
+
+    def _by_timestep(self, matrix):
+        """
+            Block diagonal copy of a per-pipe matrix with a block for each timestep, to apply to the allocation vector
+        """
+        if self.num_timesteps == 1:
+            return matrix
+        return sparse.block_diag([matrix] * self.num_timesteps, format="csr")
+
+    def build(self):
+        inputs = self.inputs
+        num_timesteps = self.num_timesteps
+        self.allocation = Variable(inputs.num_pipes * num_timesteps, name="pipe_allocations", nonneg=True)
+        self.inverse_efficiency = Parameter(len(self.field_index), name="inverse_irrigation_efficiency", nonneg=True, value=numpy.full(len(self.field_index), 1 / 0.75))
+        self._efficiencies = numpy.full(len(self.field_index), 0.75)
+
+        # benefit is the amount of water times the max distance we can send, and the cost is the amount of water times
+        # the distance of the pipe, so costs only exceed benefits if the water travels more than the max distance.
+        objective = numpy.tile(self.max_benefit_distance - inputs.pipe_distance, num_timesteps) @ self.allocation
+
+        field_supply = self._by_timestep(self.field_incidence) @ self.allocation
+        if self.add_debug:
+            # the debug supply only goes into the field's mass balance and has no limit, but is super high cost
+            self.debug_allocation = Variable(len(self.field_index) * num_timesteps, name="debug_allocations", nonneg=True)
+            field_supply = field_supply + self.debug_allocation
+            objective = objective - self.max_benefit_distance * DEBUG_WATER_COST_MULTIPLIER * cvxsum(self.debug_allocation)
+        else:
+            self.debug_allocation = None
+
+        # timestep by timestep, like the allocations - the efficiency is the same in each of them
+        field_demand = inputs.timestep_demand()[self.field_index].T.ravel()
+        well_production = inputs.timestep_production()[self.well_index].T.ravel()
+        if num_timesteps == 1:
+            inverse_efficiency = self.inverse_efficiency
+        else:
+            inverse_efficiency = sparse.vstack([sparse.identity(len(self.field_index))] * num_timesteps, format="csr") @ self.inverse_efficiency
+        demand = multiply(field_demand, inverse_efficiency)
+        well_supply = self._by_timestep(self.well_incidence) @ self.allocation
+        constraints = [
+            field_supply <= demand,
+            field_supply >= self.field_demand_margin * demand,
+            well_supply <= well_production,  # can't overallocate the well
+            well_supply >= self.well_allocation_margin * well_production,  # but make sure the water it produced is applied
+        ]
+
+        if self.use_crop_constraints and self.crop_incidence.shape[0] > 0:
+            crop_supply = sparse.hstack([self.crop_incidence] * num_timesteps, format="csr") @ self.allocation
+            constraints.append(crop_supply <= self.crop_production)
+            constraints.append(crop_supply >= self.single_crop_well_allocation_margin * self.crop_production)
+
+        self.problem = Problem(Maximize(objective), constraints)
+
+    def set_efficiencies(self, efficiencies):
+        """
+        :param efficiencies: irrigation efficiency for each of the model's fields, in field_ids order
+        """
+        self._efficiencies = numpy.array(efficiencies, dtype=numpy.float64)
+        self.inverse_efficiency.value = 1 / self._efficiencies
+
+    @property
+    def efficiencies(self):
+        return self._efficiencies  # as they were set, rather than 1 / inverse, so they key the solve cache exactly
+
+    @property
+    def demands(self):
+        """
+            Water each model field needs applied at its current irrigation efficiency
+        """
+        return self.field_demand * self.inverse_efficiency.value
+
+    @property
+    def num_variables(self):
+        return self.allocation.size + (0 if self.debug_allocation is None else self.debug_allocation.size)
+
+    def solve(self, solver_settings=None, **kwargs):
+        """
+            Solves the problem - after the first solve, cvxpy reuses the cached canonicalization and only
+            substitutes the new parameter values. Warm starts from the previous solution for solvers that support it.
+        :param solver_settings: optional solvers.SolverSettings to pick the solver and its options with - any
+                                kwargs are passed to Problem.solve on top of them
+        """
+        if solver_settings is not None:
+            kwargs = {**solver_settings.solve_kwargs(self.num_variables), **kwargs}
+        kwargs.setdefault("warm_start", True)
+        with instrumentation.span(instrumentation.SOLVE) as record:
+            value = self.problem.solve(**kwargs)
+            instrumentation.record_solve(self.problem, record)
+        return value
+
+    def _total(self, values):
+        """
+            Sums a vector with a value for each timestep in turn over the timesteps
+        """
+        if values is None or self.num_timesteps == 1:
+            return values
+        return values.reshape(self.num_timesteps, -1).sum(axis=0)
+
+    @property
+    def allocations(self):
+        return self._total(self.allocation.value)
+
+    @property
+    def timestep_allocations(self):
+        """
+            Allocations on each pipe in each timestep - pipes x timesteps
+        """
+        if self.allocation.value is None:
+            return None
+        return self.allocation.value.reshape(self.num_timesteps, -1).T
+
+    def solution(self):
+        """
+            Captures the current solve as a Solution
+        """
+        return Solution(status=self.problem.status,
+                        objective_value=self.problem.value,
+                        efficiencies=self.efficiencies,
+                        allocations=self.allocations,
+                        debug_allocations=None if self.debug_allocation is None else self._total(self.debug_allocation.value),
+                        timestep_allocations=self.timestep_allocations if self.num_timesteps > 1 else None)
+
+    def field_pipe_allocations(self, row, solution=None):
+        """
+            Allocations on each of the pipes into the model field at position row (closest first), plus the field's
+            debug water when add_debug is on
+        :param solution: a Solution to read the allocations from - defaults to the current solve
+        """
+        if solution is None:
+            solution = self.solution()
+        if solution.allocations is None:
+            return numpy.zeros(0)
+        pipes = self.field_incidence.indices[self.field_incidence.indptr[row]:self.field_incidence.indptr[row + 1]]
+        allocations = solution.allocations[pipes]
+        if solution.debug_allocations is not None:
+            allocations = numpy.append(allocations, solution.debug_allocations[row])
+        return allocations
+
+    @property
+    def field_allocations(self):
+        """
+            Total water allocated to each model field from its pipes (not including debug water)
+        """
+        if self.allocation.value is None:
+            return None
+        return self.field_incidence @ self.allocations
+
+    @property
+    def well_allocations(self):
+        if self.allocation.value is None:
+            return None
+        return self.well_incidence @ self.allocations
+
+
+class Solution(object):
+    """
+        The parts of a single solve that results are built from. Doesn't reference the cvxpy problem, so it's
+        small and picklable and can be sent back from a worker process.
+    """
+
+    def __init__(self, status, objective_value, efficiencies, allocations, debug_allocations=None, timestep_allocations=None):
+        """
+        :param timestep_allocations: pipes x timesteps allocations for models with more than one timestep -
+                                     allocations is their total. Not kept by the solve cache
+        """
+        self.status = status
+        self.objective_value = objective_value
+        self.efficiencies = numpy.array(efficiencies, dtype=numpy.float64)
+        self.allocations = None if allocations is None else numpy.array(allocations, dtype=numpy.float64)
+        self.debug_allocations = None if debug_allocations is None else numpy.array(debug_allocations, dtype=numpy.float64)
+        self.timestep_allocations = None if timestep_allocations is None else numpy.array(timestep_allocations, dtype=numpy.float64)
+
+    @property
+    def feasible(self):
+        """
+            Whether the solve found allocations - the check for every place results are recorded, so solver errors
+            and inaccurate infeasibility don't count as feasible anywhere
+        """
+        return self.status in FEASIBLE_STATUSES and self.allocations is not None
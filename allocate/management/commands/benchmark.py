@@ -0,0 +1,38 @@
+import importlib
+import json
+import logging
+
+from django.core.management.base import BaseCommand
+
+log = logging.getLogger(__name__)
+
+BENCHMARKS = ("monte_carlo", "query_plans", "sqlite_modes", "scaling", "solvers")
+
+
+class Command(BaseCommand):
+	help = 'Runs one of the benchmarks in allocate.benchmarks and prints its results as JSON'
+
+	def add_arguments(self, parser):
+		parser.add_argument('benchmark', type=str, choices=BENCHMARKS)
+		parser.add_argument('--fields', type=int, dest="fields", default=200, help="Number of fields in the synthetic service area")
+		parser.add_argument('--sizes', nargs='*', type=int, dest="sizes", default=None, help="Numbers of fields for the scaling benchmark - defaults to 100 1000 10000 100000")
+		parser.add_argument('--pipes_per_field', type=int, dest="pipes_per_field", default=5)
+		parser.add_argument('--iterations', type=int, dest="iterations", default=50, help="Number of Monte Carlo iterations to time")
+		parser.add_argument('--service_area', type=str, dest="service_area", default=None, help="Service area for the query_plans and sqlite_modes benchmarks - defaults to the one with the most pipes")
+		parser.add_argument('--service_areas', nargs='*', type=str, dest="service_areas", default=None, help="Service areas for the solvers benchmark - defaults to a synthetic one")
+		parser.add_argument('--solvers', nargs='*', type=str, dest="solvers_to_run", default=None, help="Solvers for the solvers benchmark - defaults to every installed LP solver")
+		parser.add_argument('--tolerance', type=float, dest="tolerance", default=None)
+		parser.add_argument('--time_limit', type=float, dest="time_limit", default=None)
+		parser.add_argument('--year', type=int, dest="year", default=2018)
+		parser.add_argument('--seed', type=int, dest="seed", default=20220330)
+		parser.add_argument('--output', type=str, dest="output", default=None, help="Also write the results to this JSON file")
+
+	def handle(self, *args, **options):
+		benchmark = importlib.import_module(f"allocate.benchmarks.{options['benchmark']}")
+		results = benchmark.run(**options)
+
+		output = json.dumps(results, indent=2)
+		self.stdout.write(output)
+		if options["output"] is not None:
+			with open(options["output"], 'w') as output_file:
+				output_file.write(output)
@@ -0,0 +1,28 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from allocate import allocation, pipes
+
+log = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+	help = 'Generates pipes from each field to its closest wells using the well and field coordinates'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--radius', type=float, dest="radius", default=allocation.MAX_BENEFIT_DISTANCE_METERS, help="Maximum pipe length in meters")
+		parser.add_argument('--max_wells', type=int, dest="max_wells", default=allocation.MAX_WELLS_PER_FIELD, help="Maximum number of pipes for each field")
+		parser.add_argument('--service_area', type=str, dest="service_area", default=None, help="Only generate pipes for the fields in this service area")
+		parser.add_argument('--same_service_area', action='store_true', dest="same_service_area", default=False, help="Only connect fields to wells in the same service area")
+		parser.add_argument('--replace', action='store_true', dest="replace", default=False, help="Delete the fields' existing pipes first")
+
+	def handle(self, *args, **options):
+		start = time.perf_counter()
+		count = pipes.generate_pipes(radius=options["radius"],
+									 max_wells_per_field=options["max_wells"],
+									 service_area=options["service_area"],
+									 same_service_area=options["same_service_area"],
+									 replace=options["replace"])
+		self.stdout.write(f"Generated {count} pipes in {time.perf_counter() - start:.1f} seconds")
@@ -1,7 +1,7 @@
 import logging
 from django.core.management.base import BaseCommand
 
-from allocate import load
+from allocate import incremental, load, parallel_load
 
 log = logging.getLogger(__name__)
 
@@ -20,5 +20,23 @@ class Command(BaseCommand):
 	#	parser.add_argument('--include_run_ids', nargs='*', type=int, dest="include_run_ids", help="A space separated list of run IDs on the remote server to include - defaults to including all runs if this is not specified. When specified, only the specified runs will be migrated", default=None,)
 	#	parser.add_argument('--dry_run', type=bool, dest="dry_run", required=False)
 
+	def add_arguments(self, parser):
+		parser.add_argument('--parallel', action='store_true', dest="parallel", default=False, help="Parse independent input files at the same time in worker processes")
+		parser.add_argument('--incremental', action='store_true', dest="incremental", default=False, help="Only load the changes in input files that changed since they were last loaded incrementally")
+		parser.add_argument('--workers', type=int, dest="workers", default=None, help="Number of parsing processes when using --parallel - defaults to the number of CPUs")
+
 	def handle(self, *args, **options):
-		load.load()
\ No newline at end of file
+		if options["incremental"]:
+			for stage, counts in incremental.load_incremental().items():
+				self.stdout.write(f"{stage}: {'unchanged' if counts is None else ', '.join(f'{count} {name}' for name, count in counts.items())}")
+			return
+
+		if not options["parallel"]:
+			load.load()
+			return
+
+		timings = parallel_load.load_parallel(workers=options["workers"])
+		self.stdout.write(f"{'stage':<24}{'rows':>10}{'parse (s)':>12}{'wait (s)':>12}{'write (s)':>12}")
+		for stage, timing in timings.items():
+			rows = "" if timing["rows"] is None else timing["rows"]
+			self.stdout.write(f"{stage:<24}{rows:>10}{timing['parse_seconds']:>12.2f}{timing['wait_seconds']:>12.2f}{timing['write_seconds']:>12.2f}")
\ No newline at end of file
@@ -0,0 +1,27 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from allocate import report
+
+log = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+	help = 'Reports the total supply and demand for every service area, and whether the model can allocate it'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--year', type=int, dest="year", default=2018, help="Production year for well supplies")
+		parser.add_argument('--timestep', type=int, dest="timestep", default=1, help="Field timestep for demands")
+		parser.add_argument('--format', type=str, dest="format", choices=("csv", "json"), default="csv")
+		parser.add_argument('--output', type=str, dest="output", default=None, help="File to write the report to - defaults to printing it")
+
+	def handle(self, *args, **options):
+		rows = report.service_area_totals(year=options["year"], timestep=options["timestep"])
+		write = report.write_csv if options["format"] == "csv" else report.write_json
+
+		if options["output"] is None:
+			write(rows, self.stdout)
+		else:
+			with open(options["output"], 'w', newline='') as output:
+				write(rows, output)
@@ -0,0 +1,40 @@
+import contextlib
+import logging
+from django.core.management.base import BaseCommand
+
+from allocate import batch, solvers, sqlite
+
+log = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+	help = 'Runs the Monte Carlo for every service area, spread across a pool of worker processes'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--output', type=str, dest="output", required=True, help="Folder to write results.jsonl and timings.csv to")
+		parser.add_argument('--workers', type=int, dest="workers", default=None, help="Number of worker processes - defaults to the number of cores")
+		parser.add_argument('--iterations', type=int, dest="iterations", default=None, help="Monte Carlo iterations for each service area")
+		parser.add_argument('--service_areas', nargs='*', type=str, dest="service_areas", default=None, help="A space separated list of service areas to run - defaults to all of them")
+		parser.add_argument('--no_crop_constraints', action='store_false', dest="use_crop_constraints")
+		parser.add_argument('--seed', type=str, dest="seed", default='20220330')
+		parser.add_argument('--solve_cache', type=str, dest="solve_cache", default=None, help="SQLite file to cache solves in, so reruns with unchanged inputs skip the solver")
+		parser.add_argument('--save_results', action='store_true', dest="save_results", default=False, help="Write each service area's best allocations and irrigation probabilities to the database")
+		parser.add_argument('--solver', type=str, dest="solver", default=solvers.AUTO, help="cvxpy solver to use - defaults to picking one of the installed LP solvers by the size of each service area")
+		parser.add_argument('--tolerance', type=float, dest="tolerance", default=None, help="Solver tolerance - defaults to the solver's own")
+		parser.add_argument('--time_limit', type=float, dest="time_limit", default=None, help="Seconds before each solve gives up")
+		parser.add_argument('--in_memory', action='store_true', dest="in_memory", default=False, help="Run from an in-memory copy of the SQLite database, writing the results back to it at the end")
+
+	def handle(self, *args, **options):
+		with sqlite.in_memory_copy() if options["in_memory"] else contextlib.nullcontext():
+			self.run(options)
+
+	def run(self, options):
+		batch.run_all_service_areas(options["output"],
+									workers=options["workers"],
+									iterations=options["iterations"],
+									use_crop_constraints=options["use_crop_constraints"],
+									service_areas=options["service_areas"],
+									random_seed=options["seed"],
+									solve_cache_path=options["solve_cache"],
+									save_results=options["save_results"],
+									solver_settings=solvers.SolverSettings(solver=options["solver"], tolerance=options["tolerance"], time_limit=options["time_limit"]))
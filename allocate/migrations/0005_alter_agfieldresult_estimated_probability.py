@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('allocate', '0004_well_production_type'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='agfieldresult',
+            name='estimated_probability',
+            field=models.DecimalField(decimal_places=5, max_digits=6),
+        ),
+    ]
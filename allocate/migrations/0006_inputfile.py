@@ -0,0 +1,23 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('allocate', '0005_alter_agfieldresult_estimated_probability'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InputFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.TextField(unique=True)),
+                ('model', models.TextField()),
+                ('sha256', models.CharField(max_length=64)),
+                ('rows', models.IntegerField(default=0)),
+                ('keys', models.BinaryField(null=True)),
+                ('loaded_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,31 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('allocate', '0006_inputfile'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='agfield',
+            index=models.Index(fields=['ucm_service_area_id'], name='agfield_service_area_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='well',
+            index=models.Index(fields=['ucm_service_area_id'], name='well_service_area_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='wellproduction',
+            index=models.Index(fields=['well', 'year', 'month', 'semi_year'], name='production_well_period_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='wellproduction',
+            index=models.Index(fields=['well', 'crop'], name='production_well_crop_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pipe',
+            index=models.Index(fields=['agfield', 'distance'], name='pipe_field_distance_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('allocate', '0007_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='agfield',
+            name='x',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='agfield',
+            name='y',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='well',
+            name='x',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='well',
+            name='y',
+            field=models.FloatField(null=True),
+        ),
+    ]
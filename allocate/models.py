@@ -1,4 +1,8 @@
+import math
+
+import numpy
 from django.db import models
+from django.db.models.functions import Cast, Greatest
 
 
 class Crop(models.Model):
@@ -32,10 +36,18 @@ class Well(models.Model):
         (UNMETERED, 'Unmetered Worksheet'),
     ]
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["ucm_service_area_id"], name="well_service_area_idx"),
+        ]
+
     well_id = models.TextField(unique=True)  # valley water's well identifier
     apn = models.TextField()
     ucm_service_area_id = models.TextField()  # our identifier for the service area this well is a part of
     production_type = models.PositiveSmallIntegerField(choices=METER_TYPES, default=METERED)
+    # projected coordinates in meters, for generating pipes - see pipes.py
+    x = models.FloatField(null=True)
+    y = models.FloatField(null=True)
 
     allocated_amount = models.DecimalField(max_digits=16, decimal_places=4, null=True)
 
@@ -46,42 +58,45 @@ class Well(models.Model):
             water savings for this well
         :return:
         """
-        return self.capacity - self.allocated_amount
+        return self.capacity - float(self.allocated_amount)
 
     @property
     def capacity(self):
-        # todo - make sure this sums up all of the production items below
-        return self.production.all().aggregate(models.Sum('quantity'))['quantity__sum']
-        #return self.production.all().values('quantity').annotate(capacity=models.Sum('quantity')).first().capacity
+        # sums up all of the production items below - read from the production cube rather than running an aggregate for each well
+        from .production import get_cube
+        capacity = get_cube().capacity([self.id])[0]
+        return None if math.isnan(capacity) else float(capacity)
 
     def _annual_production_only(self, year):
-        query = self.production.filter(year=year, month=None, semi_year=None)
-        if len(query) > 0:
-            return query.aggregate(models.Sum('quantity'))['quantity__sum']
+        from .production import get_cube, ANNUAL
+        return get_cube().production(self.id, year, ANNUAL)
 
     def _semi_year_production(self, year, semi_year):
         # not using this yet - only aggregating up to annual
-        query = self.production.filter(year=year, month=None, semi_year=semi_year)
-        if len(query) > 0:
-            return query.aggregate(models.Sum('quantity'))['quantity__sum']
+        from .production import get_cube, period_index
+        return get_cube().production(self.id, year, period_index(None, semi_year))
 
     def _monthly_production(self, year, month):
         # not using this yet - only aggregating up to annual
-        query = self.production.filter(year=year, month=month, semi_year=None)
-        if len(query) > 0:
-            return query.aggregate(models.Sum('quantity'))['quantity__sum']
+        from .production import get_cube, period_index
+        return get_cube().production(self.id, year, period_index(month, None))
 
     def annual_production(self, year):
-        ann_prod = self._annual_production_only(year)
-        if ann_prod is None:  # if we don't have annual data, aggregate the semi-annual data
-            query = self.production.filter(year=year, month=None)
-            if len(query) > 0:
-                return query.aggregate(models.Sum('quantity'))['quantity__sum']
-            else:  # and if we don't have that, then aggregate the monthly data for the year
-                return self.production.filter(year=year, semi_year=None).aggregate(models.Sum('quantity'))['quantity__sum']
+        # uses annual data if we have it, otherwise aggregates the semi-annual data, and if we don't have that,
+        # then the monthly data for the year. See production.ProductionCube.annual_production
+        from .production import get_cube
+        ann_prod = get_cube().annual_production([self.id], year)[0]
+        return None if math.isnan(ann_prod) else float(ann_prod)
 
 
 class WellProduction(models.Model):
+    class Meta:
+        indexes = [
+            # production for wells in a year, grouped by period - see production.ProductionCube.load
+            models.Index(fields=["well", "year", "month", "semi_year"], name="production_well_period_idx"),
+            # crop specific production for wells - see inputs.ModelInputs.load
+            models.Index(fields=["well", "crop"], name="production_well_crop_idx"),
+        ]
 
     well = models.ForeignKey(Well, on_delete=models.CASCADE, related_name="production")
     year = models.SmallIntegerField()
@@ -108,24 +123,93 @@ class CropIrrigationTypePrior(models.Model):
 
 
 class AgField(models.Model):
+    class Meta:
+        indexes = [
+            models.Index(fields=["ucm_service_area_id"], name="agfield_service_area_idx"),  # every model run loads a service area's fields
+        ]
+
     crop = models.ForeignKey(Crop, on_delete=models.SET_NULL, null=True)
     ucm_service_area_id = models.TextField()
     liq_id = models.TextField(unique=True)
     openet_id = models.TextField(null=True)
     acres = models.DecimalField(max_digits=10, decimal_places=4, null=False)
+    # projected coordinates of the field's centroid in meters, for generating pipes - see pipes.py
+    x = models.FloatField(null=True)
+    y = models.FloatField(null=True)
 
 
 class AgFieldResult(models.Model):
     agfield = models.ForeignKey(AgField, on_delete=models.CASCADE, related_name="results")
     irrigation_type = models.ForeignKey(IrrigationType, on_delete=models.CASCADE, related_name="results_by_field")
 
-    estimated_probability = models.DecimalField(max_digits=5, decimal_places=5)
+    estimated_probability = models.DecimalField(max_digits=6, decimal_places=5)  # needs a digit before the decimal so it can hold 1
+
+
+class AgFieldTimestepQuerySet(models.QuerySet):
+
+    def with_demand(self):
+        """
+            Annotates each timestep with demand_acre_feet - the same calculation as AgFieldTimestep.demand, but done
+            in the database, so it doesn't need the Decimal math or a fetch of the field for each timestep
+        """
+        net_demand = Cast(models.F("consumptive_use") - models.F("precip"), models.FloatField())
+        return self.annotate(demand_acre_feet=Greatest(net_demand, models.Value(0.0)) / models.Value(304.8) * Cast(models.F("agfield__acres"), models.FloatField()))
+
+    def demand_by_field(self, field_pks):
+        """
+            Demand for each field summed over the timesteps in the queryset - filter it to a single timestep for
+            that timestep's demand. One query for any number of fields.
+        :param field_pks: sorted array of the AgField primary keys to return demands for
+        :return: float array in field_pks order - 0 for fields without a timestep (assume unplanted)
+        """
+        field_pks = numpy.asarray(field_pks, dtype=numpy.int64)
+        demands = numpy.zeros(len(field_pks), dtype=numpy.float64)
+        rows = list(self.with_demand().values_list("agfield_id", "demand_acre_feet"))
+        if len(rows) == 0 or len(field_pks) == 0:
+            return demands
+
+        row_field_pks = numpy.array([row[0] for row in rows], dtype=numpy.int64)
+        positions = numpy.minimum(numpy.searchsorted(field_pks, row_field_pks), len(field_pks) - 1)
+        known = field_pks[positions] == row_field_pks  # skip timesteps for fields that weren't asked for
+        numpy.add.at(demands, positions[known], numpy.array([row[1] for row in rows], dtype=numpy.float64)[known])
+        return demands
+
+    def demand_by_field_and_timestep(self, field_pks, timesteps):
+        """
+            Demand for each field in each of the timesteps, from one query
+        :param field_pks: sorted array of the AgField primary keys to return demands for
+        :param timesteps: the timesteps to return, in the order of the columns
+        :return: fields x timesteps float array - 0 where a field doesn't have the timestep
+        """
+        field_pks = numpy.asarray(field_pks, dtype=numpy.int64)
+        timesteps = list(timesteps)
+        demands = numpy.zeros((len(field_pks), len(timesteps)), dtype=numpy.float64)
+        rows = list(self.filter(timestep__in=timesteps).with_demand().values_list("agfield_id", "timestep", "demand_acre_feet"))
+        if len(rows) == 0 or len(field_pks) == 0:
+            return demands
+
+        row_field_pks = numpy.array([row[0] for row in rows], dtype=numpy.int64)
+        positions = numpy.minimum(numpy.searchsorted(field_pks, row_field_pks), len(field_pks) - 1)
+        known = field_pks[positions] == row_field_pks
+        columns = numpy.array([timesteps.index(row[1]) for row in rows], dtype=numpy.int64)
+        numpy.add.at(demands, (positions[known], columns[known]), numpy.array([row[2] for row in rows], dtype=numpy.float64)[known])
+        return demands
 
 
 class AgFieldTimestep(models.Model):
+    """
+        Timestep 1 is the annual ET (load.load_et_data's default). Monthly ET is loaded as timesteps 101 (January)
+        through 112 (December), so a field can have both without them colliding - see month_timestep
+    """
     class Meta:
         unique_together = ["agfield", "timestep"]
 
+    ANNUAL = 1
+    MONTH_OFFSET = 100
+    MONTHS = tuple(range(MONTH_OFFSET + 1, MONTH_OFFSET + 13))
+
+    objects = AgFieldTimestepQuerySet.as_manager()
+
     agfield = models.ForeignKey(AgField, on_delete=models.CASCADE, related_name="timesteps")
     timestep = models.SmallIntegerField()
 
@@ -140,10 +224,25 @@ class AgFieldTimestep(models.Model):
         demand = feet_demand * float(self.agfield.acres)  # now multiple by acreage of the field to get the acre feet needed to satisfy remaining demand
         return demand
 
+    @classmethod
+    def month_timestep(cls, month):
+        return cls.MONTH_OFFSET + month
+
+    @classmethod
+    def timestep_month(cls, timestep):
+        """
+            Month (1-12) of a monthly timestep, or None for any other timestep
+        """
+        month = timestep - cls.MONTH_OFFSET
+        return month if 1 <= month <= 12 else None
+
 
 class Pipe(models.Model):
     class Meta:
         unique_together = ["well", "agfield"]
+        indexes = [
+            models.Index(fields=["agfield", "distance"], name="pipe_field_distance_idx"),  # each field's pipes, closest first
+        ]
 
     well = models.ForeignKey(Well, on_delete=models.CASCADE, related_name="pipes")
     agfield = models.ForeignKey(AgField, on_delete=models.CASCADE, related_name="pipes")
@@ -151,3 +250,16 @@ class Pipe(models.Model):
 
     variable_name = models.TextField(null=True)  # when the model runs, store the variable name for the pipe here
     allocation = models.DecimalField(max_digits=16, decimal_places=4, null=True)
+
+
+class InputFile(models.Model):
+    """
+        The last version of an input file that was loaded, so incremental loads can skip files that haven't changed
+        and know which rows came from the file when working out what to delete. See incremental.py
+    """
+    path = models.TextField(unique=True)
+    model = models.TextField()  # label of the model the file loads into
+    sha256 = models.CharField(max_length=64)
+    rows = models.IntegerField(default=0)
+    keys = models.BinaryField(null=True)  # zlib compressed JSON list of the natural keys loaded from the file
+    loaded_at = models.DateTimeField(auto_now=True)
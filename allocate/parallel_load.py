@@ -0,0 +1,224 @@
+"""
+    Loads the input data with independent stages running at the same time. load.load imports everything one file
+    after another, but most stages only need crops, wells and fields to exist first - the production files, ET and
+    pipes don't depend on each other at all. Here each stage lists the stages it depends on, and as soon as those are
+    written, its CSV is parsed and its foreign keys resolved in a worker process (with lookups loaded by the main
+    process, so the workers never touch the database). The workers send their rows back a chunk at a time through a
+    bounded queue and the main process writes each chunk as it arrives, so neither side ever holds a whole file.
+    Writing stays in the main process, so there's only ever one writer - which SQLite needs anyway.
+"""
+
+import functools
+import logging
+import multiprocessing
+import os
+import queue
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.db import models as django_models
+from django.db import transaction
+
+from WellAllocation import settings
+from . import allocation, load, models, pipes, production
+
+log = logging.getLogger(__name__)
+
+
+class Stage(object):
+    """
+        One step of the load - either a CSV to import into model with field_map (see load.read_values), or a
+        function to run in the main process (e.g. creating the irrigation types)
+    """
+
+    def __init__(self, name, model=None, csv_file=None, field_map=None, depends_on=(), run=None):
+        self.name = name
+        self.model = model
+        self.csv_file = csv_file
+        self.field_map = field_map
+        self.depends_on = tuple(depends_on)
+        self.run = run
+
+
+def build_stages(crop_file=settings.CROP_DATA,
+                 well_file=settings.WELL_DATA,
+                 production_files=settings.PRODUCTION_DATA_FILES,
+                 field_file=settings.FIELD_DATA,
+                 agtimestep_file=settings.ET_DATA,
+                 pipe_file=settings.PIPE_FILE,
+                 crop_irrigation_file=settings.CROP_IRRIGATION_TYPE_DATA,
+                 monthly_et_files=settings.MONTHLY_ET_DATA):
+    """
+        The stages of load.load and what each of them needs loaded first
+    :param pipe_file: the ArcGIS near table for the pipes - None generates them from the well and field coordinates
+    """
+    if pipe_file is None:
+        # replacing the fields' pipes means rerunning it after the wells or fields change (see incremental) also
+        # drops pipes to wells that moved out of range
+        pipe_stage = Stage("pipes", run=functools.partial(pipes.generate_pipes, replace=True), depends_on=["wells", "fields"])
+    else:
+        pipe_stage = Stage("pipes", models.Pipe, pipe_file, load.PIPE_FIELDS, depends_on=["wells", "fields"])
+
+    stages = [
+        Stage("crops", models.Crop, crop_file, load.CROP_FIELDS),
+        Stage("wells", models.Well, well_file, load.WELL_FIELDS),
+        Stage("irrigation_types", run=load.load_irrigation_types),
+        Stage("fields", models.AgField, field_file, load.FIELD_FIELDS, depends_on=["crops"]),
+        Stage("crop_irrigation_types", models.CropIrrigationTypePrior, crop_irrigation_file, load.CROP_IRRIGATION_TYPE_FIELDS, depends_on=["crops", "irrigation_types"]),
+        Stage("et", models.AgFieldTimestep, agtimestep_file, load.ET_FIELDS, depends_on=["fields"]),
+        pipe_stage,
+    ]
+    for month, et_file in sorted(monthly_et_files.items()):
+        stages.append(Stage(f"et_month_{month}", models.AgFieldTimestep, et_file, load.monthly_et_fields(month), depends_on=["fields"]))
+    for index, production_file in enumerate(production_files):
+        stages.append(Stage(f"production_{index}", models.WellProduction, production_file, load.PRODUCTION_FIELDS, depends_on=["wells", "crops"]))
+    return stages
+
+
+def check_stages(stages):
+    """
+        Makes sure the stage names are unique and every dependency exists and can be satisfied - otherwise the load
+        would stop partway through
+    """
+    names = [stage.name for stage in stages]
+    if len(set(names)) != len(names):
+        raise ValueError("Stage names must be unique")
+    for stage in stages:
+        missing = [dependency for dependency in stage.depends_on if dependency not in names]
+        if len(missing) > 0:
+            raise ValueError(f"Stage {stage.name} depends on stages that don't exist: {missing}")
+
+    done = set()
+    remaining = list(stages)
+    while len(remaining) > 0:
+        ready = [stage for stage in remaining if all(dependency in done for dependency in stage.depends_on)]
+        if len(ready) == 0:
+            raise ValueError(f"Stages have circular dependencies: {[stage.name for stage in remaining]}")
+        done.update(stage.name for stage in ready)
+        remaining = [stage for stage in remaining if stage not in ready]
+
+
+def field_attnames(model, field_map):
+    """
+        The model attribute names for the values parse_csv returns, in order
+    """
+    return [model._meta.get_field(name).attname for name in field_map]
+
+
+def parse_csv(csv_file, field_map, lookups, batch_size=load.IMPORT_BATCH_SIZE):
+    """
+        Reads a stage's CSV a chunk at a time
+    :param lookups: a load.LookupCache with the field map's lookups already loaded
+    :return: generator of lists of up to batch_size row value tuples, in field_attnames order - foreign keys are
+             returned as primary keys so the rows are cheap to send back to the main process
+    """
+    rows = []
+    with open(csv_file, 'r', newline='') as csv_data:
+        for values in load.read_values(csv_data, field_map, lookups):
+            rows.append(tuple(value.pk if isinstance(value, django_models.Model) else value for value in values.values()))
+            if len(rows) >= batch_size:
+                yield rows
+                rows = []
+    if len(rows) > 0:
+        yield rows
+
+
+def parse_stage(name, csv_file, field_map, lookups, chunks, batch_size=load.IMPORT_BATCH_SIZE):
+    """
+        Parses a stage's CSV in a worker process, putting each chunk of rows on the chunks queue as (name, rows)
+    :return: (number of rows, seconds spent parsing) - not counting time spent waiting for room on the queue
+    """
+    start = time.perf_counter()
+    rows = 0
+    waited = 0.0
+    for chunk in parse_csv(csv_file, field_map, lookups, batch_size):
+        put_start = time.perf_counter()
+        chunks.put((name, chunk))
+        waited += time.perf_counter() - put_start
+        rows += len(chunk)
+    return rows, time.perf_counter() - start - waited
+
+
+def write_rows(model, attnames, rows, batch_size=load.IMPORT_BATCH_SIZE):
+    """
+        Creates parsed rows, ignoring conflicts the same as generic_csv_import
+    """
+    with transaction.atomic():
+        for start in range(0, len(rows), batch_size):
+            model.objects.bulk_create([model(**dict(zip(attnames, row))) for row in rows[start:start + batch_size]], ignore_conflicts=True)
+
+
+def load_parallel(stages=None, workers=None, batch_size=load.IMPORT_BATCH_SIZE):
+    """
+        Runs the stages, starting each one once everything it depends on is written. The whole load is one
+        transaction, so if a stage fails, nothing is saved
+    :param stages: list of Stages - defaults to build_stages() with the files from the settings
+    :param workers: number of parsing processes - defaults to the number of CPUs
+    :param batch_size: rows per chunk sent back from the workers, and per bulk_create
+    :return: {stage name: {"rows", "parse_seconds", "wait_seconds", "write_seconds"}} - wait_seconds is the rest
+             of the time between starting the stage and finishing writing it, waiting for a free worker or for the
+             writer
+    """
+    if stages is None:
+        stages = build_stages()
+    check_stages(stages)
+    stages_by_name = {stage.name: stage for stage in stages}
+
+    start = time.perf_counter()
+    timings = {}
+    done = set()
+    pending = list(stages)
+    running = {}  # future: (stage, time submitted)
+    attnames = {stage.name: field_attnames(stage.model, stage.field_map) for stage in stages if stage.run is None}
+    write_seconds = {stage.name: 0.0 for stage in stages}
+    queue_size = 2 * (workers or os.cpu_count() or 1)  # enough to keep the writer busy - workers wait if it falls behind
+
+    # the manager shuts down before the pool does, so if writing fails, workers waiting on a full queue error out
+    # rather than waiting forever
+    with ProcessPoolExecutor(max_workers=workers, initializer=allocation.setup_worker_process) as executor, multiprocessing.Manager() as manager, transaction.atomic():
+        chunks = manager.Queue(maxsize=queue_size)
+        while len(pending) > 0 or len(running) > 0:
+            ready = [stage for stage in pending if all(dependency in done for dependency in stage.depends_on)]
+            ran_function = False
+            for stage in ready:
+                pending.remove(stage)
+                if stage.run is not None:  # nothing to parse, so just run it here
+                    stage_start = time.perf_counter()
+                    stage.run()
+                    timings[stage.name] = {"rows": None, "parse_seconds": 0.0, "wait_seconds": 0.0, "write_seconds": time.perf_counter() - stage_start}
+                    done.add(stage.name)
+                    ran_function = True
+                    continue
+                lookups = load.LookupCache()
+                lookups.preload(stage.field_map)
+                running[executor.submit(parse_stage, stage.name, stage.csv_file, stage.field_map, lookups, chunks, batch_size)] = (stage, time.perf_counter())
+            if ran_function:
+                continue  # a function stage finished, which may have made more stages ready
+
+            # a finished worker has already put all of its chunks on the queue, so once the queue's drained, the
+            # stages that had finished before it was are completely written
+            finished = [future for future in running if future.done()]
+            timeout = 0.1 if len(finished) == 0 else 0
+            while True:
+                try:
+                    name, rows = chunks.get(True, timeout)
+                except queue.Empty:
+                    break
+                write_start = time.perf_counter()
+                write_rows(stages_by_name[name].model, attnames[name], rows, batch_size=batch_size)
+                write_seconds[name] += time.perf_counter() - write_start
+                timeout = 0  # write whatever else is already waiting, then check on the workers again
+
+            for future in finished:
+                stage, submitted = running.pop(future)
+                rows, parse_seconds = future.result()
+                timings[stage.name] = {"rows": rows,
+                                       "parse_seconds": parse_seconds,
+                                       "wait_seconds": max(time.perf_counter() - submitted - parse_seconds - write_seconds[stage.name], 0.0),
+                                       "write_seconds": write_seconds[stage.name]}
+                done.add(stage.name)
+                log.info(f"{stage.name}: {rows} rows, parsed in {parse_seconds:.2f} seconds and written in {write_seconds[stage.name]:.2f}")
+
+    production.invalidate()  # bulk creates don't send signals, so drop the cached production cube ourselves
+    log.info(f"Loaded {len(stages)} stages in {time.perf_counter() - start:.1f} seconds")
+    return timings
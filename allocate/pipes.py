@@ -0,0 +1,100 @@
+"""
+    Generates pipes - the candidate well to field connections - from the well and field coordinates, instead of
+    loading them from the ArcGIS near table in PIPE_FILE. Wells go in a KD-tree and each field's closest wells
+    within the radius come from one vectorized query, so changing the distance cutoff is a rerun of this rather than
+    a trip through GIS. Coordinates need to be in a projected coordinate system in meters (field coordinates are the
+    centroids), since the pipe distances are straight line distances between them.
+"""
+
+import numpy
+from django.db import transaction
+from scipy.spatial import cKDTree
+
+from . import allocation, models
+
+PIPE_BATCH_SIZE = 5000
+
+
+def nearest_wells(field_coordinates, well_coordinates, radius, max_wells_per_field, field_groups=None, well_groups=None):
+    """
+        The closest wells to each field within the radius
+    :param field_coordinates: fields x 2 array of x, y
+    :param well_coordinates: wells x 2 array of x, y
+    :param max_wells_per_field: how many wells to keep for each field at most
+    :param field_groups: optional array with a group (e.g. service area) for each field - fields then only connect
+                         to wells with the same value in well_groups
+    :return: (field_index, well_index, distance) arrays, sorted by field and then distance
+    """
+    field_coordinates = numpy.asarray(field_coordinates, dtype=numpy.float64).reshape(-1, 2)
+    well_coordinates = numpy.asarray(well_coordinates, dtype=numpy.float64).reshape(-1, 2)
+    if field_groups is None:
+        return _query(field_coordinates, numpy.arange(len(field_coordinates)), well_coordinates, numpy.arange(len(well_coordinates)), radius, max_wells_per_field)
+
+    field_groups = numpy.asarray(field_groups)
+    well_groups = numpy.asarray(well_groups)
+    results = [_query(field_coordinates[field_groups == group], numpy.flatnonzero(field_groups == group),
+                      well_coordinates[well_groups == group], numpy.flatnonzero(well_groups == group), radius, max_wells_per_field)
+               for group in numpy.unique(field_groups)]
+    field_index, well_index, distance = (numpy.concatenate(parts) for parts in zip(*results)) if len(results) > 0 else _empty()
+    order = numpy.lexsort((distance, field_index))
+    return field_index[order], well_index[order], distance[order]
+
+
+def _empty():
+    return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.float64)
+
+
+def _query(field_coordinates, field_positions, well_coordinates, well_positions, radius, max_wells_per_field):
+    """
+        nearest_wells for one group - field_positions and well_positions map the rows back to the full arrays
+    """
+    if len(field_coordinates) == 0 or len(well_coordinates) == 0 or max_wells_per_field < 1:
+        return _empty()
+
+    k = min(max_wells_per_field, len(well_coordinates))
+    distances, wells = cKDTree(well_coordinates).query(field_coordinates, k=k, distance_upper_bound=radius, workers=-1)
+    distances = distances.reshape(len(field_coordinates), k)  # query drops the second axis when k is 1
+    wells = wells.reshape(len(field_coordinates), k)
+
+    found = numpy.isfinite(distances)  # wells past the radius come back with an infinite distance
+    fields = numpy.broadcast_to(numpy.arange(len(field_coordinates))[:, numpy.newaxis], found.shape)
+    return field_positions[fields[found]], well_positions[wells[found]], distances[found]
+
+
+def generate_pipes(radius=allocation.MAX_BENEFIT_DISTANCE_METERS, max_wells_per_field=allocation.MAX_WELLS_PER_FIELD, service_area=None,
+                   same_service_area=False, replace=False, batch_size=PIPE_BATCH_SIZE):
+    """
+        Creates a Pipe from each field to each of its max_wells_per_field closest wells within the radius. Fields
+        and wells without coordinates are skipped.
+    :param service_area: only generate pipes for the fields in this service area - they can still connect to wells
+                         in other service areas unless same_service_area is set
+    :param same_service_area: only connect fields to wells in their own service area
+    :param replace: delete the fields' existing pipes first - otherwise pipes that already exist are left as they are
+    :return: number of pipes generated
+    """
+    fields = models.AgField.objects.filter(x__isnull=False, y__isnull=False)
+    wells = models.Well.objects.filter(x__isnull=False, y__isnull=False)
+    if service_area is not None:
+        fields = fields.filter(ucm_service_area_id=service_area)
+        if same_service_area:
+            wells = wells.filter(ucm_service_area_id=service_area)
+
+    field_rows = list(fields.order_by("id").values_list("id", "x", "y", "ucm_service_area_id"))
+    well_rows = list(wells.order_by("id").values_list("id", "x", "y", "ucm_service_area_id"))
+    field_pks = numpy.array([row[0] for row in field_rows], dtype=numpy.int64)
+    well_pks = numpy.array([row[0] for row in well_rows], dtype=numpy.int64)
+    field_index, well_index, distance = nearest_wells([row[1:3] for row in field_rows], [row[1:3] for row in well_rows], radius, max_wells_per_field,
+                                                      field_groups=numpy.array([row[3] for row in field_rows], dtype=object) if same_service_area else None,
+                                                      well_groups=numpy.array([row[3] for row in well_rows], dtype=object) if same_service_area else None)
+
+    field_ids = field_pks[field_index].tolist()
+    well_ids = well_pks[well_index].tolist()
+    distances = numpy.round(distance, 4).tolist()
+    with transaction.atomic():
+        if replace:
+            models.Pipe.objects.filter(agfield__in=fields).delete()
+        for start in range(0, len(field_ids), batch_size):
+            models.Pipe.objects.bulk_create([models.Pipe(well_id=well_id, agfield_id=field_id, distance=pipe_distance)
+                                             for field_id, well_id, pipe_distance in zip(field_ids[start:start + batch_size], well_ids[start:start + batch_size], distances[start:start + batch_size])],
+                                            ignore_conflicts=True)
+    return len(field_ids)
@@ -0,0 +1,189 @@
+"""
+    Well production summarized as a wells x years x periods cube from a single GROUP BY over WellProduction, so
+    annual production, capacity and losses don't need their own queries for every well and year. Periods are the
+    annual records, the two semi-annual halves, the twelve months, records with only a semi year or only a month
+    that's out of range (e.g. semi_year 3 or month 13), and records with both a month and a semi year - those last
+    ones only count toward capacity, same as before.
+
+    Annual production uses the same fallback as the original Well.annual_production queries - the annual records if
+    the well has any for the year, otherwise every record without a month (the semi-annual records), otherwise every
+    record without a semi year (the monthly records). Out of range semi years and months are part of those totals,
+    same as they were in the queries. Whether a well "has" records of a kind is based on the number of records, not
+    the total, so records of 0 still count.
+"""
+
+import numpy
+from django.db.models import Count, Sum
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import models
+
+ANNUAL = 0
+SEMI_YEARS = slice(1, 3)  # semi_year 1 and 2
+MONTHS = slice(3, 15)  # month 1 through 12
+OTHER_SEMI_YEAR = 15  # no month and a semi year other than 1 or 2
+OTHER_MONTH = 16  # no semi year and a month other than 1 through 12
+OTHER = 17  # both a month and a semi year
+NUM_PERIODS = 18
+
+
+def period_index(month, semi_year):
+    """
+        Which period of the cube a record with the given month and semi_year goes in
+    """
+    if month is None and semi_year is None:
+        return ANNUAL
+    if month is None:
+        return SEMI_YEARS.start + semi_year - 1 if semi_year in (1, 2) else OTHER_SEMI_YEAR
+    if semi_year is None:
+        return MONTHS.start + month - 1 if 1 <= month <= 12 else OTHER_MONTH
+    return OTHER
+
+
+class ProductionCube(object):
+    """
+        quantities and records are wells x years x periods arrays of the total quantity and the number of
+        WellProduction records, with wells and years in sorted order (well_pks and years)
+    """
+
+    def __init__(self, well_pks, years, quantities, records):
+        self.well_pks = well_pks
+        self.years = years
+        self.quantities = quantities
+        self.records = records
+
+    @classmethod
+    def load(cls, wells=None, years=None):
+        """
+            Builds the cube with a single grouped query
+        :param wells: optional Well queryset to limit it to
+        :param years: optional list of years to limit it to
+        """
+        production = models.WellProduction.objects.all()
+        if wells is not None:
+            production = production.filter(well__in=wells)
+        if years is not None:
+            production = production.filter(year__in=years)
+
+        rows = list(production.order_by().values_list("well_id", "year", "month", "semi_year").annotate(total=Sum("quantity"), count=Count("id")))
+        well_pks = numpy.unique(numpy.array([row[0] for row in rows], dtype=numpy.int64))
+        all_years = numpy.unique(numpy.array([row[1] for row in rows], dtype=numpy.int64))
+
+        quantities = numpy.zeros((len(well_pks), len(all_years), NUM_PERIODS), dtype=numpy.float64)
+        records = numpy.zeros((len(well_pks), len(all_years), NUM_PERIODS), dtype=numpy.int64)
+        if len(rows) > 0:
+            cells = (numpy.searchsorted(well_pks, numpy.array([row[0] for row in rows], dtype=numpy.int64)),
+                     numpy.searchsorted(all_years, numpy.array([row[1] for row in rows], dtype=numpy.int64)),
+                     numpy.array([period_index(row[2], row[3]) for row in rows], dtype=numpy.int64))
+            numpy.add.at(quantities, cells, numpy.array([float(row[4]) for row in rows], dtype=numpy.float64))
+            numpy.add.at(records, cells, numpy.array([row[5] for row in rows], dtype=numpy.int64))
+
+        return cls(well_pks, all_years, quantities, records)
+
+    def _well_positions(self, well_pks):
+        well_pks = numpy.asarray(well_pks, dtype=numpy.int64)
+        positions = numpy.minimum(numpy.searchsorted(self.well_pks, well_pks), max(len(self.well_pks) - 1, 0))
+        found = (positions < len(self.well_pks)) & (self.well_pks[positions] == well_pks) if len(self.well_pks) > 0 else numpy.zeros(len(well_pks), dtype=bool)
+        return positions, found
+
+    def annual_production(self, well_pks, year):
+        """
+            Annual production for each of the wells in the year, with the annual -> semi-annual -> monthly fallback
+        :return: float array - NaN for wells without any production records for the year
+        """
+        result = numpy.full(len(well_pks), numpy.nan)
+        year_position = numpy.searchsorted(self.years, year)
+        if year_position >= len(self.years) or self.years[year_position] != year:
+            return result
+
+        positions, found = self._well_positions(well_pks)
+        quantities = self.quantities[positions[found], year_position]
+        records = self.records[positions[found], year_position]
+
+        # the fallbacks match the original month=None and semi_year=None filters, out of range values included
+        semi_annual_periods = [*range(SEMI_YEARS.start, SEMI_YEARS.stop), OTHER_SEMI_YEAR]
+        monthly_periods = [*range(MONTHS.start, MONTHS.stop), OTHER_MONTH]
+        annual = numpy.where(records[:, ANNUAL] > 0, quantities[:, ANNUAL], numpy.nan)
+        semi_annual = numpy.where(records[:, semi_annual_periods].sum(axis=1) > 0, quantities[:, semi_annual_periods].sum(axis=1), numpy.nan)
+        monthly = numpy.where(records[:, monthly_periods].sum(axis=1) > 0, quantities[:, monthly_periods].sum(axis=1), numpy.nan)
+        result[found] = numpy.where(~numpy.isnan(annual), annual, numpy.where(~numpy.isnan(semi_annual), semi_annual, monthly))
+        return result
+
+    def monthly_production(self, well_pks, year):
+        """
+            Production for each well in each month of the year - wells x 12, NaN where there's no monthly record
+        """
+        result = numpy.full((len(well_pks), 12), numpy.nan)
+        year_position = numpy.searchsorted(self.years, year)
+        if year_position >= len(self.years) or self.years[year_position] != year:
+            return result
+
+        positions, found = self._well_positions(well_pks)
+        months = self.quantities[positions[found], year_position, MONTHS]
+        result[found] = numpy.where(self.records[positions[found], year_position, MONTHS] > 0, months, numpy.nan)
+        return result
+
+    def monthly_production_with_fallback(self, well_pks, year):
+        """
+            Production for each well in each month of the year, for models with monthly timesteps. Wells with
+            monthly records use them, with 0 for months without a record. Wells without any monthly records for the
+            year get their annual production (see annual_production) spread evenly over the months.
+        :return: wells x 12 float array - NaN for wells without any production records for the year
+        """
+        monthly = self.monthly_production(well_pks, year)
+        has_months = ~numpy.isnan(monthly).all(axis=1)
+        spread = numpy.repeat((self.annual_production(well_pks, year) / 12)[:, numpy.newaxis], 12, axis=1)
+        return numpy.where(has_months[:, numpy.newaxis], numpy.nan_to_num(monthly, nan=0.0), spread)
+
+    def production(self, well_pk, year, period):
+        """
+            Total for a single well, year and period (ANNUAL, a semi year or month position, or one of the OTHER
+            periods - which lump together every out of range value of their kind)
+        :return: float, or None if the well has no records for it
+        """
+        positions, found = self._well_positions([well_pk])
+        year_position = numpy.searchsorted(self.years, year)
+        if not found[0] or year_position >= len(self.years) or self.years[year_position] != year:
+            return None
+        if self.records[positions[0], year_position, period] == 0:
+            return None
+        return float(self.quantities[positions[0], year_position, period])
+
+    def capacity(self, well_pks):
+        """
+            Total of all of each well's production records, every year and period
+        :return: float array - NaN for wells without any production records
+        """
+        positions, found = self._well_positions(well_pks)
+        result = numpy.full(len(well_pks), numpy.nan)
+        result[found] = self.quantities[positions[found]].sum(axis=(1, 2))
+        return result
+
+
+_cube = None
+
+
+def get_cube():
+    """
+        The cube for all wells - built on first use and kept until production changes
+    """
+    global _cube
+    if _cube is None:
+        _cube = ProductionCube.load()
+    return _cube
+
+
+def invalidate():
+    """
+        Drops the cached cube so the next use rebuilds it. Saves and deletes of WellProduction records do this
+        automatically, but bulk_create and queryset updates don't send signals, so loaders need to call it
+    """
+    global _cube
+    _cube = None
+
+
+@receiver(post_save, sender=models.WellProduction)
+@receiver(post_delete, sender=models.WellProduction)
+def _production_changed(sender, **kwargs):
+    invalidate()
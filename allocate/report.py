@@ -0,0 +1,66 @@
+"""
+    Supply and demand totals for every service area at once, to check which service areas the model can allocate.
+    Demand is summed per service area in the database, and supply comes from the production cube (one grouped
+    query) summed per service area, so the whole report is a few queries no matter how many areas there are.
+"""
+
+import csv
+import json
+
+import numpy
+from django.db.models import Sum
+
+from . import models
+from .production import ProductionCube
+
+OVERSUPPLY_RATIO = 1.35  # ranges skewed from irrigation efficiency
+UNDERSUPPLY_RATIO = 1
+
+COLUMNS = ("service_area", "supplies", "demands", "ratio", "status")
+
+
+def classify(ratio):
+    if ratio > OVERSUPPLY_RATIO:
+        return "Oversupply - Can't allocate"
+    elif ratio < UNDERSUPPLY_RATIO:
+        return "Undersupply - can't meet demand"
+    else:
+        return "OK"
+
+
+def service_area_totals(year=2018, timestep=1):
+    """
+        Supplies and demands for every service area with fields - demand from the fields in the area for the
+        timestep, and supply from the annual production of the wells in the area for the year
+    :return: list of dicts with COLUMNS, sorted by service area
+    """
+    demands = dict(models.AgFieldTimestep.objects.filter(timestep=timestep).with_demand()
+                   .values("agfield__ucm_service_area_id").order_by()
+                   .annotate(total=Sum("demand_acre_feet"))
+                   .values_list("agfield__ucm_service_area_id", "total"))
+
+    wells = list(models.Well.objects.order_by("id").values_list("id", "ucm_service_area_id"))
+    well_production = numpy.nan_to_num(ProductionCube.load(years=[year]).annual_production([well[0] for well in wells], year), nan=0.0)
+    supplies = {}
+    for (well_id, service_area), production in zip(wells, well_production):
+        supplies[service_area] = supplies.get(service_area, 0) + float(production)
+
+    rows = []
+    for service_area in sorted(models.AgField.objects.values_list("ucm_service_area_id", flat=True).distinct()):
+        demand = float(demands.get(service_area) or 0)
+        supply = supplies.get(service_area, 0.0)
+        ratio = supply / (demand if demand != 0 else 0.0001)
+        rows.append({"service_area": service_area, "supplies": supply, "demands": demand, "ratio": ratio, "status": classify(ratio)})
+    return rows
+
+
+def write_csv(rows, output):
+    writer = csv.DictWriter(output, fieldnames=COLUMNS)
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+def write_json(rows, output):
+    json.dump({"service_areas": rows,
+               "total_supply": sum(row["supplies"] for row in rows),
+               "total_demand": sum(row["demands"] for row in rows)}, output, indent=2)
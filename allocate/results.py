@@ -0,0 +1,255 @@
+"""
+    Columnar storage for Monte Carlo results. Rather than building result objects with lists of floats for every
+    field in every iteration, each iteration fills one row of preallocated NumPy arrays straight from the solution
+    vector - iterations x fields for efficiency, total allocation and net demand, and iterations x pipes for the
+    pipe allocations. ServiceAreaResult and FieldResult objects are only built on request for a single row.
+"""
+
+import csv
+
+import numpy
+
+from .lp import Solution
+
+
+class ResultStore(object):
+    """
+        Rows are iterations in the order they were added. Infeasible iterations (see Solution.feasible) still get a row, with
+        feasible set to False and NaN for everything else, so row numbers always line up with iteration numbers.
+
+        Arrays:
+            objective_values (iterations), statuses (iterations), feasible (iterations)
+            efficiencies, total_allocations, net_demands (iterations x fields, in lp.field_ids order)
+            pipe_allocations (iterations x pipes, in lp.pipe_ids order)
+            debug_allocations (iterations x fields - only when the model has debug water, otherwise None)
+
+        Total allocations include any debug water, same as FieldResult.total_allocations, and net demand is the
+        field's demand at the iteration's efficiency minus the total allocation.
+    """
+
+    def __init__(self, lp, capacity=1000):
+        """
+        :param lp: the AllocationLP the solutions come from - used for the field and pipe index maps
+        :param capacity: number of iterations to preallocate for - the arrays grow if more are added
+        """
+        self.lp = lp
+        self.field_ids = lp.field_ids
+        self.pipe_ids = lp.pipe_ids
+        self.size = 0
+
+        capacity = max(int(capacity), 1)
+        num_fields = len(self.field_ids)
+        num_pipes = len(self.pipe_ids)
+        self.objective_values = numpy.full(capacity, numpy.nan)
+        self.statuses = numpy.empty(capacity, dtype=object)
+        self.feasible = numpy.zeros(capacity, dtype=bool)
+        self.efficiencies = numpy.full((capacity, num_fields), numpy.nan)
+        self.total_allocations = numpy.full((capacity, num_fields), numpy.nan)
+        self.net_demands = numpy.full((capacity, num_fields), numpy.nan)
+        self.pipe_allocations = numpy.full((capacity, num_pipes), numpy.nan)
+        self.debug_allocations = numpy.full((capacity, num_fields), numpy.nan) if lp.add_debug else None
+
+    ARRAYS = ("objective_values", "statuses", "feasible", "efficiencies", "total_allocations", "net_demands", "pipe_allocations", "debug_allocations")
+
+    @property
+    def capacity(self):
+        return len(self.objective_values)
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def num_feasible(self):
+        return int(self.feasible[:self.size].sum())
+
+    def _grow(self):
+        for name in self.ARRAYS:
+            array = getattr(self, name)
+            if array is None:
+                continue
+            extra = numpy.empty_like(array)  # doubles the capacity
+            if array.dtype == numpy.float64:
+                extra.fill(numpy.nan)
+            elif array.dtype == bool:
+                extra.fill(False)
+            setattr(self, name, numpy.concatenate([array, extra]))
+
+    def add(self, solution):
+        """
+            Fills the next row from a Solution
+        :return: the row number
+        """
+        if self.size == self.capacity:
+            self._grow()
+        row = self.size
+        self.size += 1
+
+        self.statuses[row] = solution.status
+        self.efficiencies[row] = solution.efficiencies
+        if not solution.feasible:
+            return row
+
+        self.feasible[row] = True
+        self.objective_values[row] = solution.objective_value
+        self.pipe_allocations[row] = solution.allocations
+        self.total_allocations[row] = self.lp.field_incidence @ solution.allocations
+        if self.debug_allocations is not None:
+            self.debug_allocations[row] = solution.debug_allocations
+            self.total_allocations[row] += solution.debug_allocations
+        self.net_demands[row] = self.lp.field_demand / solution.efficiencies - self.total_allocations[row]
+        return row
+
+    @property
+    def best_index(self):
+        """
+            Row with the highest objective value, or None if no iteration was feasible
+        """
+        if self.num_feasible == 0:
+            return None
+        objective_values = numpy.where(self.feasible[:self.size], self.objective_values[:self.size], -numpy.inf)
+        return int(numpy.argmax(objective_values))
+
+    def solution(self, row):
+        """
+            Rebuilds the Solution for a row - e.g. to write the best iteration's allocations to the database
+        """
+        return Solution(status=self.statuses[row],
+                        objective_value=self.objective_values[row] if self.feasible[row] else None,
+                        efficiencies=self.efficiencies[row],
+                        allocations=self.pipe_allocations[row] if self.feasible[row] else None,
+                        debug_allocations=self.debug_allocations[row] if self.feasible[row] and self.debug_allocations is not None else None)
+
+    def result(self, row):
+        """
+            A ServiceAreaResult for a single row - built on request from the arrays
+        """
+        return ServiceAreaResult(self, row)
+
+    def __iter__(self):
+        """
+            ServiceAreaResults for the feasible rows, in order
+        """
+        for row in numpy.flatnonzero(self.feasible[:self.size]):
+            yield self.result(int(row))
+
+    def trimmed(self):
+        """
+            Dict of the arrays cut down to the rows that have been filled, plus the field and pipe ids
+        """
+        arrays = {name: getattr(self, name)[:self.size] for name in self.ARRAYS if getattr(self, name) is not None}
+        arrays["statuses"] = arrays["statuses"].astype(str)
+        arrays["field_ids"] = numpy.asarray(self.field_ids).astype(str)
+        arrays["pipe_ids"] = numpy.asarray(self.pipe_ids)
+        return arrays
+
+    def to_npz(self, path):
+        """
+            Saves all of the arrays, compressed. Load with numpy.load(path)
+        """
+        numpy.savez_compressed(path, **self.trimmed())
+
+    def field_rows(self):
+        """
+            One dict per feasible iteration and field - the long format that to_csv and to_parquet write
+        """
+        for row in numpy.flatnonzero(self.feasible[:self.size]):
+            for column, field in enumerate(self.field_ids):
+                total_allocation = float(self.total_allocations[row, column])
+                efficiency = float(self.efficiencies[row, column])
+                yield {"iteration": int(row),
+                       "field": str(field),
+                       "objective_value": float(self.objective_values[row]),
+                       "efficiency": efficiency,
+                       "allocation": total_allocation,
+                       "available_water": total_allocation * efficiency,
+                       "excess_demand": float(self.net_demands[row, column])}
+
+    FIELD_COLUMNS = ("iteration", "field", "objective_value", "efficiency", "allocation", "available_water", "excess_demand")
+
+    def to_csv(self, path):
+        with open(path, 'w', newline='') as fh:
+            writer = csv.DictWriter(fh, fieldnames=self.FIELD_COLUMNS)
+            writer.writeheader()
+            writer.writerows(self.field_rows())
+
+    def to_parquet(self, path):
+        """
+            Writes the field level results in long format (see field_rows) to a Parquet file. Needs pyarrow, which
+            isn't otherwise a requirement
+        """
+        try:
+            import pyarrow
+            from pyarrow import parquet
+        except ImportError:
+            raise ImportError("Writing Parquet files needs pyarrow - install it, or use to_npz instead")
+
+        feasible_rows = numpy.flatnonzero(self.feasible[:self.size])
+        num_fields = len(self.field_ids)
+        table = pyarrow.table({
+            "iteration": numpy.repeat(feasible_rows, num_fields),
+            "field": numpy.tile(numpy.asarray(self.field_ids).astype(str), len(feasible_rows)),
+            "objective_value": numpy.repeat(self.objective_values[feasible_rows], num_fields),
+            "efficiency": self.efficiencies[feasible_rows].ravel(),
+            "allocation": self.total_allocations[feasible_rows].ravel(),
+            "available_water": (self.total_allocations[feasible_rows] * self.efficiencies[feasible_rows]).ravel(),
+            "excess_demand": self.net_demands[feasible_rows].ravel(),
+        })
+        parquet.write_table(table, path)
+
+
+class ServiceAreaResult(object):
+    """
+        The field level results for all fields in the SA for a single run - a view of one row of a ResultStore
+    """
+
+    def __init__(self, store, row):
+        self.store = store
+        self.row = row
+        # objective value for the whole SA - False if the run wasn't feasible
+        self.objective_value = float(store.objective_values[row]) if store.feasible[row] else False
+
+    @property
+    def results(self):
+        """
+            FieldResults by field, skipping fields with no evaporative demand
+        """
+        store = self.store
+        lp = store.lp
+        results = {}
+        if self.objective_value is False:
+            return results
+
+        for column, field in enumerate(store.field_ids):
+            if lp.field_demand[column] == 0:
+                continue
+            pipes = lp.field_incidence.indices[lp.field_incidence.indptr[column]:lp.field_incidence.indptr[column + 1]]
+            allocations = store.pipe_allocations[self.row, pipes]
+            if store.debug_allocations is not None:
+                allocations = numpy.append(allocations, store.debug_allocations[self.row, column])
+            efficiency = store.efficiencies[self.row, column]
+            results[field] = FieldResult(field, self, allocations, lp.field_demand[column] / efficiency, efficiency)
+        return results
+
+
+class FieldResult(object):
+    field = None
+    # field - reference to Django object? or just the ID?
+    irrigation_efficiency_value = None
+    irrigation_type = None
+    net_water_demand = None  # net water demand - water demand remaining after allocation
+    service_area_result = None
+
+    def __init__(self, field, service_area_result, allocations, demand, irrigation_efficiency):
+        self.field = field
+        self.service_area_result = service_area_result
+        self.allocations = [float(item) for item in allocations]
+        self.net_water_demand = demand - sum(self.allocations)
+        self.irrigation_efficiency_value = irrigation_efficiency
+
+    @property
+    def total_allocations(self):
+        return sum(self.allocations)
+
+    @property
+    def result_dict(self):
+        return {'field': self.field, 'allocation': self.total_allocations, 'efficiency': self.irrigation_efficiency_value, 'available_water': self.total_allocations * self.irrigation_efficiency_value, 'excess_demand': self.net_water_demand}
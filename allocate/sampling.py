@@ -0,0 +1,137 @@
+"""
+    Draws irrigation efficiency samples for the Monte Carlo. Rather than calling numpy.random.choice once per field
+    per iteration, the sampler draws a whole iterations x fields block of choices at once with a seeded
+    numpy.random.Generator, so runs are reproducible and there's no per-field Python overhead in the loop.
+"""
+
+import itertools
+import math
+
+import numpy
+
+UNIFORM = "uniform"  # every irrigation option for a field is equally likely
+PRIOR = "prior"  # options are drawn with the field's prior probabilities
+SAMPLING_MODES = (UNIFORM, PRIOR)
+
+
+def option_indexes(options, option_counts, efficiencies):
+    """
+        Which of each field's options an efficiency is - the closest one, so small float differences don't matter
+    :param options: fields x max options array of efficiencies, padded past each field's option count
+    :param option_counts: number of real options for each field
+    :param efficiencies: efficiency for each field, or an iterations x fields block of them
+    :return: int array the same shape as efficiencies
+    """
+    efficiencies = numpy.asarray(efficiencies, dtype=numpy.float64)
+    distances = numpy.abs(options - efficiencies[..., numpy.newaxis])
+    distances[..., numpy.arange(options.shape[1]) >= numpy.asarray(option_counts)[:, numpy.newaxis]] = numpy.inf  # never match the padding
+    return numpy.argmin(distances, axis=-1)
+
+
+class EfficiencySampler(object):
+    """
+        Holds each field's options as padded (fields x max options) arrays so that a block of draws is a couple of
+        array operations. Draws are made in chunks of chunk_size iterations to keep memory bounded for long runs.
+    """
+
+    def __init__(self, efficiencies, probabilities=None, generator=None, mode=UNIFORM, chunk_size=1000):
+        """
+        :param efficiencies: list with the list of efficiency options for each field
+        :param probabilities: list with the prior probabilities for each field's options - needed for PRIOR mode.
+                              They don't need to sum to 1 - they're normalized for each field
+        :param generator: numpy.random.Generator to draw from - or a seed for one
+        :param mode: UNIFORM or PRIOR
+        :param chunk_size: maximum number of iterations to draw at once
+        """
+        if mode not in SAMPLING_MODES:
+            raise ValueError(f"Sampling mode must be one of {SAMPLING_MODES}, not {mode}")
+        if mode == PRIOR and probabilities is None:
+            raise ValueError("Prior sampling needs the probabilities for each field's options")
+
+        self.mode = mode
+        self.chunk_size = chunk_size
+        self.generator = numpy.random.default_rng(generator)
+
+        self.num_fields = len(efficiencies)
+        self.option_counts = numpy.array([len(options) for options in efficiencies], dtype=numpy.int64)
+        if numpy.any(self.option_counts == 0):
+            raise ValueError("Every field needs at least one efficiency option")
+        max_options = int(self.option_counts.max()) if self.num_fields > 0 else 1
+
+        self.options = numpy.zeros((self.num_fields, max_options), dtype=numpy.float64)
+        for field, options in enumerate(efficiencies):
+            self.options[field, :len(options)] = options
+
+        if mode == PRIOR:
+            # cumulative probabilities, with the padding set to 1 so it's never chosen
+            self.cumulative_probabilities = numpy.ones((self.num_fields, max_options), dtype=numpy.float64)
+            for field, field_probabilities in enumerate(probabilities):
+                field_probabilities = numpy.asarray(field_probabilities, dtype=numpy.float64)
+                self.cumulative_probabilities[field, :len(field_probabilities)] = numpy.cumsum(field_probabilities) / field_probabilities.sum()
+
+    @classmethod
+    def for_fields(cls, efficiency_information, field_ids, **kwargs):
+        """
+            Builds the sampler from MonteCarloController.get_combinations output for the given fields, in order
+        """
+        return cls([efficiency_information[field]["efficiencies"] for field in field_ids],
+                   [efficiency_information[field]["probabilities"] for field in field_ids],
+                   **kwargs)
+
+    def draw_indexes(self, iterations):
+        """
+            Option indexes for each field for a block of iterations
+        :return: int array of shape (iterations, fields)
+        """
+        draws = self.generator.random((iterations, self.num_fields))
+        if self.mode == UNIFORM:
+            return numpy.minimum((draws * self.option_counts).astype(numpy.int64), self.option_counts - 1)
+        else:
+            indexes = (draws[:, :, numpy.newaxis] >= self.cumulative_probabilities[numpy.newaxis, :, :]).sum(axis=2)
+            return numpy.minimum(indexes, self.option_counts - 1)  # guard against rounding in the cumulative sums
+
+    def efficiencies(self, indexes):
+        """
+            Looks up the efficiency values for a block of option indexes from draw_indexes
+        """
+        return self.options[numpy.arange(self.num_fields), indexes]
+
+    def option_indexes(self, efficiencies):
+        """
+            Reverse of efficiencies - option indexes for each field's efficiency
+        """
+        return option_indexes(self.options, self.option_counts, efficiencies)
+
+    def draw(self, iterations):
+        """
+            Efficiencies for each field for a block of iterations
+        :return: float array of shape (iterations, fields)
+        """
+        return self.efficiencies(self.draw_indexes(iterations))
+
+    @property
+    def num_combinations(self):
+        """
+            How many distinct combinations of efficiency options there are across all fields
+        """
+        return math.prod(int(count) for count in self.option_counts)
+
+    def all_combinations(self):
+        """
+            Every combination of the fields' options, for brute forcing small service areas, as
+            (indexes, efficiencies) with one row per combination
+        """
+        # with no fields there's a single, empty, combination - reshape can't infer that shape from -1
+        indexes = numpy.array(list(itertools.product(*[range(count) for count in self.option_counts])), dtype=numpy.int64).reshape(self.num_combinations, self.num_fields)
+        return indexes, self.efficiencies(indexes)
+
+    def chunks(self, iterations):
+        """
+            Yields (indexes, efficiencies) blocks of up to chunk_size iterations until iterations have been drawn
+        """
+        remaining = iterations
+        while remaining > 0:
+            size = min(self.chunk_size, remaining)
+            indexes = self.draw_indexes(size)
+            yield indexes, self.efficiencies(indexes)
+            remaining -= size
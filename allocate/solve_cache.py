@@ -0,0 +1,208 @@
+"""
+    Keeps solved allocation problems on disk so that repeated runs don't re-solve the same problem. Entries are keyed
+    by a fingerprint of the model inputs and settings (see ModelInputs.fingerprint) plus the irrigation efficiencies
+    for the solve, so any change to the data - reloading production, new pipes, a different margin - gives new keys
+    and the old entries just age out. Only optimal solves are stored - anything else could be down to the solver
+    settings (a time limit, a loose tolerance) rather than the model, so it's solved again next time. Entries live
+    in their own SQLite file rather than the Django database since they're a cache, not model data, and are evicted
+    least recently used first once the cache is over its limits.
+"""
+
+import hashlib
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+import numpy
+
+from . import instrumentation
+from .lp import Solution
+
+CACHE_VERSION = 1  # bump this if what's stored for a solve changes, so older entries stop matching
+CACHED_STATUS = "optimal"  # the only status cached_solve stores
+
+
+class SolveCache(object):
+    """
+        Usage:
+            cache = SolveCache("solve_cache.sqlite3")
+            solution, solved = cached_solve(lp, cache)
+
+        The connection is opened lazily in each process, so a SolveCache can be pickled and handed to worker
+        processes - SQLite's locking takes care of several processes writing to the same file.
+    """
+
+    def __init__(self, path, max_entries=100000, max_bytes=1024 ** 3, evict_every=100):
+        """
+        :param path: the SQLite file to store the cache in - created if it doesn't exist
+        :param max_entries: maximum number of solves to keep
+        :param max_bytes: maximum total size of the stored solutions
+        :param evict_every: how many puts to wait between checking the limits - checking sums over the whole table
+        """
+        self.path = os.fspath(path)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._connection = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_connection"] = None  # connections can't cross processes - the worker opens its own
+        state["_pid"] = None
+        return state
+
+    @property
+    def connection(self):
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS solves (
+                                            key TEXT PRIMARY KEY,
+                                            status TEXT,
+                                            objective_value REAL,
+                                            efficiencies BLOB,
+                                            allocations BLOB,
+                                            debug_allocations BLOB,
+                                            size INTEGER,
+                                            last_used REAL)""")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS solves_last_used ON solves (last_used)")
+            self._pid = os.getpid()
+        return self._connection
+
+    @staticmethod
+    def key(fingerprint, efficiencies):
+        """
+            Cache key for a solve of the model with the given fingerprint at the given efficiencies
+        """
+        digest = hashlib.sha256(f"{CACHE_VERSION}:{fingerprint}:".encode("utf-8"))
+        digest.update(numpy.ascontiguousarray(efficiencies, dtype=numpy.float64).tobytes())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+            Returns the cached Solution for the key, or None if it isn't in the cache
+        """
+        row = self.connection.execute("SELECT status, objective_value, efficiencies, allocations, debug_allocations FROM solves WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.connection.execute("UPDATE solves SET last_used = ? WHERE key = ?", (time.time(), key))
+        status, objective_value, efficiencies, allocations, debug_allocations = row
+        return Solution(status=status,
+                        objective_value=objective_value,
+                        efficiencies=_from_blob(efficiencies),
+                        allocations=_from_blob(allocations),
+                        debug_allocations=_from_blob(debug_allocations))
+
+    def put(self, key, solution):
+        blobs = [_to_blob(solution.efficiencies), _to_blob(solution.allocations), _to_blob(solution.debug_allocations)]
+        size = sum(len(blob) for blob in blobs if blob is not None)
+        objective_value = None if solution.objective_value is None else float(solution.objective_value)
+        self.connection.execute("INSERT OR REPLACE INTO solves VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                (key, solution.status, objective_value, *blobs, size, time.time()))
+
+        self._puts += 1
+        if self._puts % self.evict_every == 0:
+            self.evict()
+
+    def evict(self):
+        """
+            Deletes the least recently used entries until the cache is within max_entries and max_bytes
+        :return: number of entries deleted
+        """
+        entries, total_bytes = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM solves").fetchone()
+        if entries <= self.max_entries and total_bytes <= self.max_bytes:
+            return 0
+
+        # walk the entries from most recently used and keep them until we hit a limit - everything older goes
+        kept_entries = 0
+        kept_bytes = 0
+        cutoff = None
+        for last_used, size in self.connection.execute("SELECT last_used, size FROM solves ORDER BY last_used DESC"):
+            if kept_entries + 1 > self.max_entries or kept_bytes + size > self.max_bytes:
+                cutoff = last_used
+                break
+            kept_entries += 1
+            kept_bytes += size
+
+        if cutoff is None:
+            return 0
+        return self.connection.execute("DELETE FROM solves WHERE last_used <= ?", (cutoff,)).rowcount
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM solves").fetchone()[0]
+
+    def clear(self):
+        self.connection.execute("DELETE FROM solves")
+
+
+class SolutionMemo(object):
+    """
+        In-process memo of the solves in a run, keyed by the efficiencies, so repeated samples don't need to be
+        solved again. Each entry holds a full Solution, so the memo keeps at most max_size of them and drops the least
+        recently used past that - a long run with mostly unique samples would otherwise keep every solve.
+    """
+
+    def __init__(self, max_size=1000):
+        """
+        :param max_size: number of solves to keep - 0 turns the memo off
+        """
+        self.max_size = max_size
+        self._solutions = OrderedDict()
+
+    @staticmethod
+    def key(efficiencies):
+        return numpy.asarray(efficiencies, dtype=numpy.float64).tobytes()
+
+    def get(self, key):
+        solution = self._solutions.get(key)
+        if solution is not None:
+            self._solutions.move_to_end(key)
+        return solution
+
+    def put(self, key, solution):
+        if self.max_size < 1:
+            return
+        self._solutions[key] = solution
+        self._solutions.move_to_end(key)
+        while len(self._solutions) > self.max_size:
+            self._solutions.popitem(last=False)
+
+    def __len__(self):
+        return len(self._solutions)
+
+
+def cached_solve(lp, solve_cache=None, solver_settings=None):
+    """
+        Solves the AllocationLP at its current efficiencies, unless the cache already has the solve
+    :param solve_cache: a SolveCache, or None to always solve
+    :param solver_settings: optional solvers.SolverSettings for the solve
+    :return: (Solution, whether the solver actually ran)
+    """
+    if solve_cache is not None:
+        key = solve_cache.key(lp.fingerprint, lp.efficiencies)
+        solution = solve_cache.get(key)
+        if solution is not None:
+            return solution, False
+
+    lp.solve(solver_settings)
+    with instrumentation.span(instrumentation.EXTRACT):
+        solution = lp.solution()
+    if solve_cache is not None and solution.status == CACHED_STATUS:
+        solve_cache.put(key, solution)
+    return solution, True
+
+
+def _to_blob(values):
+    return None if values is None else numpy.ascontiguousarray(values, dtype=numpy.float64).tobytes()
+
+
+def _from_blob(blob):
+    return None if blob is None else numpy.frombuffer(blob, dtype=numpy.float64).copy()
@@ -0,0 +1,109 @@
+"""
+    Which solver cvxpy uses for the allocation LP, and with what tolerances, time limit and warm start. Left to
+    itself, cvxpy picks a general conic solver - the model is a pure LP, so a dedicated LP solver is usually much
+    faster. With AUTO, the solver is picked from the installed LP solvers by the number of variables in the problem.
+"""
+
+import cvxpy
+
+AUTO = "auto"
+LP_SOLVERS = ("HIGHS", "CLARABEL", "ECOS", "SCS", "OSQP")
+
+# preference order for AUTO by problem size - (up to this many variables, solvers to try in order). Small problems
+# go to HiGHS, whose simplex restarts from the previous basis when a Monte Carlo run re-solves with new
+# efficiencies. Simplex iteration counts grow with the problem, so big ones go to CLARABEL's interior point method
+# first. ECOS slows down a lot on big problems, where the first order solvers (SCS, OSQP) are the fallback
+AUTO_ORDER = (
+    (20000, ("HIGHS", "CLARABEL", "ECOS", "SCS", "OSQP")),
+    (None, ("CLARABEL", "HIGHS", "SCS", "OSQP", "ECOS")),
+)
+
+# the solvers' own names for the tolerance and time limit options
+TOLERANCE_OPTIONS = {
+    "HIGHS": ("primal_feasibility_tolerance", "dual_feasibility_tolerance"),
+    "CLARABEL": ("tol_gap_abs", "tol_gap_rel", "tol_feas"),
+    "ECOS": ("abstol", "reltol", "feastol"),
+    "SCS": ("eps_abs", "eps_rel"),
+    "OSQP": ("eps_abs", "eps_rel"),
+}
+TIME_LIMIT_OPTIONS = {
+    "HIGHS": "time_limit",
+    "CLARABEL": "time_limit",
+    "SCS": "time_limit_secs",
+    "OSQP": "time_limit",
+}
+
+
+def available_solvers():
+    """
+        The LP_SOLVERS that are installed, in LP_SOLVERS order
+    """
+    installed = cvxpy.installed_solvers()
+    return [solver for solver in LP_SOLVERS if solver in installed]
+
+
+class SolverSettings(object):
+    """
+        Picklable, so it can go to worker processes along with the model inputs
+    """
+
+    def __init__(self, solver=AUTO, tolerance=None, time_limit=None, warm_start=True, verbose=False, options=None):
+        """
+        :param solver: a cvxpy solver name, AUTO to pick one by problem size, or None to let cvxpy choose
+        :param tolerance: feasibility/optimality tolerance, set on each of the solver's tolerance options - None
+                          keeps the solver's defaults
+        :param time_limit: seconds before the solver gives up - ignored for solvers without one (ECOS)
+        :param warm_start: start each solve from the previous solution, for solvers that support it
+        :param options: any other solver specific options to pass to the solve
+        """
+        self.solver = solver
+        self.tolerance = tolerance
+        self.time_limit = time_limit
+        self.warm_start = warm_start
+        self.verbose = verbose
+        self.options = {} if options is None else dict(options)
+        self._available = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_available"] = None  # the worker checks for itself
+        return state
+
+    def choose(self, num_variables):
+        """
+            The solver to use for a problem with this many variables
+        """
+        if self.solver != AUTO:
+            return self.solver
+        if self._available is None:
+            self._available = available_solvers()
+        for max_variables, order in AUTO_ORDER:
+            if max_variables is None or num_variables <= max_variables:
+                for solver in order:
+                    if solver in self._available:
+                        return solver
+        return None  # none of them are installed, so leave it to cvxpy
+
+    def solve_kwargs(self, num_variables):
+        """
+            Keyword arguments for Problem.solve
+        """
+        solver = self.choose(num_variables)
+        kwargs = {"warm_start": self.warm_start, "verbose": self.verbose}
+        if solver is not None:
+            kwargs["solver"] = solver
+            if self.tolerance is not None:
+                kwargs.update({option: self.tolerance for option in TOLERANCE_OPTIONS.get(solver, ())})
+            if self.time_limit is not None and solver in TIME_LIMIT_OPTIONS:
+                kwargs[TIME_LIMIT_OPTIONS[solver]] = self.time_limit
+        kwargs.update(self.options)
+        return kwargs
+
+    def solve(self, problem, num_variables=None):
+        """
+            Solves a cvxpy Problem with these settings
+        :param num_variables: the problem's size, if the caller already knows it - otherwise from its size metrics
+        """
+        if num_variables is None:
+            num_variables = problem.size_metrics.num_scalar_variables
+        return problem.solve(**self.solve_kwargs(num_variables))
@@ -0,0 +1,155 @@
+"""
+    SQLite tuning for model runs. settings.SQLITE_PRAGMAS are applied to every new SQLite connection (WAL so a long
+    run reading the database doesn't block a load writing to it, or the other way around, plus a bigger page cache
+    and memory mapping), and in_memory_copy swaps the connection over to an in-memory copy of the database for the
+    length of a read heavy run. The copy is read at memory speed, and when the run's done, only the results the run
+    wrote are copied back to the file in a single transaction.
+"""
+
+import logging
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from . import models
+
+log = logging.getLogger(__name__)
+
+WRITE_BACK_MODELS = (models.Pipe, models.Well, models.AgFieldResult)  # the tables writer.write_results writes to
+WRITE_BACK_COLUMNS = {  # the result columns of the existing rows that writer.write_results updates
+    models.Pipe: ("allocation", "variable_name"),
+    models.Well: ("allocated_amount",),
+}
+WRITE_BACK_BATCH_SIZE = 500
+
+
+def apply_pragmas(connection, pragmas=None):
+    """
+    :param connection: a Django SQLite connection
+    :param pragmas: {pragma: value} - defaults to settings.SQLITE_PRAGMAS
+    """
+    if pragmas is None:
+        pragmas = getattr(settings, "SQLITE_PRAGMAS", None) or {}
+    with connection.cursor() as cursor:
+        for pragma, value in pragmas.items():
+            cursor.execute(f"PRAGMA {pragma} = {value}")
+
+
+@receiver(connection_created)
+def _connection_created(sender, connection, **kwargs):
+    if connection.vendor == "sqlite":
+        apply_pragmas(connection)
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def write_back(source, destination, write_models=WRITE_BACK_MODELS, batch_size=WRITE_BACK_BATCH_SIZE):
+    """
+        Copies the results in source over to destination, all in one transaction (a savepoint, so it also works if
+        destination is already in a transaction). For Pipes and Wells, only the WRITE_BACK_COLUMNS of rows that exist
+        in both and differ are updated. AgFieldResults are only written for fields whose results in source differ from
+        the ones in destination - they replace that field's results, like write_results does. Nothing else is
+        inserted or deleted, so rows another process wrote to the file in the meantime are left alone.
+    :param source: raw sqlite3 connection to copy from
+    :param destination: raw sqlite3 connection to write to
+    :return: {table: number of rows written}
+    """
+    counts = {}
+    destination.execute("SAVEPOINT allocate_write_back")
+    try:
+        for model in write_models:
+            if model is models.AgFieldResult:
+                written = _write_back_field_results(source, destination, batch_size)
+            else:
+                written = _write_back_columns(model, WRITE_BACK_COLUMNS[model], source, destination, batch_size)
+            counts[model._meta.db_table] = written
+    except Exception:
+        destination.execute("ROLLBACK TO SAVEPOINT allocate_write_back")
+        destination.execute("RELEASE SAVEPOINT allocate_write_back")
+        raise
+    destination.execute("RELEASE SAVEPOINT allocate_write_back")
+    return counts
+
+
+def _write_back_columns(model, field_names, source, destination, batch_size):
+    table = _quote(model._meta.db_table)
+    pk = _quote(model._meta.pk.column)
+    columns = [_quote(model._meta.get_field(name).column) for name in field_names]
+    select = f"SELECT {pk}, {', '.join(columns)} FROM {table}"
+
+    destination_rows = {row[0]: row[1:] for row in destination.execute(select)}
+    changed = [row[1:] + row[:1] for row in source.execute(select) if row[0] in destination_rows and destination_rows[row[0]] != row[1:]]
+    update = f"UPDATE {table} SET {', '.join(f'{column} = ?' for column in columns)} WHERE {pk} = ?"
+    for start in range(0, len(changed), batch_size):
+        destination.executemany(update, changed[start:start + batch_size])
+    return len(changed)
+
+
+def _field_results(connection):
+    """
+        {agfield_id: sorted [(irrigation_type_id, estimated_probability), ...]}
+    """
+    results = {}
+    for agfield_id, irrigation_type_id, probability in connection.execute(f"SELECT agfield_id, irrigation_type_id, estimated_probability FROM {_quote(models.AgFieldResult._meta.db_table)}"):
+        results.setdefault(agfield_id, []).append((irrigation_type_id, probability))
+    return {agfield_id: sorted(rows) for agfield_id, rows in results.items()}
+
+
+def _write_back_field_results(source, destination, batch_size):
+    table = _quote(models.AgFieldResult._meta.db_table)
+    destination_results = _field_results(destination)
+    run_results = {agfield_id: rows for agfield_id, rows in _field_results(source).items() if destination_results.get(agfield_id) != rows}
+
+    # new ids come from destination, since another process may have used the ones the copy handed out
+    field_ids = [(agfield_id,) for agfield_id in run_results]
+    rows = [(agfield_id, irrigation_type_id, probability) for agfield_id, field_rows in run_results.items() for irrigation_type_id, probability in field_rows]
+    destination.executemany(f"DELETE FROM {table} WHERE agfield_id = ?", field_ids)
+    for start in range(0, len(rows), batch_size):
+        destination.executemany(f"INSERT INTO {table} (agfield_id, irrigation_type_id, estimated_probability) VALUES (?, ?, ?)", rows[start:start + batch_size])
+    return len(rows)
+
+
+@contextmanager
+def in_memory_copy(using=DEFAULT_DB_ALIAS, write_models=WRITE_BACK_MODELS):
+    """
+        Runs everything inside the block against an in-memory copy of the database. Only the results in the tables
+        for write_models are written back to the file when the block finishes (and nothing if it raises - see
+        write_back), so anything else written during the block is lost.
+
+        Use it around a whole run rather than inside a transaction, since the connection is swapped underneath
+        Django:
+
+            with sqlite.in_memory_copy():
+                batch.run_all_service_areas(...)
+    """
+    connection = connections[using]
+    if connection.vendor != "sqlite":
+        raise ValueError("in_memory_copy only works with SQLite databases")
+
+    connection.ensure_connection()
+    disk = connection.connection
+    if connection.in_atomic_block or disk.in_transaction:
+        raise RuntimeError("in_memory_copy can't be used inside a transaction - SQLite can't back up a database with a write in progress")
+    start = time.perf_counter()
+    memory = connection.get_new_connection({**connection.get_connection_params(), "database": ":memory:"})  # so it has Django's SQL functions
+    memory.isolation_level = disk.isolation_level
+    disk.backup(memory)
+    log.info(f"Copied the database into memory in {time.perf_counter() - start:.2f} seconds")
+
+    connection.connection = memory
+    try:
+        yield memory
+        if memory.in_transaction:
+            memory.commit()
+        start = time.perf_counter()
+        counts = write_back(memory, disk, write_models)
+        log.info(f"Wrote {sum(counts.values())} result rows back to the database in {time.perf_counter() - start:.2f} seconds")
+    finally:
+        connection.connection = disk
+        memory.close()
@@ -0,0 +1,240 @@
+"""
+    Constant memory statistics for long Monte Carlo runs. Keeping every effectiveness value (and every iteration's
+    result) grows with the number of iterations, which becomes the main memory cost for long runs over the whole
+    valley. These keep running summaries instead: Welford mean and variance, counts, min and max, and a fixed size
+    reservoir sample for approximate quantiles for each field x irrigation option, plus only the top K results.
+    Each of them can merge another built from a different share of the iterations, so worker processes send back
+    their summaries rather than every iteration's solution.
+"""
+
+import heapq
+
+import numpy
+
+from .results import ResultStore
+from .sampling import option_indexes
+
+
+class RunningStatistics(object):
+    """
+        Running statistics for every cell of a grid (e.g. fields x irrigation options). Each update adds one value to
+        each of a set of cells. Quantiles come from a reservoir sample of reservoir_size values for each cell, so
+        they're exact until a cell has more values than that and approximate after.
+    """
+
+    def __init__(self, shape, reservoir_size=256, generator=None):
+        self.shape = tuple(shape)
+        self.reservoir_size = reservoir_size
+        self.generator = numpy.random.default_rng(generator)
+
+        self.count = numpy.zeros(self.shape, dtype=numpy.int64)
+        self.mean = numpy.zeros(self.shape, dtype=numpy.float64)
+        self._m2 = numpy.zeros(self.shape, dtype=numpy.float64)  # sum of squared differences from the mean
+        self.minimum = numpy.full(self.shape, numpy.inf)
+        self.maximum = numpy.full(self.shape, -numpy.inf)
+        self.reservoir = numpy.full(self.shape + (reservoir_size,), numpy.nan)
+
+    def update(self, cells, values):
+        """
+        :param cells: tuple of index arrays, one per dimension, selecting the cells to update - each cell at most once
+        :param values: value to add to each of the cells
+        """
+        values = numpy.broadcast_to(numpy.asarray(values, dtype=numpy.float64), numpy.shape(cells[0]))
+        count = self.count[cells] + 1
+        self.count[cells] = count
+
+        # Welford's update - numerically stable, unlike keeping sums of values and squares
+        delta = values - self.mean[cells]
+        mean = self.mean[cells] + delta / count
+        self.mean[cells] = mean
+        self._m2[cells] += delta * (values - mean)
+        self.minimum[cells] = numpy.minimum(self.minimum[cells], values)
+        self.maximum[cells] = numpy.maximum(self.maximum[cells], values)
+
+        # reservoir sampling - fill the reservoir, then replace a random slot with probability reservoir_size / count
+        slots = numpy.where(count <= self.reservoir_size, count - 1, self.generator.integers(0, count))
+        keep = slots < self.reservoir_size
+        self.reservoir[tuple(index[keep] for index in cells) + (slots[keep],)] = values[keep]
+
+    def merge(self, other):
+        """
+            Adds the values summarized in another RunningStatistics for the same grid, e.g. from a worker process
+            that ran some of the iterations. The merged reservoir is still a uniform sample of all of the values
+        """
+        count = self.count + other.count
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            share = numpy.where(count > 0, other.count / count, 0)
+
+        # Chan et al.'s pairwise update for the mean and squared differences
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * share
+        self._m2 = self._m2 + other._m2 + delta ** 2 * self.count * share
+        self.minimum = numpy.minimum(self.minimum, other.minimum)
+        self.maximum = numpy.maximum(self.maximum, other.maximum)
+        self.reservoir = self._merge_reservoirs(other, count)
+        self.count = count
+
+    def _merge_reservoirs(self, other, count):
+        size = self.reservoir_size
+        merged_size = numpy.minimum(count, size)
+        # how many of the merged sample's values come from each side, as if drawn from all of the values at once
+        from_self = numpy.zeros(self.shape, dtype=numpy.int64)
+        drawn = merged_size > 0
+        from_self[drawn] = self.generator.hypergeometric(self.count[drawn], other.count[drawn], merged_size[drawn])
+
+        # a random subset of a uniform sample is a uniform sample, so shuffle each reservoir and take from the front
+        positions = numpy.arange(size)
+        first = self._shuffled(self.reservoir, numpy.minimum(self.count, size))
+        second = self._shuffled(other.reservoir, numpy.minimum(other.count, size))
+        from_self = from_self[..., numpy.newaxis]
+        second = numpy.take_along_axis(second, numpy.clip(positions - from_self, 0, size - 1), axis=-1)
+        merged = numpy.where(positions < from_self, first, second)
+        merged[positions >= merged_size[..., numpy.newaxis]] = numpy.nan
+        return merged
+
+    def _shuffled(self, reservoir, filled):
+        """
+            The reservoir's filled slots in a random order, followed by the empty ones
+        """
+        keys = self.generator.random(reservoir.shape)
+        keys[numpy.arange(self.reservoir_size) >= filled[..., numpy.newaxis]] = numpy.inf
+        return numpy.take_along_axis(reservoir, numpy.argsort(keys, axis=-1), axis=-1)
+
+    @property
+    def variance(self):
+        """
+            Sample variance for each cell - NaN for cells with fewer than two values
+        """
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            return numpy.where(self.count > 1, self._m2 / (self.count - 1), numpy.nan)
+
+    @property
+    def std(self):
+        return numpy.sqrt(self.variance)
+
+    def quantiles(self, q):
+        """
+            Approximate quantiles for each cell from the reservoir - NaN for empty cells
+        :param q: quantile or sequence of quantiles in [0, 1]
+        :return: array with the quantiles on the first axis (when q is a sequence) and then the grid
+        """
+        with numpy.errstate(invalid="ignore"):
+            filled = numpy.where(self.count[..., numpy.newaxis] > 0, self.reservoir, 0)
+            result = numpy.nanquantile(filled, q, axis=-1)
+        return numpy.where(self.count > 0, result, numpy.nan)
+
+
+class EffectivenessStatistics(object):
+    """
+        Streaming version of the effectiveness lists in MonteCarloController.get_combinations - running statistics
+        of the objective value for each field x irrigation option, over the feasible iterations that chose it
+    """
+
+    def __init__(self, field_ids, options, option_counts, reservoir_size=256, generator=None):
+        """
+        :param field_ids: the model's fields, in order
+        :param options: fields x max options array of efficiencies (see EfficiencySampler.options)
+        :param option_counts: number of real options for each field - the rest of the row is padding
+        """
+        self.field_ids = field_ids
+        self.field_rows = {field: row for row, field in enumerate(field_ids)}
+        self.options = options
+        self.option_counts = numpy.asarray(option_counts)
+        self.iterations = 0
+        self.feasible_iterations = 0
+        self.drawn = numpy.zeros(options.shape, dtype=numpy.int64)  # how many iterations used each option, feasible or not
+        self.statistics = RunningStatistics(options.shape, reservoir_size=reservoir_size, generator=generator)
+
+    @property
+    def feasible(self):
+        """
+            How many feasible iterations used each option
+        """
+        return self.statistics.count
+
+    def add(self, solution):
+        self.iterations += 1
+        rows = numpy.arange(len(self.field_ids))
+        cells = (rows, option_indexes(self.options, self.option_counts, solution.efficiencies))
+        self.drawn[cells] += 1
+        if not solution.feasible:
+            return
+        self.feasible_iterations += 1
+        self.statistics.update(cells, solution.objective_value)
+
+    def merge(self, other):
+        """
+            Adds another EffectivenessStatistics for the same fields and options
+        """
+        self.iterations += other.iterations
+        self.feasible_iterations += other.feasible_iterations
+        self.drawn += other.drawn
+        self.statistics.merge(other.statistics)
+
+    def summary(self, field, quantiles=(0.25, 0.5, 0.75)):
+        """
+            Statistics for each of the field's irrigation options, in option order
+        :return: list of dicts with count, mean, std, min, max and quantiles (a dict of quantile: value)
+        """
+        row = self.field_rows[field]
+        stats = self.statistics
+        num_options = int(self.option_counts[row])
+        quantile_values = stats.quantiles(list(quantiles))
+        summaries = []
+        for column in range(num_options):
+            count = int(stats.count[row, column])
+            summaries.append({
+                "count": count,
+                "mean": float(stats.mean[row, column]) if count > 0 else None,
+                "std": float(stats.std[row, column]) if count > 1 else None,
+                "min": float(stats.minimum[row, column]) if count > 0 else None,
+                "max": float(stats.maximum[row, column]) if count > 0 else None,
+                "quantiles": {q: float(quantile_values[index, row, column]) if count > 0 else None for index, q in enumerate(quantiles)},
+            })
+        return summaries
+
+
+class TopResults(object):
+    """
+        Keeps only the k feasible solutions with the highest objective values
+    """
+
+    def __init__(self, k=10):
+        self.k = k
+        self._heap = []  # min heap of (objective value, insertion order, solution), so the worst kept result is on top
+        self._added = 0
+
+    def add(self, solution):
+        if not solution.feasible:
+            return
+        item = (solution.objective_value, self._added, solution)
+        self._added += 1
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, item)
+        elif item[0] > self._heap[0][0]:
+            heapq.heapreplace(self._heap, item)
+
+    def merge(self, other):
+        """
+            Adds the results another TopResults kept, after this one's in insertion order
+        """
+        for solution in other.solutions():
+            self.add(solution)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def solutions(self):
+        """
+            The kept solutions, best first (earlier results first for ties)
+        """
+        return [solution for value, order, solution in sorted(self._heap, key=lambda item: (-item[0], item[1]))]
+
+    def as_store(self, lp):
+        """
+            A ResultStore with the kept solutions as rows, best first
+        """
+        store = ResultStore(lp, capacity=max(len(self._heap), 1))
+        for solution in self.solutions():
+            store.add(solution)
+        return store
@@ -0,0 +1,183 @@
+"""
+    Synthetic model inputs for benchmarking and testing without the real input data - either a ModelInputs snapshot
+    directly, or the same kind of data written to the database so it goes through the real loading code
+"""
+
+import itertools
+from decimal import Decimal
+
+import numpy
+
+from . import load, models, production
+from .inputs import ModelInputs
+
+IRRIGATION_TYPES = [  # matches load.load_irrigation_types
+    {"id": 1, "name": "Sprinkler - Solid Set", "efficiency": 0.7},
+    {"id": 2, "name": "Drip - Surface", "efficiency": 0.86},
+    {"id": 3, "name": "Sprinkler - Microsprinkler", "efficiency": 0.81},
+    {"id": 4, "name": "Fallow", "efficiency": 0.01},
+]
+
+
+def synthetic_inputs(num_fields=200, wells_per_area=None, pipes_per_field=5, num_crops=6, crop_production_share=0.1,
+                     service_area="sa_synthetic", seed=20220330):
+    """
+        Builds a ModelInputs snapshot for a single made up service area. Each field gets pipes_per_field pipes
+        to randomly chosen wells within 3 km, and wells produce about enough water to meet the fields' demand at
+        typical irrigation efficiencies, so most efficiency combinations are feasible.
+    :param num_fields: number of fields in the service area
+    :param wells_per_area: number of wells - defaults to one well for every five fields
+    :param pipes_per_field: pipes (wells) connected to each field
+    :param num_crops: number of distinct crops assigned to fields - all but one crop have irrigation priors
+    :param crop_production_share: share of wells with a production record tagged with a crop
+    :param seed: seed for the random generator, so the same arguments always give the same inputs
+    :return: ModelInputs
+    """
+    rng = numpy.random.default_rng(seed)
+    if wells_per_area is None:
+        wells_per_area = max(num_fields // 5, 1)
+    pipes_per_field = min(pipes_per_field, wells_per_area)
+
+    field_demand = rng.uniform(5, 50, num_fields)
+    field_crop_ids = rng.integers(1, num_crops + 1, num_fields)
+
+    pipe_field_index = numpy.repeat(numpy.arange(num_fields), pipes_per_field)
+    pipe_well_index = numpy.concatenate([rng.choice(wells_per_area, pipes_per_field, replace=False) for _ in range(num_fields)])
+    pipe_distance = numpy.concatenate([numpy.sort(rng.uniform(50, 3000, pipes_per_field)) for _ in range(num_fields)])
+
+    # give each well a share of the total water that's needed at an efficiency of about 0.8
+    well_production = rng.dirichlet(numpy.ones(wells_per_area)) * field_demand.sum() / 0.8
+
+    crop_wells = numpy.flatnonzero(rng.random(wells_per_area) < crop_production_share)
+    crop_production_crop_ids = []
+    crop_production_quantity = []
+    for well_index in crop_wells:
+        connected_crops = field_crop_ids[pipe_field_index[pipe_well_index == well_index]]
+        crop = connected_crops[0] if len(connected_crops) > 0 else 1
+        crop_production_crop_ids.append(crop)
+        crop_production_quantity.append(well_production[well_index] * rng.uniform(0.1, 0.5))
+
+    irrigation_priors = {}
+    for crop in range(1, num_crops):  # the last crop has no priors so it uses the defaults
+        type_ids = rng.choice([1, 2, 3], size=2, replace=False)
+        irrigation_priors[crop] = [(int(type_ids[0]), 0.4), (int(type_ids[1]), 0.6)]
+
+    inputs = ModelInputs(
+        field_pks=numpy.arange(1, num_fields + 1),
+        field_ids=numpy.array([f"field_{number}" for number in range(num_fields)], dtype=object),
+        field_crop_ids=field_crop_ids,
+        field_service_areas=numpy.full(num_fields, service_area, dtype=object),
+        field_demand=field_demand,
+        well_pks=numpy.arange(1, wells_per_area + 1),
+        well_ids=numpy.array([f"well_{number}" for number in range(wells_per_area)], dtype=object),
+        well_service_areas=numpy.full(wells_per_area, service_area, dtype=object),
+        well_production=well_production,
+        pipe_pks=numpy.arange(1, len(pipe_field_index) + 1),
+        pipe_well_index=pipe_well_index,
+        pipe_field_index=pipe_field_index,
+        pipe_distance=pipe_distance,
+        pipe_named=numpy.ones(len(pipe_field_index), dtype=bool),
+        crop_production_well_index=crop_wells,
+        crop_production_crop_ids=numpy.array(crop_production_crop_ids, dtype=numpy.int64),
+        crop_production_quantity=numpy.array(crop_production_quantity, dtype=numpy.float64),
+        crop_names={crop: f"Crop {crop}" for crop in range(1, num_crops + 1)},
+        irrigation_types=IRRIGATION_TYPES,
+        irrigation_priors=irrigation_priors,
+    )
+    inputs.service_area = service_area
+    return inputs
+
+
+def _bulk_create(model, objects, batch_size, ignore_conflicts=False):
+    """
+        Creates objects from an iterable in batches, so the whole set is never in memory at once
+    :return: number of objects (including any ignored conflicts)
+    """
+    objects = iter(objects)
+    created = 0
+    while True:
+        batch = list(itertools.islice(objects, batch_size))
+        if len(batch) == 0:
+            return created
+        model.objects.bulk_create(batch, ignore_conflicts=ignore_conflicts)
+        created += len(batch)
+
+
+def _decimal(value):
+    return Decimal(f"{value:.4f}")
+
+
+def create_synthetic_database(num_service_areas=1, fields_per_area=100, wells_per_area=None, pipes_per_field=5, num_crops=6,
+                              crop_production_share=0.1, crops_without_priors=1, year=2018, timestep=1, seed=20220330, batch_size=5000):
+    """
+        Writes crops, irrigation types and priors, and for each service area the fields with their ET, wells with
+        their production, and pipes from synthetic_inputs. Service areas are named synthetic_0, synthetic_1 and so
+        on, and crops "Synthetic crop 1" and so on, so they don't collide with real data.
+    :param fields_per_area: see synthetic_inputs' num_fields - the other sizes are the same as synthetic_inputs
+    :param crops_without_priors: synthetic_inputs leaves the last crop without irrigation priors, so its fields use
+                                 every irrigation type including fallow, which makes most iterations infeasible in
+                                 large service areas. 0 gives it priors too
+    :param year: production year to write the well production for
+    :param timestep: AgFieldTimestep timestep to write the demand to
+    :return: dict with the number of each kind of record created
+    """
+    load.load_irrigation_types()
+    irrigation_type_pks = dict(models.IrrigationType.objects.values_list("type_code", "id"))
+    # synthetic_inputs' irrigation type ids are positions in load.IRRIGATION_TYPES
+    irrigation_type_pks = {type_id: irrigation_type_pks[type_code] for type_id, (name, type_code, efficiency) in enumerate(load.IRRIGATION_TYPES, start=1)}
+
+    crop_names = [f"Synthetic crop {crop}" for crop in range(1, num_crops + 1)]
+    models.Crop.objects.bulk_create([models.Crop(vw_crop_name=name, liq_crop_id=f"SYN{crop}") for crop, name in enumerate(crop_names, start=1)], ignore_conflicts=True)
+    crop_pks = dict(models.Crop.objects.filter(vw_crop_name__in=crop_names).values_list("vw_crop_name", "id"))
+    crop_pks = {crop: crop_pks[name] for crop, name in enumerate(crop_names, start=1)}
+
+    counts = {"service_areas": num_service_areas, "fields": 0, "wells": 0, "pipes": 0, "production": 0, "priors": 0}
+    for area in range(num_service_areas):
+        service_area = f"synthetic_{area}"
+        inputs = synthetic_inputs(num_fields=fields_per_area, wells_per_area=wells_per_area, pipes_per_field=pipes_per_field, num_crops=num_crops,
+                                  crop_production_share=crop_production_share, service_area=service_area, seed=[seed, area])
+        rng = numpy.random.default_rng([seed, area, 1])  # separate from the inputs' stream so the inputs match synthetic_inputs
+        if area == 0:  # priors are per crop, so they come from the first service area
+            priors = dict(inputs.irrigation_priors)
+            for crop in range(num_crops - crops_without_priors + 1, num_crops + 1):
+                priors.pop(crop, None)
+            for crop in range(1, num_crops - crops_without_priors + 1):
+                if crop not in priors:
+                    type_ids = rng.choice([1, 2, 3], size=2, replace=False)
+                    priors[crop] = [(int(type_ids[0]), 0.4), (int(type_ids[1]), 0.6)]
+            counts["priors"] = _bulk_create(models.CropIrrigationTypePrior, (
+                models.CropIrrigationTypePrior(crop_id=crop_pks[crop], irrigation_type_id=irrigation_type_pks[type_id], probability=Decimal(str(probability)))
+                for crop, crop_priors in priors.items() for type_id, probability in crop_priors), batch_size, ignore_conflicts=True)
+
+        # fields, with ET that gives the synthetic demand: demand = (consumptive use - precip) / 304.8 * acres
+        acres = rng.uniform(5, 100, inputs.num_fields)
+        precip = rng.uniform(0, 100, inputs.num_fields)
+        counts["fields"] += _bulk_create(models.AgField, (
+            models.AgField(liq_id=f"{service_area}_{field_id}", crop_id=crop_pks[int(crop)], ucm_service_area_id=service_area, acres=_decimal(acres[index]))
+            for index, (field_id, crop) in enumerate(zip(inputs.field_ids, inputs.field_crop_ids))), batch_size)
+        field_pks = dict(models.AgField.objects.filter(ucm_service_area_id=service_area).values_list("liq_id", "id"))
+        field_pks = [field_pks[f"{service_area}_{field_id}"] for field_id in inputs.field_ids]
+        consumptive_use = inputs.field_demand * 304.8 / acres + precip
+        _bulk_create(models.AgFieldTimestep, (
+            models.AgFieldTimestep(agfield_id=field_pks[index], timestep=timestep, consumptive_use=_decimal(consumptive_use[index]), precip=_decimal(precip[index]))
+            for index in range(inputs.num_fields)), batch_size)
+
+        counts["wells"] += _bulk_create(models.Well, (
+            models.Well(well_id=f"{service_area}_{well_id}", apn=f"{service_area}_{index}", ucm_service_area_id=service_area)
+            for index, well_id in enumerate(inputs.well_ids)), batch_size)
+        well_pks = dict(models.Well.objects.filter(ucm_service_area_id=service_area).values_list("well_id", "id"))
+        well_pks = [well_pks[f"{service_area}_{well_id}"] for well_id in inputs.well_ids]
+        # crop tagged records count toward the well's annual production too, so the untagged record is the rest of it
+        untagged = inputs.well_production.copy()
+        numpy.subtract.at(untagged, inputs.crop_production_well_index, inputs.crop_production_quantity)
+        annual = (models.WellProduction(well_id=well_pks[index], year=year, quantity=_decimal(quantity)) for index, quantity in enumerate(untagged))
+        crop_tagged = (models.WellProduction(well_id=well_pks[well_index], year=year, crop_id=crop_pks[int(crop)], quantity=_decimal(quantity))
+                       for well_index, crop, quantity in zip(inputs.crop_production_well_index, inputs.crop_production_crop_ids, inputs.crop_production_quantity))
+        counts["production"] += _bulk_create(models.WellProduction, itertools.chain(annual, crop_tagged), batch_size)
+
+        counts["pipes"] += _bulk_create(models.Pipe, (
+            models.Pipe(well_id=well_pks[well_index], agfield_id=field_pks[field_index], distance=_decimal(distance))
+            for well_index, field_index, distance in zip(inputs.pipe_well_index, inputs.pipe_field_index, inputs.pipe_distance)), batch_size)
+
+    production.invalidate()  # bulk creates don't send signals, so drop the cached production cube ourselves
+    return counts
@@ -0,0 +1,59 @@
+"""
+    Small hand-built datasets for the tests so they don't depend on the input data in Box
+"""
+
+from decimal import Decimal
+
+from allocate import models
+
+
+def create_service_areas():
+    """
+        Two service areas:
+            sa_1 - three fields (one without a timestep, one with six pipes so the pipe limit applies) and three wells
+                   with annual, semi-annual and monthly production, and one well production record tagged with a crop
+            sa_2 - a single field with a single well
+    """
+    almonds = models.Crop.objects.create(vw_crop_name="Almonds", liq_crop_id="D12", _efficiency_options="0.7,0.86")
+    grapes = models.Crop.objects.create(vw_crop_name="Grapes", liq_crop_id="V")
+
+    sprinkler = models.IrrigationType.objects.create(name="Sprinkler - Solid Set", type_code="SI", efficiency=Decimal("0.7"))
+    drip = models.IrrigationType.objects.create(name="Drip - Surface", type_code="SD", efficiency=Decimal("0.86"))
+    models.CropIrrigationTypePrior.objects.create(crop=almonds, irrigation_type=sprinkler, probability=Decimal("0.25"))
+    models.CropIrrigationTypePrior.objects.create(crop=almonds, irrigation_type=drip, probability=Decimal("0.75"))
+
+    field_a = models.AgField.objects.create(liq_id="field_a", crop=almonds, ucm_service_area_id="sa_1", acres=Decimal("10"))
+    field_b = models.AgField.objects.create(liq_id="field_b", crop=grapes, ucm_service_area_id="sa_1", acres=Decimal("20"))
+    field_c = models.AgField.objects.create(liq_id="field_c", crop=None, ucm_service_area_id="sa_1", acres=Decimal("5"))
+    field_d = models.AgField.objects.create(liq_id="field_d", crop=almonds, ucm_service_area_id="sa_2", acres=Decimal("8"))
+
+    models.AgFieldTimestep.objects.create(agfield=field_a, timestep=1, consumptive_use=Decimal("900"), precip=Decimal("150"))
+    models.AgFieldTimestep.objects.create(agfield=field_b, timestep=1, consumptive_use=Decimal("600"), precip=Decimal("100"))
+    models.AgFieldTimestep.objects.create(agfield=field_d, timestep=1, consumptive_use=Decimal("100"), precip=Decimal("400"))  # negative net demand
+
+    well_annual = models.Well.objects.create(well_id="w_annual", apn="1", ucm_service_area_id="sa_1")
+    well_semi = models.Well.objects.create(well_id="w_semi", apn="2", ucm_service_area_id="sa_1")
+    well_monthly = models.Well.objects.create(well_id="w_monthly", apn="3", ucm_service_area_id="sa_1")
+    well_sa_2 = models.Well.objects.create(well_id="w_sa_2", apn="4", ucm_service_area_id="sa_2")
+
+    models.WellProduction.objects.create(well=well_annual, year=2018, quantity=Decimal("40"))
+    models.WellProduction.objects.create(well=well_annual, year=2018, semi_year=1, quantity=Decimal("1000"))  # ignored - annual data wins
+    models.WellProduction.objects.create(well=well_annual, year=2018, crop=almonds, quantity=Decimal("15"))
+    models.WellProduction.objects.create(well=well_semi, year=2018, semi_year=1, quantity=Decimal("10"))
+    models.WellProduction.objects.create(well=well_semi, year=2018, semi_year=2, quantity=Decimal("12.5"))
+    models.WellProduction.objects.create(well=well_semi, year=2017, quantity=Decimal("500"))  # other year
+    for month in range(1, 13):
+        models.WellProduction.objects.create(well=well_monthly, year=2018, month=month, quantity=Decimal("1.5"))
+    models.WellProduction.objects.create(well=well_sa_2, year=2018, quantity=Decimal("3"))
+
+    models.Pipe.objects.create(well=well_annual, agfield=field_a, distance=Decimal("500"))
+    models.Pipe.objects.create(well=well_semi, agfield=field_a, distance=Decimal("1200"))
+    models.Pipe.objects.create(well=well_monthly, agfield=field_b, distance=Decimal("800"))
+    models.Pipe.objects.create(well=well_annual, agfield=field_b, distance=Decimal("2500"))
+    models.Pipe.objects.create(well=well_sa_2, agfield=field_d, distance=Decimal("100"))
+
+    # field_c has more pipes than the model will use - the wells outside the service area only connect here
+    for number, distance in enumerate(("2900", "100", "2000", "300", "1500", "2200")):
+        extra_well = models.Well.objects.create(well_id=f"w_extra_{number}", apn="5", ucm_service_area_id="sa_other")
+        models.WellProduction.objects.create(well=extra_well, year=2018, quantity=Decimal("1"))
+        models.Pipe.objects.create(well=extra_well, agfield=field_c, distance=Decimal(distance))
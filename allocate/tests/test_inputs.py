@@ -0,0 +1,107 @@
+import numpy
+from django.test import TestCase
+
+from allocate import allocation, models
+from allocate.inputs import ModelInputs, NO_CROP
+from allocate.tests.data import create_service_areas
+
+
+class ModelInputsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_service_areas()
+
+    def test_fixed_number_of_queries(self):
+        with self.assertNumQueries(9):
+            ModelInputs.load(service_area="sa_1", max_wells_per_field=5)
+        with self.assertNumQueries(9):
+            ModelInputs.load(max_wells_per_field=5)
+
+    def test_matches_orm_values(self):
+        inputs = ModelInputs.load(service_area="sa_1", max_wells_per_field=5)
+
+        self.assertEqual(list(inputs.field_ids), ["field_a", "field_b", "field_c"])
+        for field_id, demand in zip(inputs.field_ids, inputs.field_demand):
+            timesteps = models.AgFieldTimestep.objects.filter(agfield__liq_id=field_id, timestep=1)
+            expected = timesteps.first().demand if timesteps.exists() else 0
+            self.assertAlmostEqual(demand, expected)
+
+        for well_id, production in zip(inputs.well_ids, inputs.well_production):
+            expected = models.Well.objects.get(well_id=well_id).annual_production(2018)
+            self.assertAlmostEqual(production, float(expected or 0))
+
+        self.assertEqual(inputs.field_crop_ids[2], NO_CROP)
+        self.assertEqual(len(inputs.crop_production_quantity), 1)
+
+    def test_pipes_limited_and_sorted(self):
+        inputs = ModelInputs.load(service_area="sa_1", max_wells_per_field=5)
+        field_c_pipes = inputs.pipe_field_index == 2
+        self.assertEqual(field_c_pipes.sum(), 5)
+        self.assertEqual(list(inputs.pipe_distance[field_c_pipes]), [100, 300, 1500, 2000, 2200])
+        self.assertEqual(len(ModelInputs.load(service_area="sa_1").pipe_pks), 10)
+
+        # the pipes' well indexes point at the right wells
+        for pipe_pk, well_index in zip(inputs.pipe_pks, inputs.pipe_well_index):
+            self.assertEqual(models.Pipe.objects.get(id=pipe_pk).well.well_id, inputs.well_ids[well_index])
+
+    def test_service_area_totals(self):
+        inputs = allocation.load_inputs()
+        totals = allocation.get_sa_total("sa_1", inputs=inputs)
+        self.assertAlmostEqual(totals["supplies"], 40 + 15 + 22.5 + 18)  # the crop tagged record is annual production too
+        self.assertAlmostEqual(totals["demands"], 750 / 304.8 * 10 + 500 / 304.8 * 20)
+        self.assertEqual(allocation.get_sa_total("sa_1"), totals)
+        self.assertAlmostEqual(allocation.get_sa_total("sa_2")["demands"], 0)
+
+    def test_picklable(self):
+        import pickle
+        inputs = ModelInputs.load(service_area="sa_1", max_wells_per_field=5)
+        restored = pickle.loads(pickle.dumps(inputs))
+        numpy.testing.assert_array_equal(restored.pipe_distance, inputs.pipe_distance)
+
+    def test_monte_carlo_reads_snapshot(self):
+        controller = allocation.MonteCarloController("sa_1", use_crop_constraints=True)
+        with self.assertNumQueries(0):
+            options = controller.get_combinations()
+            controller.run(iterations=3)
+        self.assertEqual(options["field_a"]["crop_name"], "Almonds")
+        self.assertEqual(options["field_a"]["efficiencies"], [0.7, 0.86])
+        self.assertEqual(options["field_c"]["crop_id"], -1)
+        self.assertEqual(options["field_c"]["probabilities"], [0.5, 0.5])
+
+    def test_build_problem_only_reads(self):
+        with self.assertNumQueries(9):  # just the snapshot - pipe names are written with the results now
+            allocation.build_problem("sa_1")
+        self.assertEqual(models.Pipe.objects.filter(variable_name__isnull=False).count(), 0)
+
+    def test_for_service_area(self):
+        valley = allocation.load_inputs()
+        for service_area in ("sa_1", "sa_2"):
+            expected = allocation.load_inputs(service_area=service_area)
+            subset = valley.for_service_area(service_area)
+            for name in ("field_ids", "field_demand", "field_crop_ids", "pipe_pks", "pipe_distance", "crop_production_quantity"):
+                numpy.testing.assert_array_equal(getattr(subset, name), getattr(expected, name))
+            numpy.testing.assert_array_equal(subset.well_ids[subset.pipe_well_index], expected.well_ids[expected.pipe_well_index])
+            numpy.testing.assert_array_equal(subset.field_ids[subset.pipe_field_index], expected.field_ids[expected.pipe_field_index])
+            self.assertEqual(subset.service_area_totals(service_area), expected.service_area_totals(service_area))
+
+
+class FieldDemandTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_service_areas()
+
+    def test_matches_demand_property(self):
+        field_pks = numpy.array(sorted(models.AgField.objects.values_list("id", flat=True)))
+        with self.assertNumQueries(1):
+            demands = models.AgFieldTimestep.objects.filter(timestep=1).demand_by_field(field_pks)
+
+        expected = numpy.zeros(len(field_pks))
+        for timestep in models.AgFieldTimestep.objects.filter(timestep=1):
+            expected[numpy.searchsorted(field_pks, timestep.agfield_id)] = timestep.demand
+        numpy.testing.assert_allclose(demands, expected)
+        self.assertEqual(demands[list(field_pks).index(models.AgField.objects.get(liq_id="field_d").id)], 0)  # net demand was negative
+
+        annotated = models.AgFieldTimestep.objects.with_demand().get(agfield__liq_id="field_a")
+        self.assertAlmostEqual(annotated.demand_acre_feet, annotated.demand)
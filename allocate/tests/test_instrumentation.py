@@ -0,0 +1,60 @@
+import json
+import os
+import tempfile
+
+from django.test import TestCase
+
+from allocate import allocation, instrumentation
+from allocate.instrumentation import Instrumentation
+from allocate.tests.data import create_service_areas
+
+
+class InstrumentationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_service_areas()
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, "metrics.jsonl")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_monte_carlo_run(self):
+        metrics = Instrumentation(self.path)
+        controller = allocation.MonteCarloController("sa_1", use_crop_constraints=True, instrumentation=metrics)
+        controller.brute_force_combinations_threshold = 0
+        controller.run(iterations=5)
+
+        summary = {total["span"]: total for total in metrics.summary()}
+        self.assertEqual(summary["fetch"]["count"], 1)
+        self.assertEqual(summary["fetch"]["queries"], 9)  # see test_query_plans
+        self.assertEqual(summary["build"]["queries"], 0)  # built from the snapshot
+        self.assertEqual(summary["solve"]["count"], controller.solver_calls)
+        self.assertEqual(summary["record"]["count"], 5)
+
+        solves = [record for record in metrics.records if record["span"] == "solve"]
+        for solve in solves:
+            self.assertIn(solve["status"], ("optimal", "optimal_inaccurate", "infeasible"))
+            self.assertIsNotNone(solve["solver"])
+
+        with open(self.path) as metrics_file:
+            written = [json.loads(line) for line in metrics_file]
+        self.assertEqual(written, metrics.records)
+
+    def test_inactive(self):
+        with instrumentation.span(instrumentation.SOLVE) as record:
+            self.assertIsNone(record)
+
+        metrics = Instrumentation()
+        with metrics.active():
+            with instrumentation.span(instrumentation.SOLVE) as outer:
+                with metrics.active():  # activating again doesn't count queries twice
+                    allocation.load_inputs(service_area="sa_1")
+        self.assertEqual(outer["queries"], 9)
+        self.assertEqual([record["span"] for record in metrics.records], ["fetch", "solve"])
+
+        allocation.load_inputs(service_area="sa_1")
+        self.assertEqual(len(metrics.records), 2)
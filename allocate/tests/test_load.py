@@ -0,0 +1,238 @@
+import csv
+import os
+import tempfile
+from decimal import Decimal
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from allocate import incremental, load, models, parallel_load
+from allocate.tests.data import create_service_areas
+
+
+class CSVTestCase(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def write_csv(self, name, rows):
+        path = os.path.join(self.folder.name, name)
+        with open(path, 'w', newline='') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=rows[0].keys())
+            writer.writeheader()
+            writer.writerows(rows)
+        return path
+
+    def production_file(self, kind, month, wells=3, quantity="5"):
+        return self.write_csv(f"production_{kind}.csv", [{"well_id": f"w_{index}", "factor": "", "af": quantity, "calendar_year": "2018", "month": month, "calendar_semi_year": ""}
+                                                          for index in range(wells)])
+
+    def write_input_files(self, wells=3):
+        """
+            A small set of the input files for load.load and parallel_load.build_stages - each well has a pipe to each field
+        """
+        return {
+            "crop_file": self.write_csv("crops.csv", [{"VW_crop": "Almonds", "UCM_group": "", "LIQ_CropType": "Almonds", "LIQ_CROPTYP2": "D12", "LIQ_class_name": "", "LIQ_CLASS2": "D", "efficiencies": "SI,SD"}]),
+            "well_file": self.write_csv("wells.csv", [{"Well_Nbr": f"w_{index}", "ucm_well_service_area_id": "sa_1", "APN": f"apn_{index}"} for index in range(wells)]),
+            "field_file": self.write_csv("fields.csv", [{"UniqueID": f"f_{index}", "CROPTYP2": "D12", "ucm_well_service_area_id": "sa_1", "ACRES": "10"} for index in range(2)]),
+            "agtimestep_file": self.write_csv("et.csv", [{"UniqueID": f"f_{index}", "et": "2.5", "precip": "0.5"} for index in range(2)]),
+            "pipe_file": self.write_csv("pipes.csv", [{"Well_Nbr": f"w_{well}", "UniqueID": f"f_{field}", "NEAR_DIST": "100"} for well in range(4) for field in range(2)]),
+            "crop_irrigation_file": self.write_csv("priors.csv", [{"crop_code": "D12", "irrigation_type": "SD", "probability": "0.6"}, {"crop_code": "D12", "irrigation_type": "SI", "probability": "0.4"}]),
+            "production_files": [self.production_file("annual", ""), self.production_file("monthly", "6")],
+        }
+
+
+class LoadTests(CSVTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_service_areas()
+        # two crops share a LandIQ code - lookups should pick the first one by id, like the queries did
+        cls.first_grain = models.Crop.objects.create(vw_crop_name="Wheat", liq_crop_id="G")
+        models.Crop.objects.create(vw_crop_name="Barley", liq_crop_id="G")
+
+    def test_fields_resolve_crops(self):
+        path = self.write_csv("fields.csv", [
+            {"UniqueID": "new_grain", "CROPTYP2": "G", "ucm_well_service_area_id": "sa_3", "ACRES": "4"},
+            {"UniqueID": "new_unknown", "CROPTYP2": "ZZZ", "ucm_well_service_area_id": "sa_3", "ACRES": "5"},
+            {"UniqueID": "new_almond", "CROPTYP2": "D12", "ucm_well_service_area_id": "sa_3", "ACRES": "6"},
+        ])
+        load.load_fields(path)
+
+        fields = {field.liq_id: field for field in models.AgField.objects.filter(ucm_service_area_id="sa_3")}
+        self.assertEqual(fields["new_grain"].crop_id, self.first_grain.id)
+        self.assertIsNone(fields["new_unknown"].crop_id)
+        self.assertEqual(fields["new_almond"].crop.vw_crop_name, "Almonds")
+
+    def test_lookup_queries_dont_scale_with_rows(self):
+        rows = [{"well_id": "w_sa_2", "factor": "Almonds" if year % 2 else "", "af": "1.5", "calendar_year": str(year), "month": "", "calendar_semi_year": ""}
+                for year in range(1900, 1960)]
+        path = self.write_csv("production.csv", rows)
+
+        # one query for each referenced model's lookup, plus the insert and the transaction's savepoint
+        with self.assertNumQueries(5):
+            load.generic_csv_import(models.WellProduction, path, {
+                "well": {"Well.well_id": "well_id"},
+                "crop": {"Crop.vw_crop_name": "factor"},
+                "quantity": "af",
+                "year": "calendar_year",
+                "month": "month",
+                "semi_year": "calendar_semi_year",
+            })
+
+        loaded = models.WellProduction.objects.filter(well__well_id="w_sa_2", year__lt=2000)
+        self.assertEqual(loaded.count(), 60)
+        self.assertEqual(loaded.filter(crop__vw_crop_name="Almonds").count(), 30)
+        self.assertEqual(loaded.filter(crop=None).count(), 30)
+        self.assertEqual(sum(production.quantity for production in loaded), Decimal("90"))
+
+    def test_lookup_cache(self):
+        lookups = load.LookupCache()
+        self.assertEqual(lookups.get("Crop.liq_crop_id", "G").pk, self.first_grain.id)
+        self.assertIsNone(lookups.get("Well.well_id", "not_a_well"))
+
+        # CSV values are strings, so they're converted to the attribute's type before looking them up
+        well = models.Well.objects.get(well_id="w_sa_2")
+        self.assertEqual(lookups.get("Well.id", str(well.id)).pk, well.id)
+        self.assertIsNone(lookups.get("Well.id", "abc"))
+
+    def production_rows(self, years, well_id="w_sa_2"):
+        return [{"well_id": well_id, "quantity": "2", "year": str(year), "month": "", "semi_year": ""} for year in years]
+
+    def test_chunked_import(self):
+        path = self.write_csv("production.csv", self.production_rows(range(1900, 1925)))
+        field_map = {"well": {"Well.well_id": "well_id"}, "quantity": None, "year": None, "month": None, "semi_year": None}
+
+        # the lookup, then 25 rows in chunks of 10 is three inserts, inside a savepoint
+        with self.assertNumQueries(6):
+            rows = load.generic_csv_import(models.WellProduction, path, field_map, batch_size=10)
+        self.assertEqual(rows, 25)
+        self.assertEqual(models.WellProduction.objects.filter(well__well_id="w_sa_2", year__lt=2000).count(), 25)
+
+    def test_header_field_map(self):
+        path = self.write_csv("crops.csv", [{"vw_crop_name": "Rye", "liq_crop_id": "R1"}, {"vw_crop_name": "Oats", "liq_crop_id": "R2"}])
+        self.assertEqual(load.generic_csv_import(models.Crop, path, None), 2)
+        self.assertEqual(models.Crop.objects.get(vw_crop_name="Oats").liq_crop_id, "R2")
+
+    def test_failed_import_rolls_back(self):
+        rows = self.production_rows(range(1900, 1905)) + [{"well_id": "w_sa_2", "quantity": "not a number", "year": "1906", "month": "", "semi_year": ""}]
+        path = self.write_csv("production.csv", rows)
+        with self.assertRaises(Exception):
+            load.generic_csv_import(models.WellProduction, path, {"well": {"Well.well_id": "well_id"}, "quantity": None, "year": None, "month": None, "semi_year": None}, batch_size=2)
+        self.assertFalse(models.WellProduction.objects.filter(year__lt=2000).exists())
+
+    def test_skip_failed_rows(self):
+        path = self.write_csv("wells.csv", [{"well_id": "w_sa_2", "ucm_service_area_id": None}, {"well_id": "w_new", "ucm_service_area_id": "sa_3"}])
+        # the first row collides with an existing well_id, and only that row's savepoint is rolled back
+        load.generic_csv_import(models.Well, path, None, skip_failed_create=True, bulk=False)
+        self.assertTrue(models.Well.objects.filter(well_id="w_new", ucm_service_area_id="sa_3").exists())
+        self.assertEqual(models.Well.objects.filter(well_id="w_sa_2").count(), 1)
+
+
+class ParallelLoadTests(CSVTestCase):
+
+    def test_loads_every_stage(self):
+        timings = parallel_load.load_parallel(parallel_load.build_stages(**self.write_input_files()), workers=2)
+
+        self.assertEqual(set(timings), {"crops", "wells", "irrigation_types", "fields", "crop_irrigation_types", "et", "pipes", "production_0", "production_1"})
+        self.assertEqual(timings["pipes"]["rows"], 8)
+        self.assertEqual(models.Pipe.objects.count(), 6)  # w_3 doesn't exist, so its pipes are skipped
+        self.assertEqual(models.AgField.objects.filter(crop__liq_crop_id="D12").count(), 2)
+        self.assertEqual(models.Pipe.objects.filter(well__well_id="w_2", agfield__liq_id="f_1").count(), 1)
+        self.assertEqual(models.CropIrrigationTypePrior.objects.get(irrigation_type__type_code="SD").probability, Decimal("0.6"))
+        self.assertEqual(models.AgFieldTimestep.objects.filter(timestep=1, agfield__liq_id="f_0").count(), 1)
+        self.assertEqual(models.WellProduction.objects.filter(well__well_id="w_0", year=2018).count(), 2)
+
+    def test_generates_pipes_without_a_pipe_file(self):
+        files = self.write_input_files()
+        files["well_file"] = self.write_csv("wells.csv", [{"Well_Nbr": f"w_{index}", "ucm_well_service_area_id": "sa_1", "APN": f"apn_{index}", "POINT_X": str(index * 1000), "POINT_Y": "0"}
+                                                          for index in range(3)])
+        files["field_file"] = self.write_csv("fields.csv", [{"UniqueID": f"f_{index}", "CROPTYP2": "D12", "ucm_well_service_area_id": "sa_1", "ACRES": "10", "CENTROID_X": str(index * 4500), "CENTROID_Y": "0"}
+                                                            for index in range(2)])
+        files["pipe_file"] = None
+        timings = parallel_load.load_parallel(parallel_load.build_stages(**files), workers=2)
+
+        self.assertIsNone(timings["pipes"]["rows"])
+        self.assertEqual(models.Pipe.objects.filter(agfield__liq_id="f_0").count(), 3)  # every well is within 3000 meters of f_0
+        self.assertEqual(models.Pipe.objects.filter(agfield__liq_id="f_1").count(), 1)  # only w_2 is within 3000 meters of f_1
+
+    def test_streams_chunks(self):
+        files = self.write_input_files()
+        chunks = list(parallel_load.parse_csv(files["well_file"], load.WELL_FIELDS, load.LookupCache(), batch_size=2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 1])
+
+        timings = parallel_load.load_parallel(parallel_load.build_stages(**files), workers=2, batch_size=2)
+        self.assertEqual(timings["pipes"]["rows"], 8)
+        self.assertEqual(models.Pipe.objects.count(), 6)
+        self.assertEqual(models.WellProduction.objects.count(), 6)
+
+    def test_rejects_circular_dependencies(self):
+        stages = [parallel_load.Stage("a", depends_on=["b"]), parallel_load.Stage("b", depends_on=["a"]), parallel_load.Stage("c")]
+        with self.assertRaisesRegex(ValueError, "circular"):
+            parallel_load.check_stages(stages)
+        with self.assertRaisesRegex(ValueError, "don't exist"):
+            parallel_load.check_stages([parallel_load.Stage("a", depends_on=["missing"])])
+
+
+class IncrementalLoadTests(CSVTestCase):
+
+    def test_irrigation_types_are_idempotent(self):
+        load.load_irrigation_types()
+        load.load_irrigation_types()
+        self.assertEqual(models.IrrigationType.objects.count(), len(load.IRRIGATION_TYPES))
+
+    def test_applies_only_changes(self):
+        files = self.write_input_files()
+        first = incremental.load_incremental(parallel_load.build_stages(**files))
+        self.assertEqual(first["production_0"], {"inserts": 3, "updates": 0, "deletes": 0, "skipped": 0})
+        self.assertEqual(first["pipes"]["skipped"], 2)
+        self.assertEqual(models.WellProduction.objects.count(), 6)
+
+        unchanged = incremental.load_incremental(parallel_load.build_stages(**files))
+        self.assertTrue(all(counts is None for counts in unchanged.values()))
+
+        # the annual file changes - w_0's quantity, w_2 is gone, and w_1 is the same. The monthly file's rows stay
+        self.write_csv("production_annual.csv", [{"well_id": "w_0", "factor": "", "af": "7.5", "calendar_year": "2018", "month": "", "calendar_semi_year": ""},
+                                                 {"well_id": "w_1", "factor": "", "af": "5.0", "calendar_year": "2018", "month": "", "calendar_semi_year": ""}])
+        with CaptureQueriesContext(connection) as queries:
+            reload = incremental.load_incremental(parallel_load.build_stages(**files))
+        writes = [query["sql"].split()[0] for query in queries.captured_queries if "allocate_wellproduction" in query["sql"] and not query["sql"].startswith("SELECT")]
+        self.assertEqual(writes, ["DELETE", "UPDATE"])
+        self.assertEqual(reload["production_0"], {"inserts": 0, "updates": 1, "deletes": 1, "skipped": 0})
+        self.assertIsNone(reload["production_1"])
+        self.assertEqual(models.WellProduction.objects.get(well__well_id="w_0", month=None).quantity, Decimal("7.5"))
+        self.assertFalse(models.WellProduction.objects.filter(well__well_id="w_2", month=None).exists())
+        self.assertEqual(models.WellProduction.objects.filter(month=6).count(), 3)
+
+    def test_reloads_dependents_of_changed_files(self):
+        files = self.write_input_files()
+        incremental.load_incremental(parallel_load.build_stages(**files))
+
+        # the pipes file already has w_3's pipes, which couldn't load until the well exists
+        files.update(self.write_input_files(wells=4))
+        results = incremental.load_incremental(parallel_load.build_stages(**files))
+        self.assertEqual(results["wells"]["inserts"], 1)
+        self.assertEqual(results["pipes"], {"inserts": 2, "updates": 0, "deletes": 0, "skipped": 0})
+        self.assertIsNone(results["et"])
+        self.assertEqual(models.Pipe.objects.filter(well__well_id="w_3").count(), 2)
+
+    def test_generates_pipes_when_wells_change(self):
+        files = self.write_input_files()
+        files["pipe_file"] = None
+        wells = [{"Well_Nbr": "w_0", "ucm_well_service_area_id": "sa_1", "APN": "apn_0", "POINT_X": "0", "POINT_Y": "0"}]
+        files["well_file"] = self.write_csv("wells.csv", wells)
+        files["field_file"] = self.write_csv("fields.csv", [{"UniqueID": "f_0", "CROPTYP2": "D12", "ucm_well_service_area_id": "sa_1", "ACRES": "10", "CENTROID_X": "100", "CENTROID_Y": "0"}])
+        first = incremental.load_incremental(parallel_load.build_stages(**files))
+        self.assertEqual(first["pipes"], {"generated": 1})
+        self.assertIsNone(incremental.load_incremental(parallel_load.build_stages(**files))["pipes"])
+
+        # w_0 moves out of range and a new well is close by
+        wells = [dict(wells[0], POINT_X="9000"), {"Well_Nbr": "w_1", "ucm_well_service_area_id": "sa_1", "APN": "apn_1", "POINT_X": "200", "POINT_Y": "0"}]
+        self.write_csv("wells.csv", wells)
+        results = incremental.load_incremental(parallel_load.build_stages(**files))
+        self.assertEqual(results["pipes"], {"generated": 1})
+        self.assertEqual(list(models.Pipe.objects.values_list("well__well_id", flat=True)), ["w_1"])
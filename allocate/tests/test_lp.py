@@ -0,0 +1,101 @@
+import numpy
+from django.test import TestCase
+
+from allocate import allocation, models
+from allocate.tests.data import create_service_areas
+
+
+class AllocationLPTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_service_areas()
+
+    def assertSameOptimum(self, service_area, efficiencies, **kwargs):
+        inputs = allocation.load_inputs(service_area=service_area)
+        problem, problem_info = allocation.build_problem(service_area, inputs=inputs, **kwargs)
+        lp = allocation.build_lp(inputs=inputs, **kwargs)
+
+        self.assertEqual(list(lp.field_ids), list(problem_info["irrigation_efficiency_params"].keys()))
+        for field, efficiency in zip(lp.field_ids, efficiencies):
+            problem_info["irrigation_efficiency_params"][field].value = efficiency
+        lp.set_efficiencies(efficiencies)
+
+        problem.solve()
+        lp.solve()
+        self.assertEqual(lp.problem.status, problem.status)
+        if problem.status == "optimal":
+            self.assertAlmostEqual(lp.problem.value, problem.value, places=3)
+        return lp
+
+    def test_same_optimum(self):
+        for use_crop_constraints in (True, False):
+            for efficiencies in ([0.75, 0.75, 0.75], [0.7, 0.86, 0.81], [0.86, 0.7, 0.01]):
+                self.assertSameOptimum("sa_1", efficiencies, use_crop_constraints=use_crop_constraints)
+
+        self.assertSameOptimum(None, [0.8, 0.7, 0.9, 0.75])
+
+    def test_same_optimum_with_debug(self):
+        self.assertSameOptimum("sa_1", [0.7, 0.86, 0.81], add_debug=True)
+        self.assertSameOptimum("sa_2", [0.8], add_debug=True)
+
+    def test_pipe_index_map(self):
+        lp = self.assertSameOptimum("sa_1", [0.7, 0.86, 0.81])
+        allocations = dict(zip(lp.pipe_ids, lp.allocations))
+        pipe = models.Pipe.objects.get(well__well_id="w_monthly", agfield__liq_id="field_b")
+        self.assertIn(pipe.id, allocations)
+
+        # the crop constraint limits the almond water from w_annual to its tagged production
+        almond_pipe = models.Pipe.objects.get(well__well_id="w_annual", agfield__liq_id="field_a")
+        self.assertLessEqual(allocations[almond_pipe.id], 15 + 1e-4)
+        numpy.testing.assert_allclose(lp.field_allocations, [sum(v for k, v in allocations.items() if models.Pipe.objects.get(id=k).agfield.liq_id == field) for field in lp.field_ids], atol=1e-6)
+
+    def test_parameterized_problem_is_dpp(self):
+        lp = allocation.build_lp(service_area="sa_1")
+        self.assertTrue(lp.problem.is_dpp())
+
+        lp.set_efficiencies([0.7, 0.86, 0.81])
+        lp.solve()
+        first_value = lp.problem.value
+        lp.set_efficiencies([0.86, 0.7, 0.81])
+        lp.solve()
+        lp.set_efficiencies([0.7, 0.86, 0.81])
+        lp.solve()
+        self.assertAlmostEqual(lp.problem.value, first_value, places=4)
+        numpy.testing.assert_allclose(lp.efficiencies, [0.7, 0.86, 0.81])
+
+    def test_timesteps(self):
+        june, july = models.AgFieldTimestep.month_timestep(6), models.AgFieldTimestep.month_timestep(7)
+        for liq_id, june_et, july_et in (("field_a", "80", "90"), ("field_b", "40", "50")):
+            field = models.AgField.objects.get(liq_id=liq_id)
+            models.AgFieldTimestep.objects.create(agfield=field, timestep=june, consumptive_use=june_et, precip="0")
+            models.AgFieldTimestep.objects.create(agfield=field, timestep=july, consumptive_use=july_et, precip="0")
+
+        inputs = allocation.load_inputs(service_area="sa_1", timesteps=[june, july])
+        numpy.testing.assert_allclose(inputs.field_timestep_demand, [[80 / 304.8 * 10, 90 / 304.8 * 10], [40 / 304.8 * 20, 50 / 304.8 * 20], [0, 0]])
+        numpy.testing.assert_allclose(inputs.field_demand, inputs.field_timestep_demand.sum(axis=1))
+        production = dict(zip(inputs.well_ids, inputs.well_timestep_production))
+        numpy.testing.assert_allclose(production["w_monthly"], [1.5, 1.5])
+        numpy.testing.assert_allclose(production["w_annual"], [55 / 12, 55 / 12])  # no monthly records, so the annual production spread over the year
+        numpy.testing.assert_allclose(production["w_semi"], [22.5 / 12, 22.5 / 12])
+
+        lp = allocation.build_lp(inputs=inputs)
+        self.assertTrue(lp.problem.is_dpp())
+        lp.set_efficiencies([0.8, 0.8, 0.8])
+        lp.solve()
+        self.assertEqual(lp.problem.status, "optimal")
+
+        # every timestep stays within that timestep's production, and the solution has the totals
+        solution = lp.solution()
+        self.assertEqual(solution.timestep_allocations.shape, (inputs.num_pipes, 2))
+        numpy.testing.assert_allclose(solution.allocations, solution.timestep_allocations.sum(axis=1))
+        well_supply = lp.well_incidence @ solution.timestep_allocations
+        self.assertTrue((well_supply <= inputs.well_timestep_production[lp.well_index] + 1e-4).all())
+
+    def test_single_timestep_matches(self):
+        lp = allocation.build_lp(service_area="sa_1")
+        timestep_lp = allocation.build_lp(inputs=allocation.load_inputs(service_area="sa_1", timesteps=[models.AgFieldTimestep.ANNUAL]))
+        for model in (lp, timestep_lp):
+            model.set_efficiencies([0.7, 0.86, 0.81])
+            model.solve()
+        self.assertAlmostEqual(timestep_lp.problem.value, lp.problem.value, places=4)
@@ -0,0 +1,119 @@
+import json
+import os
+import tempfile
+from unittest import mock
+
+from django.test import TestCase
+
+from allocate import allocation, models
+from allocate.tests.data import create_service_areas
+
+
+class MonteCarloTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_service_areas()
+
+    def run_controller(self, iterations, workers=None, brute_force_threshold=0, **kwargs):
+        controller = allocation.MonteCarloController("sa_1", use_crop_constraints=True, **kwargs)
+        controller.brute_force_combinations_threshold = brute_force_threshold
+        controller.run(iterations=iterations, workers=workers)
+        return controller, list(controller.results)
+
+    def test_parallel_is_reproducible(self):
+        controller, results = self.run_controller(12, workers=3)
+        repeat_controller, repeat_results = self.run_controller(12, workers=3)
+
+        self.assertEqual(len(results), 12)
+        self.assertEqual([result.objective_value for result in results], [result.objective_value for result in repeat_results])
+        self.assertEqual(controller.best_result.objective_value, max(result.objective_value for result in results))
+
+        # every iteration adds an effectiveness value to exactly one irrigation option for each model field
+        for field in controller.lp.field_ids:
+            options = controller.efficiency_information[field]["irrigation"]
+            self.assertEqual(sum(len(option["effectiveness"]) for option in options), 12)
+            self.assertEqual(options, repeat_controller.efficiency_information[field]["irrigation"])
+
+    def test_parallel_matches_serial_solves(self):
+        controller = allocation.MonteCarloController("sa_1", use_crop_constraints=True)
+        controller.brute_force_combinations_threshold = 0
+        with mock.patch.object(controller, "record_result", wraps=controller.record_result) as record_result:
+            controller.run(iterations=4, workers=2)
+        solutions = [call.args[0] for call in record_result.call_args_list]
+        self.assertEqual(len(solutions), 4)
+
+        # re-solving each parallel sample on the controller's own problem gives the same results
+        for solution in solutions:
+            controller.lp.set_efficiencies(solution.efficiencies)
+            controller.lp.solve(controller.solver_settings)
+            self.assertEqual(controller.lp.problem.status, solution.status)
+            self.assertAlmostEqual(controller.lp.problem.value, solution.objective_value, delta=1e-6 * abs(solution.objective_value))
+
+    def test_run_all_service_areas(self):
+        from allocate import batch
+        self.assertEqual([service_area for service_area, pipes in batch.service_areas_by_size()], ["sa_1", "sa_2"])
+        models.AgField.objects.create(liq_id="field_no_pipes", ucm_service_area_id="sa_empty", acres=10)  # skipped
+
+        with tempfile.TemporaryDirectory() as output_folder:
+            self.assertEqual(batch.run_all_service_areas(output_folder, workers=2, iterations=3), 2)
+            with open(os.path.join(output_folder, "results.jsonl")) as results_file:
+                results = {result["service_area"]: result for result in map(json.loads, results_file)}
+
+        self.assertEqual(set(results), {"sa_1", "sa_2"})
+
+        self.assertEqual(results["sa_1"]["pipes"], 9)
+        self.assertEqual(results["sa_2"]["feasible_iterations"], 2)  # a single field with two options gets brute forced
+        self.assertTrue(results["sa_2"]["brute_forced"])
+        self.assertIn("field_a", results["sa_1"]["field_results"])
+        self.assertIsNotNone(results["sa_2"]["field_results"]["field_d"]["best_efficiency"])  # no demand, so it has no field results in the best iteration
+
+    def test_failed_service_areas_dont_stop_the_run(self):
+        from allocate import batch
+        with tempfile.TemporaryDirectory() as output_folder:
+            with self.assertLogs(batch.log, level="ERROR") as logs:
+                self.assertEqual(batch.run_all_service_areas(output_folder, workers=2, iterations=3, random_seed="not a number"), 0)
+            self.assertEqual(len(logs.records), 2)  # one for each service area
+            with open(os.path.join(output_folder, "timings.csv")) as timings_file:
+                self.assertEqual(len(timings_file.readlines()), 1)  # just the header
+
+    def test_serial_is_reproducible(self):
+        controller, results = self.run_controller(6)
+        repeat_controller, repeat_results = self.run_controller(6)
+        self.assertEqual([result.objective_value for result in results], [result.objective_value for result in repeat_results])
+
+        prior_controller, prior_results = self.run_controller(6, sampling_mode="prior")
+        self.assertEqual(len(prior_results), 6)
+
+    def test_brute_force_small_service_area(self):
+        controller, results = self.run_controller(50, brute_force_threshold=100)
+        self.assertTrue(controller.brute_forced)
+        self.assertEqual(len(results), 8)  # 2 options for each of the 3 fields, solved once each
+        self.assertEqual(controller.solver_calls, 8)
+
+    def test_repeated_samples_reuse_solves(self):
+        controller, results = self.run_controller(40)
+        self.assertFalse(controller.brute_forced)
+        self.assertEqual(len(results), 40)
+        self.assertLessEqual(controller.solver_calls, 8)  # only 8 distinct combinations to solve
+        self.assertEqual(len(controller.solutions_by_efficiencies), controller.solver_calls)
+
+    def test_service_area_without_pipes(self):
+        models.AgField.objects.create(liq_id="field_no_pipes", ucm_service_area_id="sa_empty", acres=10)
+        for streaming_statistics in (False, True):
+            controller = allocation.MonteCarloController("sa_empty", use_crop_constraints=True, streaming_statistics=streaming_statistics)
+            controller.run(iterations=5)
+            self.assertEqual(len(controller.lp.field_ids), 0)
+            self.assertEqual(controller.solver_calls, 0)
+            self.assertEqual(controller.feasible_iterations, 0)
+            self.assertIsNone(controller.best_result)
+            self.assertEqual(controller.irrigation_probabilities(), {})
+
+    def test_memo_size(self):
+        controller = allocation.MonteCarloController("sa_1", use_crop_constraints=True)
+        controller.brute_force_combinations_threshold = 0
+        controller.solution_memo_size = 2
+        controller.run(iterations=40)
+        self.assertEqual(len(controller.results), 40)
+        self.assertEqual(len(controller.solutions_by_efficiencies), 2)
+        self.assertGreater(controller.solver_calls, 8)  # some of the 8 combinations fell out of the memo and were solved again
@@ -0,0 +1,50 @@
+from decimal import Decimal
+
+import numpy
+from django.test import TestCase
+
+from allocate import models, pipes
+
+
+class PipeGenerationTests(TestCase):
+
+    def test_matches_brute_force(self):
+        rng = numpy.random.default_rng(4)
+        fields = rng.uniform(0, 10000, (200, 2))
+        wells = rng.uniform(0, 10000, (60, 2))
+        field_index, well_index, distance = pipes.nearest_wells(fields, wells, radius=1500, max_wells_per_field=3)
+
+        all_distances = numpy.linalg.norm(fields[:, numpy.newaxis] - wells[numpy.newaxis], axis=2)
+        for field in range(len(fields)):
+            expected = numpy.sort(all_distances[field][all_distances[field] <= 1500])[:3]
+            numpy.testing.assert_allclose(distance[field_index == field], expected)
+            numpy.testing.assert_allclose(all_distances[field, well_index[field_index == field]], expected)
+        self.assertTrue((numpy.diff(field_index) >= 0).all())
+
+    def test_groups(self):
+        fields = [[0, 0], [10, 0]]
+        wells = [[1, 0], [9, 0], [5, 0]]
+        field_index, well_index, distance = pipes.nearest_wells(fields, wells, radius=100, max_wells_per_field=1,
+                                                                field_groups=numpy.array(["a", "b"], dtype=object), well_groups=numpy.array(["b", "a", "b"], dtype=object))
+        self.assertEqual(list(field_index), [0, 1])
+        self.assertEqual(list(well_index), [1, 2])  # each field's closest well in its own group
+        numpy.testing.assert_allclose(distance, [9, 5])
+
+    def test_generate_pipes(self):
+        for number, (x, service_area) in enumerate(((0, "sa_1"), (100, "sa_1"), (5000, "sa_2"))):
+            models.AgField.objects.create(liq_id=f"field_{number}", ucm_service_area_id=service_area, acres=Decimal("10"), x=x, y=0)
+        models.AgField.objects.create(liq_id="no_coordinates", ucm_service_area_id="sa_1", acres=Decimal("10"))
+        for number, (x, service_area) in enumerate(((30, "sa_2"), (60, "sa_1"), (4000, "sa_2"), (9000, "sa_2"))):
+            models.Well.objects.create(well_id=f"well_{number}", apn="1", ucm_service_area_id=service_area, x=x, y=0)
+
+        self.assertEqual(pipes.generate_pipes(radius=1500, max_wells_per_field=2), 5)
+        self.assertEqual(sorted(models.Pipe.objects.filter(agfield__liq_id="field_1").values_list("well__well_id", "distance")),
+                         [("well_0", Decimal("70")), ("well_1", Decimal("40"))])
+        self.assertEqual(list(models.Pipe.objects.filter(agfield__liq_id="field_2").values_list("well__well_id", flat=True)), ["well_2"])
+
+        # running it again doesn't duplicate the pipes, and replace swaps them for the new ones
+        pipes.generate_pipes(radius=1500, max_wells_per_field=2)
+        self.assertEqual(models.Pipe.objects.count(), 5)
+        self.assertEqual(pipes.generate_pipes(radius=1500, service_area="sa_1", same_service_area=True, replace=True), 2)
+        self.assertEqual(list(models.Pipe.objects.filter(agfield__ucm_service_area_id="sa_1").values_list("well__well_id", flat=True).distinct()), ["well_1"])
+        self.assertEqual(models.Pipe.objects.filter(agfield__liq_id="field_2").count(), 1)
@@ -0,0 +1,86 @@
+from decimal import Decimal
+
+from django.db.models import Sum
+from django.test import TestCase
+
+from allocate import models, production
+from allocate.tests.data import create_service_areas
+
+
+def queried_annual_production(well, year):
+    """
+        The original per-well queries, to check the cube against
+    """
+    query = well.production.filter(year=year, month=None, semi_year=None)
+    if len(query) > 0:
+        return float(query.aggregate(Sum('quantity'))['quantity__sum'])
+    query = well.production.filter(year=year, month=None)
+    if len(query) == 0:
+        query = well.production.filter(year=year, semi_year=None)
+    total = query.aggregate(Sum('quantity'))['quantity__sum']
+    return None if total is None else float(total)
+
+
+class ProductionCubeTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_service_areas()
+        # a zero annual record still counts as having annual data
+        zero = models.Well.objects.create(well_id="w_zero", apn="6", ucm_service_area_id="sa_1")
+        models.WellProduction.objects.create(well=zero, year=2018, quantity=Decimal("0"))
+        models.WellProduction.objects.create(well=zero, year=2018, month=3, quantity=Decimal("7"))
+        # out of range semi years and months still count toward the fallbacks, like they did in the queries
+        odd_semi_year = models.Well.objects.create(well_id="w_odd_semi_year", apn="7", ucm_service_area_id="sa_1")
+        models.WellProduction.objects.create(well=odd_semi_year, year=2018, semi_year=1, quantity=Decimal("2"))
+        models.WellProduction.objects.create(well=odd_semi_year, year=2018, semi_year=3, quantity=Decimal("4"))
+        models.WellProduction.objects.create(well=odd_semi_year, year=2018, month=5, quantity=Decimal("100"))  # ignored - semi-annual data wins
+        odd_month = models.Well.objects.create(well_id="w_odd_month", apn="8", ucm_service_area_id="sa_1")
+        models.WellProduction.objects.create(well=odd_month, year=2018, month=2, quantity=Decimal("1"))
+        models.WellProduction.objects.create(well=odd_month, year=2018, month=13, quantity=Decimal("5"))
+        models.WellProduction.objects.create(well=odd_month, year=2018, month=4, semi_year=1, quantity=Decimal("50"))  # both, so only capacity
+
+    def setUp(self):
+        production.invalidate()
+
+    def test_matches_queries(self):
+        for well in models.Well.objects.all():
+            for year in (2017, 2018, 2019):
+                self.assertEqual(well.annual_production(year), queried_annual_production(well, year), msg=f"{well.well_id} {year}")
+            capacity = well.production.aggregate(Sum('quantity'))['quantity__sum']
+            self.assertEqual(well.capacity, None if capacity is None else float(capacity))
+
+    def test_out_of_range_periods(self):
+        self.assertEqual(models.Well.objects.get(well_id="w_odd_semi_year").annual_production(2018), 6)
+        odd_month = models.Well.objects.get(well_id="w_odd_month")
+        self.assertEqual(odd_month.annual_production(2018), 6)
+        self.assertEqual(odd_month.capacity, 56)
+        self.assertEqual(production.period_index(13, None), production.OTHER_MONTH)
+        self.assertEqual(production.period_index(None, 0), production.OTHER_SEMI_YEAR)
+        self.assertEqual(production.period_index(4, 1), production.OTHER)
+
+    def test_single_query(self):
+        wells = list(models.Well.objects.all())
+        with self.assertNumQueries(1):
+            for well in wells:
+                well.annual_production(2018)
+                well.capacity
+                well._semi_year_production(2018, 1)
+                well._monthly_production(2018, 3)
+
+    def test_periods_and_losses(self):
+        well = models.Well.objects.get(well_id="w_semi")
+        self.assertEqual(well._semi_year_production(2018, 2), 12.5)
+        self.assertIsNone(well._monthly_production(2018, 1))
+        cube = production.get_cube()
+        monthly = cube.monthly_production([models.Well.objects.get(well_id="w_monthly").id], 2018)
+        self.assertEqual(list(monthly[0]), [1.5] * 12)
+
+        well.allocated_amount = Decimal("20")
+        self.assertEqual(well.losses, 522.5 - 20)
+
+    def test_saves_invalidate(self):
+        well = models.Well.objects.get(well_id="w_sa_2")
+        self.assertEqual(well.annual_production(2018), 3)
+        models.WellProduction.objects.create(well=well, year=2018, quantity=Decimal("2"))
+        self.assertEqual(well.annual_production(2018), 5)
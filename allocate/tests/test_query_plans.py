@@ -0,0 +1,26 @@
+from django.test import TestCase
+
+from allocate import models
+from allocate.benchmarks import query_plans
+from allocate.tests.data import create_service_areas
+
+
+class QueryPlanTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_service_areas()
+
+    def test_hot_queries_use_indexes(self):
+        plans = query_plans.query_plans("sa_1")
+        self.assertEqual({name: plan["full_scans"] for name, plan in plans.items() if len(plan["full_scans"]) > 0}, {})
+        self.assertFalse(plans["pipes"]["temp_b_tree"])  # closest first straight from the index, without a sort
+
+    def test_finds_full_scans(self):
+        self.assertEqual(query_plans.full_scans(models.AgField.objects.filter(acres=4).explain()), ["allocate_agfield"])
+
+    def test_benchmark(self):
+        results = query_plans.run()
+        self.assertEqual(results["service_area"], "sa_1")
+        self.assertEqual(results["load_inputs"]["queries"], 9)
+        self.assertEqual(results["full_scans"], {})
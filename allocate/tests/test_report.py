@@ -0,0 +1,52 @@
+import contextlib
+import io
+import json
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from allocate import allocation, report
+from allocate.tests.data import create_service_areas
+
+
+class ServiceAreaReportTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_service_areas()
+
+    def test_matches_per_area_totals(self):
+        with self.assertNumQueries(4):  # demands, wells, production, and the list of service areas
+            rows = report.service_area_totals()
+
+        self.assertEqual([row["service_area"] for row in rows], ["sa_1", "sa_2"])
+        for row in rows:
+            totals = allocation.get_sa_total(row["service_area"])
+            self.assertAlmostEqual(row["demands"], totals["demands"])
+            self.assertAlmostEqual(row["supplies"], totals["supplies"])
+
+        self.assertEqual(rows[1]["demands"], 0)  # negative net demand
+        self.assertEqual(rows[1]["status"], "Oversupply - Can't allocate")
+        self.assertEqual(report.classify(1.2), "OK")
+        self.assertEqual(report.classify(0.5), "Undersupply - can't meet demand")
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            allocation.report_sa_totals()
+        self.assertIn("sa_2 - Supplies: 3.0, Demands: 0.0", output.getvalue())
+
+    def test_year_and_timestep(self):
+        rows = {row["service_area"]: row for row in report.service_area_totals(year=2017, timestep=2)}
+        self.assertEqual(rows["sa_1"]["supplies"], 500)  # only w_semi has 2017 production
+        self.assertEqual(rows["sa_1"]["demands"], 0)
+
+    def test_command(self):
+        output = io.StringIO()
+        call_command("report_service_areas", format="json", stdout=output)
+        results = json.loads(output.getvalue())
+        self.assertEqual(len(results["service_areas"]), 2)
+        self.assertAlmostEqual(results["total_supply"], sum(row["supplies"] for row in results["service_areas"]))
+
+        output = io.StringIO()
+        call_command("report_service_areas", stdout=output)
+        self.assertEqual(output.getvalue().splitlines()[0], ",".join(report.COLUMNS))
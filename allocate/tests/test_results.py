@@ -0,0 +1,100 @@
+import csv
+import os
+import tempfile
+import unittest
+
+import numpy
+from django.test import TestCase
+
+from allocate import allocation
+from allocate.lp import Solution
+from allocate.results import ResultStore
+from allocate.streaming import TopResults
+from allocate.tests.data import create_service_areas
+
+
+class ResultStoreTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_service_areas()
+
+    def setUp(self):
+        self.controller = allocation.MonteCarloController("sa_1", use_crop_constraints=True)
+        self.controller.brute_force_combinations_threshold = 0
+        self.controller.run(iterations=10)
+        self.store = self.controller.results
+
+    def test_rows_match_solutions(self):
+        lp = self.controller.lp
+        self.assertEqual(len(self.store), 10)
+        self.assertEqual(self.store.num_feasible, 10)
+        self.assertEqual(self.store.pipe_allocations.shape[1], len(lp.pipe_ids))
+
+        # re-solving the last row gives the same allocations
+        lp.set_efficiencies(self.store.efficiencies[9])
+        lp.solve()
+        numpy.testing.assert_allclose(self.store.pipe_allocations[9], lp.allocations, atol=1e-5)
+        numpy.testing.assert_allclose(self.store.total_allocations[9], lp.field_allocations, atol=1e-5)
+        numpy.testing.assert_allclose(self.store.net_demands[9], lp.demands - lp.field_allocations, atol=1e-5)
+
+        best = self.controller.best_result
+        self.assertEqual(best.objective_value, numpy.nanmax(self.store.objective_values))
+        field_result = best.results["field_a"]
+        self.assertAlmostEqual(field_result.total_allocations, self.store.total_allocations[best.row, 0])
+
+    def test_results_are_per_controller(self):
+        other = allocation.MonteCarloController("sa_2", use_crop_constraints=True)
+        other.run(iterations=3)
+        self.assertEqual(len(other.results), 2)  # brute forced
+        self.assertEqual(len(self.controller.results), 10)
+
+    def test_grows_past_capacity(self):
+        store = ResultStore(self.controller.lp, capacity=2)
+        solution = self.controller.lp.solution()  # the last solve from the run
+        for row in range(5):
+            store.add(solution)
+        self.assertEqual(len(store), 5)
+        self.assertGreaterEqual(store.capacity, 5)
+        self.assertTrue(store.feasible[:5].all())
+
+    def test_feasibility_is_shared(self):
+        lp = self.controller.lp
+        allocations = numpy.ones(len(lp.pipe_ids))
+        solutions = [Solution("optimal_inaccurate", 5.0, lp.efficiencies, allocations),
+                     Solution("infeasible_inaccurate", 9.0, lp.efficiencies, None),
+                     Solution("solver_error", None, lp.efficiencies, None),
+                     Solution("optimal", 7.0, lp.efficiencies, None)]  # no allocations to record
+        self.assertEqual([solution.feasible for solution in solutions], [True, False, False, False])
+
+        store = ResultStore(lp)
+        top = TopResults(k=5)
+        for solution in solutions:
+            store.add(solution)
+            top.add(solution)
+        self.assertEqual(store.feasible[:4].tolist(), [True, False, False, False])
+        self.assertEqual([solution.objective_value for solution in top.solutions()], [5.0])
+
+    def test_exports(self):
+        with tempfile.TemporaryDirectory() as folder:
+            self.store.to_npz(os.path.join(folder, "results.npz"))
+            with numpy.load(os.path.join(folder, "results.npz")) as arrays:
+                numpy.testing.assert_array_equal(arrays["pipe_allocations"], self.store.pipe_allocations[:10])
+                self.assertEqual(list(arrays["field_ids"]), list(self.controller.lp.field_ids))
+
+            self.store.to_csv(os.path.join(folder, "results.csv"))
+            with open(os.path.join(folder, "results.csv"), newline='') as fh:
+                rows = list(csv.DictReader(fh))
+            self.assertEqual(len(rows), 10 * len(self.controller.lp.field_ids))
+            self.assertEqual(rows[0]["field"], "field_a")
+
+    def test_parquet_export(self):
+        try:
+            from pyarrow import parquet
+        except ImportError:
+            raise unittest.SkipTest("pyarrow isn't installed")
+
+        with tempfile.TemporaryDirectory() as folder:
+            self.store.to_parquet(os.path.join(folder, "results.parquet"))
+            table = parquet.read_table(os.path.join(folder, "results.parquet"))
+        self.assertEqual(table.num_rows, 10 * len(self.controller.lp.field_ids))
@@ -0,0 +1,49 @@
+import unittest
+
+import numpy
+
+from allocate.sampling import EfficiencySampler, PRIOR, UNIFORM
+
+EFFICIENCIES = [[0.7, 0.86], [0.7, 0.86, 0.81, 0.01], [0.81]]
+PROBABILITIES = [[0.25, 0.75], [1, 1, 2, 0], [1]]
+
+
+class EfficiencySamplerTests(unittest.TestCase):
+
+    def test_reproducible(self):
+        first = EfficiencySampler(EFFICIENCIES, generator=42).draw(50)
+        second = EfficiencySampler(EFFICIENCIES, generator=42).draw(50)
+        numpy.testing.assert_array_equal(first, second)
+        self.assertEqual(first.shape, (50, 3))
+
+    def test_chunks_match_single_draw(self):
+        single = EfficiencySampler(EFFICIENCIES, generator=7).draw(25)
+        chunked = [efficiencies for indexes, efficiencies in EfficiencySampler(EFFICIENCIES, generator=7, chunk_size=10).chunks(25)]
+        self.assertEqual([len(chunk) for chunk in chunked], [10, 10, 5])
+        numpy.testing.assert_array_equal(numpy.concatenate(chunked), single)
+
+    def test_uniform(self):
+        indexes = EfficiencySampler(EFFICIENCIES, generator=1, mode=UNIFORM).draw_indexes(40000)
+        numpy.testing.assert_allclose(numpy.bincount(indexes[:, 1], minlength=4) / 40000, [0.25] * 4, atol=0.01)
+        self.assertTrue(numpy.all(indexes[:, 2] == 0))
+
+    def test_prior(self):
+        sampler = EfficiencySampler(EFFICIENCIES, PROBABILITIES, generator=1, mode=PRIOR)
+        indexes = sampler.draw_indexes(40000)
+        numpy.testing.assert_allclose(numpy.bincount(indexes[:, 0], minlength=2) / 40000, [0.25, 0.75], atol=0.01)
+        numpy.testing.assert_allclose(numpy.bincount(indexes[:, 1], minlength=4) / 40000, [0.25, 0.25, 0.5, 0], atol=0.01)
+        numpy.testing.assert_array_equal(numpy.unique(sampler.efficiencies(indexes)[:, 1]), [0.7, 0.81, 0.86])
+
+    def test_prior_needs_probabilities(self):
+        with self.assertRaises(ValueError):
+            EfficiencySampler(EFFICIENCIES, mode=PRIOR)
+
+    def test_all_combinations(self):
+        indexes, efficiencies = EfficiencySampler(EFFICIENCIES).all_combinations()
+        self.assertEqual(len(indexes), EfficiencySampler(EFFICIENCIES).num_combinations)
+        self.assertEqual(len(set(map(tuple, indexes))), len(indexes))
+
+        # no fields - a single empty combination
+        indexes, efficiencies = EfficiencySampler([]).all_combinations()
+        self.assertEqual(indexes.shape, (1, 0))
+        self.assertEqual(efficiencies.shape, (1, 0))
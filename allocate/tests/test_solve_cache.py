@@ -0,0 +1,118 @@
+import os
+import tempfile
+from unittest import mock
+
+import numpy
+from django.test import TestCase
+
+from allocate import allocation, models
+from allocate.lp import Solution
+from allocate.solve_cache import SolutionMemo, SolveCache, cached_solve
+from allocate.tests.data import create_service_areas
+
+
+class SolveCacheTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_service_areas()
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.cache = SolveCache(os.path.join(self.folder.name, "solve_cache.sqlite3"))
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def run_controller(self, iterations=20):
+        controller = allocation.MonteCarloController("sa_1", use_crop_constraints=True, solve_cache=self.cache)
+        controller.brute_force_combinations_threshold = 0
+        controller.run(iterations=iterations)
+        return controller
+
+    def test_rerun_reads_from_cache(self):
+        controller = self.run_controller()
+        self.assertGreater(controller.solver_calls, 0)
+        self.assertEqual(len(self.cache), controller.solver_calls)
+
+        rerun = self.run_controller()
+        self.assertEqual(rerun.solver_calls, 0)
+        self.assertEqual([result.objective_value for result in rerun.results], [result.objective_value for result in controller.results])
+
+    def test_changed_inputs_miss(self):
+        lp = allocation.build_lp(service_area="sa_1")
+        lp.set_efficiencies([0.7, 0.86, 0.81])
+        self.assertTrue(cached_solve(lp, self.cache)[1])
+
+        same_lp = allocation.build_lp(service_area="sa_1")
+        same_lp.set_efficiencies([0.7, 0.86, 0.81])
+        self.assertFalse(cached_solve(same_lp, self.cache)[1])
+
+        # different margins and different production both change the fingerprint
+        margin_lp = allocation.build_lp(service_area="sa_1", field_demand_margin=0.5)
+        margin_lp.set_efficiencies([0.7, 0.86, 0.81])
+        self.assertNotEqual(margin_lp.fingerprint, lp.fingerprint)
+
+        models.WellProduction.objects.filter(well__well_id="w_annual", crop__isnull=True).update(quantity=30)
+        changed_lp = allocation.build_lp(service_area="sa_1")
+        changed_lp.set_efficiencies([0.7, 0.86, 0.81])
+        self.assertTrue(cached_solve(changed_lp, self.cache)[1])
+
+    def test_legacy_problem_shares_cache(self):
+        inputs = allocation.load_inputs(service_area="sa_1")
+        lp = allocation.build_lp(inputs=inputs, add_debug=True)
+        lp.set_efficiencies([0.7, 0.86, 0.81])
+        solution, solved = cached_solve(lp, self.cache)
+
+        problem, problem_info = allocation.build_problem("sa_1", add_debug=True, inputs=inputs)
+        self.assertEqual(problem_info["fingerprint"], lp.fingerprint)
+        for param, efficiency in zip(problem_info["irrigation_efficiency_params"].values(), [0.7, 0.86, 0.81]):
+            param.value = efficiency
+        allocation.solve_and_report(problem, problem_info, solve_cache=self.cache)
+
+        self.assertIsNone(problem.status)  # never solved - filled in from the cache
+        self.assertEqual(self.cache.hits, 1)
+        numpy.testing.assert_allclose([variable.value for variable in problem_info["pipe_variables"]], solution.allocations)
+
+    def test_only_caches_optimal_solves(self):
+        lp = allocation.build_lp(service_area="sa_1")
+        lp.set_efficiencies([0.7, 0.86, 0.81])
+        with mock.patch.object(lp, "solution", return_value=Solution("user_limit", None, lp.efficiencies, None)):
+            solution, solved = cached_solve(lp, self.cache)
+        self.assertTrue(solved)
+        self.assertEqual(len(self.cache), 0)
+
+        solution, solved = cached_solve(lp, self.cache)
+        self.assertEqual(solution.status, "optimal")
+        self.assertTrue(solved)
+        self.assertEqual(len(self.cache), 1)
+        self.assertFalse(cached_solve(lp, self.cache)[1])
+
+    def test_evicts_least_recently_used(self):
+        cache = SolveCache(self.cache.path, max_entries=2, evict_every=1)
+        for name in ("a", "b"):
+            cache.put(name, Solution("optimal", 1.0, [0.75], [1.0, 2.0]))
+        cache.get("a")  # a is now more recently used than b
+        cache.put("c", Solution("infeasible", None, [0.75], None))
+
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c").status, "infeasible")
+        numpy.testing.assert_allclose(cache.get("a").allocations, [1.0, 2.0])
+
+    def test_memo_is_bounded(self):
+        memo = SolutionMemo(max_size=2)
+        keys = [SolutionMemo.key([efficiency]) for efficiency in (0.7, 0.8, 0.9)]
+        for key in keys[:2]:
+            memo.put(key, Solution("optimal", 1.0, [0.75], [1.0]))
+        memo.get(keys[0])  # keys[0] is now more recently used than keys[1]
+        memo.put(keys[2], Solution("optimal", 2.0, [0.75], [2.0]))
+
+        self.assertEqual(len(memo), 2)
+        self.assertIsNone(memo.get(keys[1]))
+        self.assertEqual(memo.get(keys[2]).objective_value, 2.0)
+        self.assertIsNotNone(memo.get(keys[0]))
+
+        off = SolutionMemo(max_size=0)
+        off.put(keys[0], Solution("optimal", 1.0, [0.75], [1.0]))
+        self.assertEqual(len(off), 0)
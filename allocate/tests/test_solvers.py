@@ -0,0 +1,57 @@
+import pickle
+
+from django.test import TestCase
+
+from allocate import allocation, solvers
+from allocate.benchmarks import solvers as solver_benchmark
+from allocate.solvers import SolverSettings
+from allocate.tests.data import create_service_areas
+
+
+class SolverSettingsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_service_areas()
+
+    def test_auto(self):
+        available = solvers.available_solvers()
+        self.assertGreater(len(available), 0)  # cvxpy always comes with some of them
+        settings = SolverSettings()
+        self.assertIn(settings.choose(10), available)
+        self.assertIn(settings.choose(10 ** 6), available)
+        self.assertEqual(SolverSettings(solver="SCS").choose(10), "SCS")
+
+    def test_auto_by_size(self):
+        settings = SolverSettings()
+        settings._available = ["HIGHS", "CLARABEL", "ECOS"]
+        self.assertEqual(settings.choose(100), "HIGHS")
+        self.assertEqual(settings.choose(10 ** 6), "CLARABEL")
+        settings._available = ["HIGHS", "ECOS"]
+        self.assertEqual(settings.choose(10 ** 6), "HIGHS")
+
+    def test_solve_kwargs(self):
+        kwargs = SolverSettings(solver="SCS", tolerance=1e-6, time_limit=30, warm_start=False).solve_kwargs(100)
+        self.assertEqual(kwargs, {"solver": "SCS", "warm_start": False, "verbose": False, "eps_abs": 1e-6, "eps_rel": 1e-6, "time_limit_secs": 30})
+        self.assertNotIn("solver", SolverSettings(solver=None).solve_kwargs(100))
+        self.assertIsNone(pickle.loads(pickle.dumps(SolverSettings()))._available)
+
+    def test_solvers_agree(self):
+        values = {}
+        for solver in solvers.available_solvers():
+            controller = allocation.MonteCarloController("sa_1", use_crop_constraints=True, solver_settings=SolverSettings(solver=solver))
+            controller.brute_force_combinations_threshold = 0
+            controller.run(iterations=5)
+            values[solver] = controller.best_result_objective_value
+        reference = next(iter(values.values()))
+        for solver, value in values.items():
+            self.assertAlmostEqual(value, reference, delta=abs(reference) * 0.01 + 1e-3, msg=solver)
+
+    def test_benchmark(self):
+        results = solver_benchmark.run(fields=20, iterations=2)
+        service_area = results["service_areas"][0]
+        self.assertEqual(set(service_area["solvers"]), set(solvers.available_solvers()))
+        self.assertIn(service_area["auto_solver"], service_area["solvers"])
+        for solver, solver_results in service_area["solvers"].items():
+            if solver != results["reference_solver"]:
+                self.assertIn("max_relative_objective_difference", solver_results)
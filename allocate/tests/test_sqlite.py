@@ -0,0 +1,83 @@
+from django.db import connection
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+
+from allocate import allocation, models, sqlite
+from allocate.benchmarks import sqlite_modes
+from allocate.tests.data import create_service_areas
+from allocate.writer import write_results
+
+
+class PragmaTests(TestCase):
+
+    def test_pragmas(self):
+        with connection.cursor() as cursor:
+            self.assertEqual(cursor.execute("PRAGMA synchronous").fetchone()[0], 1)  # NORMAL
+            self.assertEqual(cursor.execute("PRAGMA cache_size").fetchone()[0], -65536)
+
+
+class InMemoryCopyTests(TransactionTestCase):
+    # not a TestCase - SQLite can't back up the database from inside the transaction a TestCase runs in
+
+    def setUp(self):
+        create_service_areas()
+
+    def test_in_memory_copy_writes_back_results(self):
+        disk = connection.connection
+        with sqlite.in_memory_copy() as memory:
+            self.assertIs(connection.connection, memory)
+            inputs = allocation.load_inputs(service_area="sa_1")
+            lp = allocation.build_lp(inputs=inputs)
+            lp.set_efficiencies([0.7, 0.86, 0.81])
+            lp.solve()
+            write_results(inputs, lp.solution())
+            models.Crop.objects.filter(vw_crop_name="Almonds").update(vw_crop_name="not written back")  # not one of the result tables
+            self.assertEqual(models.Pipe.objects.exclude(allocation=None).count(), inputs.num_pipes)
+
+        self.assertIs(connection.connection, disk)
+        self.assertEqual(models.Pipe.objects.exclude(allocation=None).count(), inputs.num_pipes)
+        self.assertEqual(models.Well.objects.exclude(allocated_amount=None).count(), len(set(inputs.pipe_well_index)))
+        self.assertFalse(models.Crop.objects.filter(vw_crop_name="not written back").exists())
+
+    def test_failed_run_writes_nothing(self):
+        with self.assertRaises(RuntimeError):
+            with sqlite.in_memory_copy():
+                models.Pipe.objects.update(allocation=1)
+                raise RuntimeError()
+        self.assertFalse(models.Pipe.objects.filter(allocation=1).exists())
+
+    def test_write_back_only_changed_rows(self):
+        disk = connection.connection
+        with sqlite.in_memory_copy() as memory:
+            models.Well.objects.filter(well_id="w_sa_2").update(allocated_amount=5)
+            models.AgFieldResult.objects.create(agfield=models.AgField.objects.first(), irrigation_type=models.IrrigationType.objects.first(), estimated_probability=1)
+            self.assertEqual(sqlite.write_back(memory, disk), {"allocate_pipe": 0, "allocate_well": 1, "allocate_agfieldresult": 1})
+            self.assertEqual(sqlite.write_back(memory, disk), {"allocate_pipe": 0, "allocate_well": 0, "allocate_agfieldresult": 0})
+            models.AgFieldResult.objects.all().delete()
+
+        self.assertEqual(models.Well.objects.get(well_id="w_sa_2").allocated_amount, 5)
+        self.assertEqual(models.AgFieldResult.objects.count(), 1)  # deleting rows in the copy doesn't delete them from the file
+
+    def test_write_back_only_result_columns(self):
+        with sqlite.in_memory_copy():
+            models.Pipe.objects.update(allocation=2, distance=1)
+            models.Well.objects.filter(well_id="w_sa_2").update(allocated_amount=3, apn="changed")
+            models.Pipe.objects.filter(well__well_id="w_sa_2").delete()
+
+        self.assertIsNone(models.Pipe.objects.get(well__well_id="w_sa_2").allocation)  # still there, and not updated
+        self.assertFalse(models.Pipe.objects.exclude(well__well_id="w_sa_2").exclude(allocation=2).exists())
+        self.assertFalse(models.Pipe.objects.filter(distance=1).exists())
+        well = models.Well.objects.get(well_id="w_sa_2")
+        self.assertEqual(well.allocated_amount, 3)
+        self.assertEqual(well.apn, "4")
+
+    def test_not_in_transactions(self):
+        with transaction.atomic():
+            with self.assertRaises(RuntimeError):
+                with sqlite.in_memory_copy():
+                    pass
+
+    def test_benchmark(self):
+        results = sqlite_modes.run(iterations=1)
+        self.assertEqual(results["service_area"], "sa_1")
+        self.assertEqual(set(results["speedup"]), {"get_parts", "load_inputs"})
@@ -0,0 +1,125 @@
+import unittest
+
+import numpy
+from django.test import TestCase
+
+from allocate import allocation
+from allocate.lp import Solution
+from allocate.streaming import RunningStatistics, TopResults
+from allocate.tests.data import create_service_areas
+
+
+class RunningStatisticsTests(unittest.TestCase):
+
+    def test_matches_full_statistics(self):
+        generator = numpy.random.default_rng(1)
+        values = generator.normal(100, 15, size=(500, 3))
+        stats = RunningStatistics((3,), reservoir_size=1000, generator=2)
+        for row in values:
+            stats.update((numpy.arange(3),), row)
+
+        numpy.testing.assert_array_equal(stats.count, [500, 500, 500])
+        numpy.testing.assert_allclose(stats.mean, values.mean(axis=0))
+        numpy.testing.assert_allclose(stats.variance, values.var(axis=0, ddof=1))
+        numpy.testing.assert_array_equal(stats.minimum, values.min(axis=0))
+        numpy.testing.assert_array_equal(stats.maximum, values.max(axis=0))
+        # the reservoir holds everything, so the quantiles are exact
+        numpy.testing.assert_allclose(stats.quantiles([0.25, 0.5]), numpy.quantile(values, [0.25, 0.5], axis=0))
+
+    def test_memory_is_bounded(self):
+        generator = numpy.random.default_rng(3)
+        stats = RunningStatistics((2, 2), reservoir_size=64, generator=4)
+        for value in generator.uniform(0, 1, size=5000):
+            stats.update((numpy.array([0, 1]), numpy.array([1, 0])), value)
+
+        self.assertEqual(stats.reservoir.shape, (2, 2, 64))
+        self.assertEqual(stats.count[0, 1], 5000)
+        self.assertEqual(stats.count[0, 0], 0)
+        self.assertTrue(numpy.isnan(stats.quantiles(0.5)[0, 0]))
+        self.assertAlmostEqual(stats.quantiles(0.5)[0, 1], 0.5, delta=0.15)  # approximate from the reservoir
+
+    def test_merge(self):
+        generator = numpy.random.default_rng(5)
+        values = generator.normal(100, 15, size=(300, 3))
+        full = RunningStatistics((3,), reservoir_size=1000, generator=6)
+        first = RunningStatistics((3,), reservoir_size=1000, generator=7)
+        second = RunningStatistics((3,), reservoir_size=1000, generator=8)
+        for number, row in enumerate(values):
+            full.update((numpy.arange(3),), row)
+            (first if number < 120 else second).update((numpy.arange(3),), row)
+        first.merge(second)
+        first.merge(RunningStatistics((3,), reservoir_size=1000))  # nothing to add
+
+        numpy.testing.assert_array_equal(first.count, full.count)
+        numpy.testing.assert_allclose(first.mean, full.mean)
+        numpy.testing.assert_allclose(first.variance, full.variance)
+        numpy.testing.assert_array_equal(first.minimum, full.minimum)
+        numpy.testing.assert_allclose(first.quantiles([0.25, 0.5]), full.quantiles([0.25, 0.5]))
+
+        # past the reservoir size, the merged reservoir samples each side in proportion to its count
+        small = RunningStatistics((1,), reservoir_size=200, generator=9)
+        large = RunningStatistics((1,), reservoir_size=200, generator=10)
+        for value in range(1000):
+            small.update((numpy.array([0]),), value)
+        for value in range(1000, 4000):
+            large.update((numpy.array([0]),), value)
+        small.merge(large)
+        self.assertFalse(numpy.isnan(small.reservoir).any())
+        self.assertAlmostEqual((small.reservoir < 1000).mean(), 0.25, delta=0.1)
+
+    def test_top_results(self):
+        top = TopResults(k=2)
+        for value in (3, 1, None, 5, 4):
+            top.add(Solution("optimal" if value is not None else "infeasible", value, [0.75], [value or 0]))
+        self.assertEqual([solution.objective_value for solution in top.solutions()], [5, 4])
+
+        other = TopResults(k=2)
+        other.add(Solution("optimal", 6, [0.75], [6]))
+        top.merge(other)
+        self.assertEqual([solution.objective_value for solution in top.solutions()], [6, 5])
+
+
+class StreamingControllerTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_service_areas()
+
+    def run_controller(self, streaming_statistics, workers=None):
+        controller = allocation.MonteCarloController("sa_1", use_crop_constraints=True, streaming_statistics=streaming_statistics)
+        controller.brute_force_combinations_threshold = 0
+        controller.top_k = 3
+        controller.run(iterations=30, workers=workers)
+        return controller
+
+    def test_matches_full_results(self):
+        full = self.run_controller(False)
+        streaming = self.run_controller(True)
+
+        self.assertIsNone(streaming.results)
+        self.assertEqual(streaming.feasible_iterations, full.feasible_iterations)
+        self.assertAlmostEqual(streaming.best_result.objective_value, full.best_result.objective_value)
+        for field in full.lp.field_ids:
+            for name, mean in full.mean_effectiveness(field).items():
+                streaming_mean = streaming.mean_effectiveness(field)[name]
+                if mean is None:
+                    self.assertIsNone(streaming_mean)
+                else:
+                    self.assertAlmostEqual(streaming_mean, mean, places=6)
+            # streaming doesn't keep the per-iteration values
+            self.assertTrue(all(item["effectiveness"] == [] for item in streaming.efficiency_information[field]["irrigation"]))
+
+    def test_parallel_matches_full_results(self):
+        full = self.run_controller(False, workers=2)
+        streaming = self.run_controller(True, workers=2)
+
+        self.assertEqual(streaming.effectiveness.iterations, 30)
+        self.assertEqual(streaming.feasible_iterations, full.feasible_iterations)
+        self.assertAlmostEqual(streaming.best_result.objective_value, full.best_result.objective_value)
+        for field in full.lp.field_ids:
+            for name, mean in full.mean_effectiveness(field).items():
+                streaming_mean = streaming.mean_effectiveness(field)[name]
+                if mean is None:
+                    self.assertIsNone(streaming_mean)
+                else:
+                    self.assertAlmostEqual(streaming_mean, mean, places=6)
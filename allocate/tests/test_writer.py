@@ -0,0 +1,80 @@
+import json
+import os
+import tempfile
+
+import numpy
+from django.test import TestCase
+
+from allocate import allocation, models
+from allocate.tests.data import create_service_areas
+from allocate.writer import write_results
+
+
+class ResultsWriterTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        create_service_areas()
+
+    def run_controller(self, **kwargs):
+        controller = allocation.MonteCarloController("sa_1", use_crop_constraints=True, **kwargs)
+        controller.run(iterations=10)
+        return controller
+
+    def test_save_results(self):
+        controller = self.run_controller()
+        best = controller.best_solution
+        self.assertEqual(best.objective_value, controller.best_result_objective_value)
+
+        # pipes and wells are each one bulk update, and the field results are a delete and one insert, in a transaction
+        with self.assertNumQueries(6):
+            counts = controller.save_results()
+        self.assertEqual(counts, {"pipes": 9, "wells": 8, "field_results": 6})
+
+        for pipe_id, allocation_value in zip(controller.lp.pipe_ids, best.allocations):
+            pipe = models.Pipe.objects.get(id=pipe_id)
+            self.assertAlmostEqual(float(pipe.allocation), allocation_value, places=3)
+            self.assertIsNotNone(pipe.variable_name)
+        well = models.Well.objects.get(well_id="w_annual")
+        self.assertAlmostEqual(float(well.allocated_amount), float(sum(pipe.allocation for pipe in well.pipes.all())), places=3)
+
+        for field in controller.lp.field_ids:
+            probabilities = models.AgFieldResult.objects.filter(agfield__liq_id=field).values_list("estimated_probability", flat=True)
+            self.assertAlmostEqual(float(sum(probabilities)), 1, places=3)
+
+        # saving again replaces the field results rather than adding to them
+        controller.save_results()
+        self.assertEqual(models.AgFieldResult.objects.count(), 6)
+
+    def test_irrigation_probabilities(self):
+        controller = self.run_controller()  # brute forced - every combination is feasible, so the priors don't change
+        self.assertTrue(controller.brute_forced)
+        probabilities = controller.irrigation_probabilities()
+        field_a_priors = {item["irrigation_id"]: item["probability"] for item in controller.efficiency_information["field_a"]["irrigation"]}
+        for irrigation_id, probability in probabilities["field_a"]:
+            self.assertAlmostEqual(probability, field_a_priors[irrigation_id])
+
+        streaming = self.run_controller(streaming_statistics=True)
+        self.assertEqual(streaming.irrigation_probabilities(), probabilities)
+
+    def test_solve_and_report_saves(self):
+        problem, problem_info = allocation.build_problem("sa_1")
+        allocation.solve_and_report(problem, problem_info, save_results=True)
+        numpy.testing.assert_allclose([float(models.Pipe.objects.get(id=variable.alloc_pipe_id).allocation) for variable in problem_info["pipe_variables"]],
+                                      [variable.value for variable in problem_info["pipe_variables"]], atol=1e-3)
+
+    def test_infeasible_writes_no_allocations(self):
+        inputs = allocation.load_inputs(service_area="sa_1")
+        self.assertEqual(write_results(inputs, None), {"pipes": 0, "wells": 0, "field_results": 0})
+        self.assertFalse(models.Pipe.objects.filter(allocation__isnull=False).exists())
+
+    def test_batch_saves_results(self):
+        from allocate import batch
+        with tempfile.TemporaryDirectory() as output_folder:
+            batch.run_all_service_areas(output_folder, workers=2, iterations=3, save_results=True)
+            with open(os.path.join(output_folder, "results.jsonl")) as results_file:
+                results = [json.loads(line) for line in results_file]
+
+        self.assertTrue(all("best_solution" not in result for result in results))
+        self.assertEqual(models.Pipe.objects.filter(allocation__isnull=False).count(), 10)  # 9 in sa_1 and 1 in sa_2
+        self.assertEqual(set(models.AgFieldResult.objects.values_list("agfield__liq_id", flat=True)), {"field_a", "field_b", "field_c", "field_d"})
@@ -0,0 +1,56 @@
+"""
+    Writes model results back to the database - the solved allocation and variable name for every pipe in the
+    model, the total allocated from each well, and the estimated probability of each irrigation type for each field.
+    Everything is written with bulk_update/bulk_create in batches inside a single transaction, so writing a whole
+    valley run is a handful of statements per table rather than one UPDATE per pipe.
+"""
+
+import numpy
+from django.db import transaction
+
+from . import models
+
+WRITE_BATCH_SIZE = 500
+
+
+def write_results(inputs, solution=None, irrigation_probabilities=None, batch_size=WRITE_BATCH_SIZE):
+    """
+    :param inputs: the ModelInputs the solution was solved from
+    :param solution: a lp.Solution whose allocations are in the snapshot's pipe order (e.g. the Monte Carlo's best
+                     result). Pipes, and wells connected to them, are skipped if it's None or wasn't feasible
+    :param irrigation_probabilities: {liq_id: [(irrigation_type_id, probability), ...]} - replaces any existing
+                                     AgFieldResults for those fields. See MonteCarloController.irrigation_probabilities
+    :param batch_size: rows per bulk statement
+    :return: dict with the number of pipes, wells and field results written
+    """
+    pipes = []
+    wells = []
+    if solution is not None and solution.feasible:
+        allocations = numpy.round(numpy.asarray(solution.allocations, dtype=numpy.float64), 4)
+        pipes = [models.Pipe(id=int(pipe_id), allocation=float(allocation), variable_name=inputs.pipe_variable_name(pipe_index))
+                 for pipe_index, (pipe_id, allocation) in enumerate(zip(inputs.pipe_pks, allocations))]
+
+        # wells only get a total if they have pipes in the model - otherwise we didn't allocate them at all
+        well_totals = numpy.bincount(inputs.pipe_well_index, weights=allocations, minlength=inputs.num_wells)
+        wells = [models.Well(id=int(inputs.well_pks[well_index]), allocated_amount=round(float(well_totals[well_index]), 4))
+                 for well_index in numpy.unique(inputs.pipe_well_index)]
+
+    field_results = []
+    if irrigation_probabilities is not None:
+        field_pks = dict(zip(inputs.field_ids, inputs.field_pks))
+        field_results = [models.AgFieldResult(agfield_id=int(field_pks[field]), irrigation_type_id=irrigation_type_id, estimated_probability=round(float(probability), 5))
+                         for field, probabilities in irrigation_probabilities.items()
+                         for irrigation_type_id, probability in probabilities]
+
+    with transaction.atomic():
+        if len(pipes) > 0:
+            models.Pipe.objects.bulk_update(pipes, ["allocation", "variable_name"], batch_size=batch_size)
+        if len(wells) > 0:
+            models.Well.objects.bulk_update(wells, ["allocated_amount"], batch_size=batch_size)
+        if irrigation_probabilities is not None:
+            result_field_pks = [int(field_pks[field]) for field in irrigation_probabilities]
+            for start in range(0, len(result_field_pks), batch_size):  # in batches to stay under SQLite's variable limit
+                models.AgFieldResult.objects.filter(agfield_id__in=result_field_pks[start:start + batch_size]).delete()
+            models.AgFieldResult.objects.bulk_create(field_results, batch_size=batch_size)
+
+    return {"pipes": len(pipes), "wells": len(wells), "field_results": len(field_results)}